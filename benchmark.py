@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from contextlib import redirect_stdout
+from bulk_import import import_graph
+from graph_cache import CachedGraph, get_graph
+from mvcc import begin_transaction
+from cypher_engine import execute_query, create_index, find_nodes_with_index
+import parallel
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then reported as null
+    resource = None
+
+# Reproducible benchmarks over synthetic social graphs.
+#
+# A run generates a graph of `nodes` :Person nodes and about nodes * degree
+# :FOLLOWS relationships from a seed, bulk-imports it into an empty database
+# and then times the operations the engine is used for: cold loads of the
+# snapshot files, index builds, point lookups through find_nodes_with_index,
+# label scans, WHERE ranges, relationship matches, single-statement CREATEs,
+# transaction commits and a scan run serially and on `workers` parallel
+# workers. Every benchmark reports p50 / p99 latency, throughput and the
+# process's peak RSS so far; the report is JSON.
+#
+# Sources are uniform and targets are drawn as nodes * random() ** skew, so
+# in-degrees follow a power law with exponent 1 + skew / (skew - 1) (about
+# 2.7 for the default skew of 2.5), with the hubs at the low node numbers.
+#
+#   python benchmark.py --nodes 100000 --output bench.json
+#   python benchmark.py --nodes 100000 --baseline bench.json   # exits 1 on regressions
+
+CITIES = 100
+MIN_AGE, MAX_AGE = 18, 90
+
+
+class BenchmarkError(RuntimeError):
+    pass
+
+
+# ---- Synthetic graphs ----
+
+def person_name(number):
+    return f"person{number}"
+
+
+def generate_people(count, seed):
+    rng = random.Random(seed)
+    for number in range(count):
+        yield {
+            "id": number,
+            "labels": ["Person"],
+            "properties": {
+                "name": person_name(number),
+                "age": rng.randint(MIN_AGE, MAX_AGE),
+                "city": f"city{rng.randrange(CITIES)}"
+            }
+        }
+
+
+def generate_follows(count, degree, skew, seed):
+    # `degree` relationships per node, without self-loops; the same target
+    # may be drawn twice, as people can interact repeatedly
+    rng = random.Random(seed)
+    for source in range(count):
+        for _ in range(degree):
+            target = int(count * rng.random() ** skew)
+            if target != source:
+                yield {"start": source, "end": target, "type": "FOLLOWS", "properties": {}}
+
+
+def write_jsonl(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record))
+            f.write("\n")
+
+
+def generate_social_graph(directory, nodes, degree=5, skew=2.5, seed=42):
+    # Writes people.jsonl and follows.jsonl for bulk_import and returns their paths
+    if skew <= 1:
+        raise ValueError("skew must be greater than 1 for a power-law degree distribution")
+    node_file = os.path.join(directory, "people.jsonl")
+    rel_file = os.path.join(directory, "follows.jsonl")
+    write_jsonl(node_file, generate_people(nodes, seed))
+    write_jsonl(rel_file, generate_follows(nodes, degree, skew, seed + 1))
+    return node_file, rel_file
+
+
+# ---- Measurement ----
+
+def peak_rss_mb(who=None):
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(samples, fraction):
+    # Nearest-rank percentile of sorted samples
+    return samples[max(0, math.ceil(fraction * len(samples)) - 1)]
+
+
+def summarize(name, samples, seconds, extra=None):
+    samples = sorted(samples)
+    report = {
+        "name": name,
+        "operations": len(samples),
+        "seconds": round(seconds, 4),
+        "ops_per_second": round(len(samples) / seconds, 1) if seconds else None,
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 4),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 4),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 4),
+        "max_ms": round(samples[-1] * 1000, 4),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_children_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource is not None else None
+    }
+    report.update(extra or {})
+    return report
+
+
+def measure(name, operations, run):
+    # Calls run(i) `operations` times and times every call; engine results
+    # carrying an error abort the benchmark instead of being timed as successes
+    clock = time.perf_counter
+    samples = []
+    started = clock()
+    for i in range(operations):
+        call_started = clock()
+        result = run(i)
+        samples.append(clock() - call_started)
+        if isinstance(result, dict) and "error" in result:
+            raise BenchmarkError(f"{name}: {result['error']}")
+    return summarize(name, samples, clock() - started)
+
+
+def checked(result):
+    if "error" in result:
+        raise BenchmarkError(result["error"])
+    return result
+
+
+# ---- Benchmarks ----
+
+def bench_load(db_path, runs):
+    # A cold load parses the snapshot files and replays the log (GraphStorage + CachedGraph)
+    def load(_):
+        CachedGraph(db_path)
+    return measure("cold_load", runs, load)
+
+
+def bench_index_build(db_path):
+    # create_index reports on stdout, which carries the JSON report
+    with redirect_stdout(sys.stderr):
+        started = time.perf_counter()
+        create_index(db_path, "Person", "name")
+        name_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        create_index(db_path, "Person", "age", "range")
+        age_seconds = time.perf_counter() - started
+    return summarize("index_build", [name_seconds, age_seconds], name_seconds + age_seconds)
+
+
+def bench_point_lookup(db_path, nodes, operations, rng):
+    names = [person_name(rng.randrange(nodes)) for _ in range(operations)]
+
+    def lookup(i):
+        if not find_nodes_with_index(db_path, "Person", "name", names[i]):
+            raise BenchmarkError(f"point_lookup: {names[i]} not found")
+    return measure("point_lookup", operations, lookup)
+
+
+def bench_label_scan(db_path, operations):
+    return measure("label_scan", operations, lambda _: execute_query("MATCH (n:Person) RETURN count(*)", db_path))
+
+
+def bench_range(db_path, operations, rng):
+    # One year of ages, about 1/73 of the people
+    query = "MATCH (n:Person) WHERE n.age >= $low AND n.age < $high RETURN count(*)"
+    lows = [rng.randint(MIN_AGE, MAX_AGE) for _ in range(operations)]
+    return measure("where_range", operations, lambda i: execute_query(
+        query, db_path, params={"low": lows[i], "high": lows[i] + 1}))
+
+
+def bench_expand(db_path, nodes, operations, rng):
+    names = [person_name(rng.randrange(nodes)) for _ in range(operations)]
+    one_hop = "MATCH (a:Person {name: $name})-[:FOLLOWS]->(b) RETURN b.name"
+    two_hops = "MATCH (a:Person {name: $name})-[:FOLLOWS]->()-[:FOLLOWS]->(c) RETURN count(c)"
+    return [
+        measure("match_one_hop", operations, lambda i: execute_query(one_hop, db_path, params={"name": names[i]})),
+        measure("match_two_hops", operations, lambda i: execute_query(two_hops, db_path, params={"name": names[i]}))
+    ]
+
+
+def bench_create(db_path, operations, rng):
+    # One statement per node, each logged and committed on its own
+    def create(i):
+        return execute_query(
+            f"CREATE (p:Person {{name: 'created{i}', age: {rng.randint(MIN_AGE, MAX_AGE)}, "
+            f"city: 'city{rng.randrange(CITIES)}'}})",
+            db_path
+        )
+    return measure("create", operations, create)
+
+
+def bench_commit(db_path, operations, rng):
+    # Latency of COMMIT alone, for transactions that created one node each
+    clock = time.perf_counter
+    samples = []
+    started = clock()
+    for i in range(operations):
+        transaction = begin_transaction(db_path)
+        checked(execute_query(
+            f"CREATE (p:Person {{name: 'committed{i}', age: {rng.randint(MIN_AGE, MAX_AGE)}}})",
+            db_path, transaction=transaction
+        ))
+        commit_started = clock()
+        transaction.commit()
+        samples.append(clock() - commit_started)
+    return summarize("transaction_commit", samples, clock() - started)
+
+
+def bench_parallel_scan(db_path, workers, operations):
+    # The same scan and expansion serially and on `workers` workers once they
+    # hold the database, then the first run after a write, which must not
+    # wait for the workers to reload
+    query = "MATCH (a:Person)-[:FOLLOWS]->(b) WHERE b.age > a.age RETURN count(*)"
+    previous = parallel.parallelism(), parallel.MIN_PARALLEL_ROWS
+    graph = get_graph(db_path)
+    try:
+        parallel.set_parallelism(1)
+        serial = measure("parallel_scan_1", operations, lambda _: execute_query(query, db_path))
+        parallel.set_parallelism(workers, min_rows=0)
+        while not parallel.warm_up(graph, wait_loaded=True):
+            time.sleep(0.1)
+        scaled = measure(f"parallel_scan_{workers}", operations, lambda _: execute_query(query, db_path))
+        scaled["speedup"] = round(serial["p50_ms"] / scaled["p50_ms"], 2)
+        checked(execute_query("CREATE (p:Person {name: 'parallel', age: 30})", db_path))
+        after_write = measure("parallel_scan_after_write", 1, lambda _: execute_query(query, db_path))
+        after_write["serial_p50_ms"] = serial["p50_ms"]
+    finally:
+        parallel.set_parallelism(*previous)
+    return [serial, scaled, after_write]
+
+
+def run_benchmarks(nodes=10000, degree=5, skew=2.5, seed=42, operations=1000, scan_operations=20,
+                   load_runs=3, storage_format="binary", db_path=None, keep=False, progress=None, workers=None):
+    # Returns the report as a dict. Without db_path the graph lives in a
+    # temporary folder that is removed afterwards unless keep is set.
+    if workers is None:
+        workers = parallel.parallelism()
+    config = {
+        "nodes": nodes, "degree": degree, "skew": skew, "seed": seed, "operations": operations,
+        "scan_operations": scan_operations, "load_runs": load_runs, "storage_format": storage_format,
+        "workers": workers
+    }
+    say = progress or (lambda message: None)
+    workdir = tempfile.mkdtemp(prefix="graphdb-bench-")
+    if db_path is None:
+        db_path = os.path.join(workdir, "db")
+    rng = random.Random(seed + 2)
+    benchmarks = []
+    try:
+        say(f"Generating {nodes} nodes with {degree} relationships each")
+        started = time.perf_counter()
+        node_file, rel_file = generate_social_graph(workdir, nodes, degree, skew, seed)
+        generate_seconds = time.perf_counter() - started
+
+        say("Importing")
+        stats = import_graph(db_path, [node_file], [rel_file], storage_format)
+        benchmarks.append(summarize("bulk_import", [stats.seconds], stats.seconds, {
+            "nodes": stats.nodes,
+            "relationships": stats.relationships,
+            "entities_per_second": round(stats.entities_per_second, 1)
+        }))
+
+        say("Loading")
+        benchmarks.append(bench_load(db_path, load_runs))
+        get_graph(db_path)
+        say("Building indexes")
+        benchmarks.append(bench_index_build(db_path))
+        say("Reading")
+        benchmarks.append(bench_point_lookup(db_path, nodes, operations, rng))
+        benchmarks.append(bench_label_scan(db_path, scan_operations))
+        benchmarks.append(bench_range(db_path, scan_operations, rng))
+        benchmarks.extend(bench_expand(db_path, nodes, operations, rng))
+        # Writes last, so the reads above see exactly the generated graph
+        say("Writing")
+        benchmarks.append(bench_create(db_path, operations, rng))
+        benchmarks.append(bench_commit(db_path, operations, rng))
+        if workers > 1:
+            say(f"Scanning on {workers} workers")
+            benchmarks.extend(bench_parallel_scan(db_path, workers, scan_operations))
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "generate_seconds": round(generate_seconds, 4),
+        "benchmarks": benchmarks
+    }
+
+
+def compare(report, baseline, tolerance=0.25):
+    # Benchmarks whose p50 or p99 grew by more than `tolerance` over the baseline
+    if report["config"] != baseline.get("config"):
+        raise BenchmarkError("The baseline was recorded with a different configuration")
+    previous = {benchmark["name"]: benchmark for benchmark in baseline.get("benchmarks", [])}
+    regressions = []
+    for benchmark in report["benchmarks"]:
+        old = previous.get(benchmark["name"])
+        if old is None:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            if old[key] and benchmark[key] > old[key] * (1 + tolerance):
+                regressions.append(
+                    f"{benchmark['name']} {key}: {old[key]} -> {benchmark[key]} "
+                    f"(+{(benchmark[key] / old[key] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the graph database on a synthetic social graph")
+    parser.add_argument("--nodes", type=int, default=10000, help="number of :Person nodes")
+    parser.add_argument("--degree", type=int, default=5, help=":FOLLOWS relationships per node")
+    parser.add_argument("--skew", type=float, default=2.5, help="power-law skew of the targets (> 1)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--ops", type=int, default=1000, help="lookups, matches, creates and commits per benchmark")
+    parser.add_argument("--scan-ops", type=int, default=20, help="label scans and range queries per benchmark")
+    parser.add_argument("--load-runs", type=int, default=3, help="cold loads of the database")
+    parser.add_argument("--workers", type=int, help="parallel workers for the scaling check (default: "
+                        "GRAPH_DB_PARALLELISM or the number of cores; 1 skips it)")
+    parser.add_argument("--format", choices=["binary", "json"], default="binary", help="snapshot storage format")
+    parser.add_argument("--database", help="empty database folder to use instead of a temporary one")
+    parser.add_argument("--keep", action="store_true", help="keep the generated files and temporary database")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 / p99 growth over the baseline")
+    args = parser.parse_args()
+
+    result = run_benchmarks(
+        args.nodes, args.degree, args.skew, args.seed, args.ops, args.scan_ops, args.load_runs,
+        args.format, args.database, args.keep, progress=lambda message: print(message, file=sys.stderr),
+        workers=args.workers
+    )
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare(result, baseline, args.tolerance)
+        except BenchmarkError as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
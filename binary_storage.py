@@ -0,0 +1,474 @@
+import os
+import json
+import mmap
+import struct
+import time
+from array import array
+from graph_entities import Node, Relationship
+from lock_manager import lock_manager, EXCLUSIVE
+
+# Fixed-record snapshot format, used instead of nodes.json / relationships.json
+# when a database has been converted with json_to_binary():
+#
+#   nodes.<generation>.store          header + one node_record per node
+#   relationships.<generation>.store  header + one rel_record per relationship
+#   properties.<generation>.store     header + heap of strings, label lists and property blobs
+#   store.manifest                    {"generation": ...}: the current snapshot
+#
+# A new snapshot is written next to the current one and becomes current when
+# the manifest is replaced, a single atomic rename; a crash before that
+# leaves the previous snapshot in place. Stores written before the manifest
+# existed use the unsuffixed names and are read until the next snapshot.
+#
+# Records refer to each other by slot (record number) and to the heap by byte
+# offset. Each node heads two singly linked lists of its outgoing / incoming
+# relationships, continued through the next_out / next_in fields of the
+# relationship records. The engine keeps the whole graph resident, so a
+# reader decodes every record in one pass over the mapped files and does not
+# follow the chains; they stay in the format for readers that visit records
+# one at a time.
+
+MAGIC = b"GDBS"
+VERSION = 1
+# Null slot pointer (end of an edge chain)
+NO_SLOT = 0xFFFFFFFF
+# Null heap offset (offset 0 is inside the header, so never a real entry)
+NO_REF = 0
+
+# magic, version, generation, record count (heap size for properties.store)
+header = struct.Struct("<4sIQQ")
+# in use, id ref, labels ref, first out, first in, properties ref
+node_record = struct.Struct("<BQQIIQ")
+# in use, id ref, type ref, start slot, end slot, next out, next in, properties ref
+rel_record = struct.Struct("<BQQIIIIQ")
+
+count_field = struct.Struct("<I")
+ref_field = struct.Struct("<Q")
+int_field = struct.Struct("<q")
+float_field = struct.Struct("<d")
+TAG_NULL, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_FLOAT, TAG_STRING, TAG_JSON = range(7)
+
+NODES_FILE = "nodes.store"
+RELATIONSHIPS_FILE = "relationships.store"
+PROPERTIES_FILE = "properties.store"
+MANIFEST_FILE = "store.manifest"
+STORE_FILES = (NODES_FILE, RELATIONSHIPS_FILE, PROPERTIES_FILE)
+
+# Distinct property values a writer remembers for sharing
+SHARED_VALUE_LIMIT = 65536
+
+
+class StoreFormatError(ValueError):
+    pass
+
+
+def generation_name(name, generation):
+    # nodes.store -> nodes.<generation>.store
+    stem, extension = os.path.splitext(name)
+    return f"{stem}.{generation}{extension}"
+
+
+def read_manifest(db_path):
+    path = os.path.join(db_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def store_paths(db_path):
+    # Paths of the current snapshot's nodes, relationships and properties files
+    manifest = read_manifest(db_path)
+    if manifest is None:
+        return [os.path.join(db_path, name) for name in STORE_FILES]
+    return [os.path.join(db_path, generation_name(name, manifest["generation"])) for name in STORE_FILES]
+
+
+def _is_store_file(name):
+    stem, extension = os.path.splitext(name)
+    return extension == ".store" and stem.split(".")[0] in ("nodes", "relationships", "properties")
+
+
+def _sync_directory(db_path):
+    # Makes a rename in db_path durable; not possible (nor needed) on Windows
+    if os.name == "nt":
+        return
+    fd = os.open(db_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def remove_binary_store(db_path, keep_generation=None):
+    # Deletes the store files of every generation but keep_generation (all of
+    # them, and the manifest, when it is None)
+    if keep_generation is None:
+        manifest = os.path.join(db_path, MANIFEST_FILE)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+    current = {generation_name(name, keep_generation) for name in STORE_FILES} if keep_generation is not None else set()
+    for name in os.listdir(db_path):
+        if _is_store_file(name) and name not in current:
+            os.remove(os.path.join(db_path, name))
+
+
+class _Heap:
+    # Append-only byte heap for properties.store; labels, types and keys are
+    # stored once, property values only while the value table has room
+    def __init__(self):
+        self.data = bytearray(header.size)
+        self.strings = {}
+        self.values = {}
+        self.label_lists = {}
+
+    def string(self, text, shared=True):
+        # Unique strings such as ids skip the dedup table, which would only grow
+        offset = self.strings.get(text) if shared else None
+        if offset is None:
+            encoded = text.encode("utf-8")
+            offset = len(self.data)
+            if shared:
+                self.strings[text] = offset
+            self.data += count_field.pack(len(encoded)) + encoded
+        return offset
+
+    def value(self, text):
+        # Repeated values such as cities share one entry; once the table is
+        # full, new values are written as they come so it stops growing
+        offset = self.values.get(text)
+        if offset is None:
+            offset = self.string(text, shared=False)
+            if len(self.values) < SHARED_VALUE_LIMIT:
+                self.values[text] = offset
+        return offset
+
+    def labels(self, labels):
+        # Label lists are shared like strings: one entry per distinct combination
+        labels = tuple(sorted(labels))
+        offset = self.label_lists.get(labels)
+        if offset is None:
+            refs = [self.string(label) for label in labels]
+            offset = self.label_lists[labels] = len(self.data)
+            self.data += count_field.pack(len(refs))
+            for ref in refs:
+                self.data += ref_field.pack(ref)
+        return offset
+
+    def properties(self, properties):
+        if not properties:
+            return NO_REF
+        parts = [count_field.pack(len(properties))]
+        for key, value in properties.items():
+            parts.append(ref_field.pack(self.string(key)))
+            parts.append(self._value(value))
+        offset = len(self.data)
+        self.data += b"".join(parts)
+        return offset
+
+    def _value(self, value):
+        if value is None:
+            return bytes([TAG_NULL])
+        if isinstance(value, bool):
+            return bytes([TAG_TRUE if value else TAG_FALSE])
+        if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+            return bytes([TAG_INT]) + int_field.pack(value)
+        if isinstance(value, float):
+            return bytes([TAG_FLOAT]) + float_field.pack(value)
+        if isinstance(value, str):
+            return bytes([TAG_STRING]) + ref_field.pack(self.value(value))
+        # Lists, maps and big integers round-trip through JSON
+        return bytes([TAG_JSON]) + ref_field.pack(self.value(json.dumps(value)))
+
+
+class BinaryStoreWriter:
+    # Builds a binary snapshot incrementally, keeping only fixed-width arrays
+    # and the heap in memory, so large imports never hold Node objects.
+    # Nodes must be added before the relationships that refer to them.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.heap = _Heap()
+        self.node_fields = [array("Q"), array("Q"), array("Q")]  # id, labels, properties refs
+        self.first_out = array("I")
+        self.first_in = array("I")
+        # Chain tails, so edges are appended and chains list them in creation order
+        self.last_out = array("I")
+        self.last_in = array("I")
+        self.rel_fields = [array("Q"), array("Q"), array("I"), array("I"), array("Q")]  # id, type, start, end, properties
+        self.next_out = array("I")
+        self.next_in = array("I")
+
+    @property
+    def node_count(self):
+        return len(self.first_out)
+
+    @property
+    def rel_count(self):
+        return len(self.next_out)
+
+    def add_node(self, node_id, labels, properties):
+        # Returns the node's slot
+        heap = self.heap
+        slot = len(self.first_out)
+        id_refs, label_refs, prop_refs = self.node_fields
+        id_refs.append(heap.string(node_id, shared=False))
+        label_refs.append(heap.labels(labels))
+        prop_refs.append(heap.properties(properties))
+        self.first_out.append(NO_SLOT)
+        self.first_in.append(NO_SLOT)
+        self.last_out.append(NO_SLOT)
+        self.last_in.append(NO_SLOT)
+        return slot
+
+    def add_relationship(self, rel_id, start, end, rel_type, properties):
+        node_count = len(self.first_out)
+        if not (0 <= start < node_count and 0 <= end < node_count):
+            raise StoreFormatError(f"Relationship {rel_id} points to a node that does not exist")
+        heap = self.heap
+        slot = len(self.next_out)
+        id_refs, type_refs, starts, ends, prop_refs = self.rel_fields
+        id_refs.append(heap.string(rel_id, shared=False))
+        type_refs.append(heap.string(rel_type))
+        starts.append(start)
+        ends.append(end)
+        prop_refs.append(heap.properties(properties))
+        self.next_out.append(NO_SLOT)
+        self.next_in.append(NO_SLOT)
+        if self.first_out[start] == NO_SLOT:
+            self.first_out[start] = slot
+        else:
+            self.next_out[self.last_out[start]] = slot
+        self.last_out[start] = slot
+        if self.first_in[end] == NO_SLOT:
+            self.first_in[end] = slot
+        else:
+            self.next_in[self.last_in[end]] = slot
+        self.last_in[end] = slot
+        return slot
+
+    def finish(self):
+        # All three files carry the same generation, so a reader can tell if
+        # a crash left them from different snapshots
+        generation = time.time_ns()
+        heap = self.heap
+        heap.data[:header.size] = header.pack(MAGIC, VERSION, generation, len(heap.data))
+
+        node_data = bytearray(header.pack(MAGIC, VERSION, generation, self.node_count))
+        for fields in zip(*self.node_fields, self.first_out, self.first_in):
+            id_ref, labels_ref, props_ref, first_out, first_in = fields
+            node_data += node_record.pack(1, id_ref, labels_ref, first_out, first_in, props_ref)
+        rel_data = bytearray(header.pack(MAGIC, VERSION, generation, self.rel_count))
+        for fields in zip(*self.rel_fields, self.next_out, self.next_in):
+            id_ref, type_ref, start, end, props_ref, next_out, next_in = fields
+            rel_data += rel_record.pack(1, id_ref, type_ref, start, end, next_out, next_in, props_ref)
+
+        # The new generation is fully on disk before the manifest points at it
+        for name, data in ((NODES_FILE, node_data), (RELATIONSHIPS_FILE, rel_data), (PROPERTIES_FILE, heap.data)):
+            with open(os.path.join(self.db_path, generation_name(name, generation)), "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        manifest = os.path.join(self.db_path, MANIFEST_FILE)
+        with open(manifest + ".tmp", "w") as f:
+            json.dump({"generation": generation}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + ".tmp", manifest)
+        _sync_directory(self.db_path)
+        remove_binary_store(self.db_path, keep_generation=generation)
+
+
+def write_binary_store(db_path, nodes, relationships):
+    # Write a complete snapshot of in-memory nodes and relationships
+    writer = BinaryStoreWriter(db_path)
+    slot_of = {}
+    for node in nodes:
+        slot_of[node.id] = writer.add_node(node.id, node.labels, dict(node.properties))
+    for rel in relationships:
+        start, end = slot_of.get(rel.start_node), slot_of.get(rel.end_node)
+        if start is None or end is None:
+            raise StoreFormatError(f"Relationship {rel.id} points to a node that does not exist")
+        writer.add_relationship(rel.id, start, end, rel.rel_type, dict(rel.properties))
+    writer.finish()
+
+
+class BinaryGraphReader:
+    # Read-only, memory-mapped view of a binary snapshot. Opening it only
+    # checks the headers; load() decodes the records.
+    def __init__(self, db_path):
+        self._files = []
+        self._maps = []
+        paths = store_paths(db_path)
+        while True:
+            try:
+                self.nodes_map, node_count, generation = self._open(paths[0])
+                self.rels_map, rel_count, rel_generation = self._open(paths[1])
+                self.heap, _, heap_generation = self._open(paths[2])
+                break
+            except FileNotFoundError:
+                # A snapshot written meanwhile removed the files; retry on the new one
+                self.close()
+                previous, paths = paths, store_paths(db_path)
+                if paths == previous:
+                    raise
+            except BaseException:
+                self.close()
+                raise
+        if not generation == rel_generation == heap_generation:
+            self.close()
+            raise StoreFormatError(f"Binary store files in {db_path} belong to different snapshots")
+        self.node_count = node_count
+        self.rel_count = rel_count
+        self._strings = {}
+
+    def _open(self, path):
+        f = open(path, "rb")
+        self._files.append(f)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(data)
+        if len(data) < header.size:
+            raise StoreFormatError(f"{path} is truncated")
+        magic, version, generation, count = header.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise StoreFormatError(f"{path} is not a version {VERSION} graph store")
+        return data, count, generation
+
+    def close(self):
+        for data in self._maps:
+            data.close()
+        for f in self._files:
+            f.close()
+        self._maps = []
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _text(self, offset):
+        (length,) = count_field.unpack_from(self.heap, offset)
+        start = offset + count_field.size
+        return self.heap[start:start + length].decode("utf-8")
+
+    def string(self, offset):
+        # Decoded strings are cached, so repeated ids, labels and keys share one object
+        text = self._strings.get(offset)
+        if text is None:
+            text = self._strings[offset] = self._text(offset)
+        return text
+
+    def _labels(self, offset):
+        (count,) = count_field.unpack_from(self.heap, offset)
+        offset += count_field.size
+        return [
+            self.string(ref_field.unpack_from(self.heap, offset + i * ref_field.size)[0])
+            for i in range(count)
+        ]
+
+    def _properties(self, offset):
+        if offset == NO_REF:
+            return {}
+        heap = self.heap
+        (count,) = count_field.unpack_from(heap, offset)
+        offset += count_field.size
+        properties = {}
+        for _ in range(count):
+            (key_ref,) = ref_field.unpack_from(heap, offset)
+            tag = heap[offset + ref_field.size]
+            offset += ref_field.size + 1
+            if tag == TAG_NULL:
+                value = None
+            elif tag == TAG_FALSE:
+                value = False
+            elif tag == TAG_TRUE:
+                value = True
+            elif tag == TAG_INT:
+                (value,) = int_field.unpack_from(heap, offset)
+                offset += int_field.size
+            elif tag == TAG_FLOAT:
+                (value,) = float_field.unpack_from(heap, offset)
+                offset += float_field.size
+            elif tag in (TAG_STRING, TAG_JSON):
+                (ref,) = ref_field.unpack_from(heap, offset)
+                offset += ref_field.size
+                value = self.string(ref) if tag == TAG_STRING else json.loads(self.string(ref))
+            else:
+                raise StoreFormatError(f"Unknown property tag {tag} at offset {offset}")
+            properties[self.string(key_ref)] = value
+        return properties
+
+    def load(self):
+        # (nodes, relationships) of the whole store, for building the resident
+        # graph: one sequential pass over each record array. Ids (unique)
+        # bypass the string cache and endpoints come from the node pass.
+        text = self._text
+        string = self.string
+        properties = self._properties
+        label_lists = {}
+        nodes = []
+        with memoryview(self.nodes_map) as view, \
+                view[header.size:header.size + self.node_count * node_record.size] as records:
+            for _, id_ref, labels_ref, _, _, props_ref in node_record.iter_unpack(records):
+                labels = label_lists.get(labels_ref)
+                if labels is None:
+                    labels = label_lists[labels_ref] = self._labels(labels_ref)
+                nodes.append(Node(text(id_ref), labels, properties(props_ref)))
+        ids = [node.id for node in nodes]
+        relationships = []
+        with memoryview(self.rels_map) as view, \
+                view[header.size:header.size + self.rel_count * rel_record.size] as records:
+            for _, id_ref, type_ref, start, end, _, _, props_ref in rel_record.iter_unpack(records):
+                relationships.append(Relationship(text(id_ref), ids[start], ids[end], string(type_ref), properties(props_ref)))
+        return nodes, relationships
+
+
+def has_binary_store(db_path):
+    return os.path.exists(os.path.join(db_path, MANIFEST_FILE)) or os.path.exists(os.path.join(db_path, NODES_FILE))
+
+
+def json_to_binary(db_path, keep_source=False):
+    # Convert a database from nodes.json / relationships.json to the binary
+    # store. The write-ahead log is folded in first. With keep_source the JSON
+    # files stay behind as a (no longer updated) copy.
+    from graph_cache import get_graph
+    graph = get_graph(db_path)
+    # Other processes wait on the file lock until the conversion is done
+    with lock_manager.locked(graph.resource, EXCLUSIVE), graph.lock, graph.storage.lock:
+        graph.refresh()
+        graph.checkpoint()
+        write_binary_store(db_path, graph.nodes, graph.relationships)
+        if not keep_source:
+            for name in ("nodes.json", "relationships.json"):
+                path = os.path.join(db_path, name)
+                if os.path.exists(path):
+                    os.remove(path)
+        graph.storage.select_format()
+        graph.refresh()
+
+
+def binary_to_json(db_path):
+    # Convert a database from the binary store back to the JSON layout. The
+    # store files and manifest are removed, since they select the binary format.
+    from graph_cache import get_graph
+    graph = get_graph(db_path)
+    # Other processes wait on the file lock until the conversion is done
+    with lock_manager.locked(graph.resource, EXCLUSIVE), graph.lock, graph.storage.lock:
+        graph.refresh()
+        graph.checkpoint()
+        storage = graph.storage
+        storage.save_json_snapshot(graph.nodes, graph.relationships)
+        remove_binary_store(db_path)
+        storage.select_format()
+        graph.refresh()
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3 or sys.argv[1] not in ("to-binary", "to-json"):
+        sys.exit("usage: python binary_storage.py to-binary|to-json <database folder>")
+    if sys.argv[1] == "to-binary":
+        json_to_binary(sys.argv[2])
+    else:
+        binary_to_json(sys.argv[2])
@@ -0,0 +1,266 @@
+import os
+import csv
+import json
+import time
+import argparse
+from binary_storage import BinaryStoreWriter, has_binary_store
+
+# Offline loader for large node and relationship files, in the spirit of
+# neo4j-admin import. Input is streamed record by record and the snapshot
+# files are written directly, without going through the query engine, the
+# write-ahead log or the resident graph. The target database must be empty
+# and nothing may write to it during the import. Index definitions already
+# registered on it (equality, range and composite) are left in place and
+# built from the imported nodes when the database is first opened.
+#
+# CSV files have a header row. Special columns:
+#   nodes:          :ID (import id used by relationship files), :LABEL (';'-separated)
+#   relationships:  :START_ID, :END_ID, :TYPE
+# Other columns are properties, strings unless typed as name:int, name:long,
+# name:float, name:double or name:boolean. Empty cells are left out.
+#
+# JSONL files hold one object per line:
+#   nodes:          {"id": ..., "labels": [...], "properties": {...}}
+#   relationships:  {"start": ..., "end": ..., "type": ..., "properties": {...}}
+
+# Number of UUIDs generated per os.urandom call
+ID_BATCH = 10000
+
+converters = {
+    "string": str,
+    "int": int,
+    "long": int,
+    "float": float,
+    "double": float,
+    "boolean": lambda value: value.strip().lower() == "true",
+}
+special_fields = {"ID", "LABEL", "START_ID", "END_ID", "TYPE"}
+
+
+class BulkImportError(ValueError):
+    pass
+
+
+class ImportStats:
+    def __init__(self):
+        self.nodes = 0
+        self.relationships = 0
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    @property
+    def entities(self):
+        return self.nodes + self.relationships
+
+    @property
+    def entities_per_second(self):
+        seconds = self.seconds or (time.perf_counter() - self.started)
+        return self.entities / seconds if seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.nodes} nodes, {self.relationships} relationships in {self.seconds:.2f}s "
+            f"({self.entities_per_second:,.0f} entities/s)"
+        )
+
+
+def id_stream():
+    # Random (version 4) UUID strings, drawing entropy one batch at a time and
+    # formatting the hex directly instead of building uuid.UUID objects
+    variant = "89ab"
+    while True:
+        data = os.urandom(16 * ID_BATCH).hex()
+        for offset in range(0, len(data), 32):
+            h = data[offset:offset + 32]
+            yield (
+                f"{h[:8]}-{h[8:12]}-4{h[13:16]}-"
+                f"{variant[int(h[16], 16) & 3]}{h[17:20]}-{h[20:]}"
+            )
+
+
+def parse_header(header):
+    # Column name -> (record key, converter); special columns keep their ':X' key
+    fields = []
+    for column in header:
+        name, _, kind = column.rpartition(":")
+        if not _:
+            fields.append((column, str))
+        elif kind.upper() in special_fields:
+            fields.append((":" + kind.upper(), str))
+        elif kind.lower() in converters:
+            fields.append((name, converters[kind.lower()]))
+        else:
+            raise BulkImportError(f"Unknown column type in header: {column}")
+    return fields
+
+
+def read_csv(path, delimiter):
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        if header is None:
+            return
+        fields = parse_header(header)
+        for line_no, values in enumerate(reader, 2):
+            record = {}
+            for (key, convert), value in zip(fields, values):
+                if value == "":
+                    continue
+                try:
+                    record[key] = convert(value)
+                except ValueError:
+                    raise BulkImportError(f"{path}:{line_no}: invalid value {value!r} for {key}")
+            yield line_no, record
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError as e:
+                raise BulkImportError(f"{path}:{line_no}: {e}")
+
+
+def read_nodes(path, delimiter):
+    # (line, import id, labels, properties) per node
+    if path.endswith(".csv"):
+        for line_no, record in read_csv(path, delimiter):
+            import_id = record.pop(":ID", None)
+            labels = [label for label in record.pop(":LABEL", "").split(";") if label]
+            yield line_no, import_id, labels, record
+    else:
+        for line_no, record in read_jsonl(path):
+            labels = record.get("labels", [])
+            if isinstance(labels, str):
+                labels = [labels]
+            yield line_no, record.get("id"), labels, record.get("properties", {})
+
+
+def read_relationships(path, delimiter):
+    # (line, start import id, end import id, type, properties) per relationship
+    if path.endswith(".csv"):
+        for line_no, record in read_csv(path, delimiter):
+            yield line_no, record.pop(":START_ID", None), record.pop(":END_ID", None), record.pop(":TYPE", None), record
+    else:
+        for line_no, record in read_jsonl(path):
+            yield line_no, record.get("start"), record.get("end"), record.get("type"), record.get("properties", {})
+
+
+class _JsonSink:
+    # Streams nodes.json / relationships.json as JSON arrays, one entity per line
+    def __init__(self, db_path):
+        self.paths = [os.path.join(db_path, "nodes.json"), os.path.join(db_path, "relationships.json")]
+        self.files = [open(path + ".tmp", "w", encoding="utf-8") for path in self.paths]
+        self.counts = [0, 0]
+        self.node_ids = []
+        for f in self.files:
+            f.write("[")
+
+    def _write(self, which, data):
+        f = self.files[which]
+        f.write(",\n" if self.counts[which] else "\n")
+        f.write(json.dumps(data))
+        self.counts[which] += 1
+
+    def add_node(self, node_id, labels, properties):
+        self._write(0, {"id": node_id, "labels": labels, "properties": properties})
+        self.node_ids.append(node_id)
+        return len(self.node_ids) - 1
+
+    def add_relationship(self, rel_id, start, end, rel_type, properties):
+        self._write(1, {
+            "id": rel_id,
+            "start_node": self.node_ids[start],
+            "end_node": self.node_ids[end],
+            "type": rel_type,
+            "properties": properties
+        })
+
+    def finish(self):
+        for f, path in zip(self.files, self.paths):
+            f.write("\n]\n")
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.replace(path + ".tmp", path)
+
+
+def is_empty_database(db_path):
+    if has_binary_store(db_path):
+        return False
+    log_file = os.path.join(db_path, "wal.log")
+    if os.path.exists(log_file) and os.path.getsize(log_file):
+        return False
+    for name in ("nodes.json", "relationships.json"):
+        path = os.path.join(db_path, name)
+        if os.path.exists(path):
+            with open(path) as f:
+                if json.load(f):
+                    return False
+    return True
+
+
+def import_graph(db_path, node_files=(), relationship_files=(), storage_format="binary",
+                 delimiter=",", progress=None, progress_every=100000):
+    # Loads the files into an empty database and returns ImportStats.
+    # progress(stats) is called every `progress_every` entities.
+    if storage_format not in ("binary", "json"):
+        raise ValueError(f"Unknown storage format: {storage_format}")
+    os.makedirs(db_path, exist_ok=True)
+    if not is_empty_database(db_path):
+        raise BulkImportError(f"{db_path} already contains data; bulk import needs an empty database")
+
+    sink = BinaryStoreWriter(db_path) if storage_format == "binary" else _JsonSink(db_path)
+    stats = ImportStats()
+    ids = id_stream()
+    slot_of = {}
+
+    def tick():
+        if progress is not None and stats.entities % progress_every == 0:
+            progress(stats)
+
+    for path in node_files:
+        for line_no, import_id, labels, properties in read_nodes(path, delimiter):
+            node_id = next(ids)
+            slot = sink.add_node(node_id, labels, properties)
+            if import_id is not None:
+                import_id = str(import_id)
+                if import_id in slot_of:
+                    raise BulkImportError(f"{path}:{line_no}: duplicate node id {import_id!r}")
+                slot_of[import_id] = slot
+            stats.nodes += 1
+            tick()
+
+    for path in relationship_files:
+        for line_no, start_id, end_id, rel_type, properties in read_relationships(path, delimiter):
+            start, end = slot_of.get(str(start_id)), slot_of.get(str(end_id))
+            if start is None or end is None:
+                missing = start_id if start is None else end_id
+                raise BulkImportError(f"{path}:{line_no}: unknown node id {missing!r}")
+            if not rel_type:
+                raise BulkImportError(f"{path}:{line_no}: relationship without a type")
+            sink.add_relationship(next(ids), start, end, rel_type, properties)
+            stats.relationships += 1
+            tick()
+
+    sink.finish()
+    stats.seconds = time.perf_counter() - stats.started
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import CSV / JSONL files into an empty database")
+    parser.add_argument("database", help="database folder, e.g. databases/DB4")
+    parser.add_argument("--nodes", nargs="*", default=[], help="node files (.csv or .jsonl)")
+    parser.add_argument("--relationships", nargs="*", default=[], help="relationship files (.csv or .jsonl)")
+    parser.add_argument("--format", choices=["binary", "json"], default="binary")
+    parser.add_argument("--delimiter", default=",")
+    args = parser.parse_args()
+    result = import_graph(
+        args.database, args.nodes, args.relationships, args.format, args.delimiter,
+        progress=lambda stats: print(f"{stats.entities} entities ({stats.entities_per_second:,.0f}/s)")
+    )
+    print(result)
@@ -0,0 +1,244 @@
+import json
+import asyncio
+from itertools import count
+from contextlib import asynccontextmanager, suppress
+
+# asyncio client for server.py. GraphClient keeps a pool of logged-in
+# connections; run() borrows one per query, session() holds one for a
+# sequence of statements (needed for transactions and cursors), and
+# pipeline() sends a batch of queries on one connection without waiting for
+# each answer.
+#
+#   client = GraphClient(database="DB1", password="...", pool_size=10)
+#   result = await client.run("MATCH (n:Person) RETURN n.name")
+#   async with client.session() as session:
+#       await session.begin()
+#       await session.run("CREATE (p:Person {name: 'Ada'})")
+#       await session.commit()
+#   await client.close()
+
+# Same as server.DEFAULT_PORT; the client does not import the engine
+DEFAULT_PORT = 7688
+# Largest response line accepted (a whole-graph MATCH can be big)
+MAX_RESPONSE_SIZE = 256 * 1024 * 1024
+
+
+class GraphClientError(Exception):
+    pass
+
+
+class Connection:
+    # One socket; requests may be pipelined, answers are matched by id
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ids = count(1)
+        self.pending = {}
+        self.listener = asyncio.create_task(self._listen())
+
+    @classmethod
+    async def open(cls, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+        if unix_path:
+            reader, writer = await asyncio.open_unix_connection(unix_path, limit=MAX_RESPONSE_SIZE)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_RESPONSE_SIZE)
+        return cls(reader, writer)
+
+    async def _listen(self):
+        error = GraphClientError("Connection closed")
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self.pending.pop(response.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (ConnectionError, ValueError) as e:
+            error = GraphClientError(f"Connection lost: {e}")
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    @property
+    def closed(self):
+        return self.listener.done()
+
+    def send(self, op, **fields):
+        # Queues a request and returns a future for its result
+        if self.closed:
+            raise GraphClientError("Connection closed")
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(json.dumps({"id": request_id, "op": op, **fields}).encode() + b"\n")
+        return future
+
+    async def request(self, op, **fields):
+        future = self.send(op, **fields)
+        # Respects the server's backpressure: waits while the socket buffer is full
+        await self.writer.drain()
+        return unwrap(await future)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        await asyncio.gather(self.listener, return_exceptions=True)
+
+
+def unwrap(response):
+    if "error" in response:
+        raise GraphClientError(response["error"])
+    return response["result"]
+
+
+class Session:
+    def __init__(self, connection):
+        self.connection = connection
+        self.in_transaction = False
+
+    async def run(self, query, params=None, limits=None):
+        extra = {"limits": limits} if limits else {}
+        return await self.connection.request("query", query=query, params=params or {}, **extra)
+
+    async def begin(self):
+        result = await self.connection.request("begin")
+        self.in_transaction = True
+        return result
+
+    async def commit(self):
+        # The server ends the transaction even when the commit fails
+        self.in_transaction = False
+        return await self.connection.request("commit")
+
+    async def rollback(self):
+        self.in_transaction = False
+        return await self.connection.request("rollback")
+
+    async def reset(self):
+        # Whether the connection can go back to the pool: a transaction left
+        # open by the borrower is rolled back first
+        if self.connection.closed:
+            return False
+        if self.in_transaction:
+            try:
+                await self.rollback()
+            except GraphClientError:
+                return False
+        return True
+
+    async def stream(self, query, params=None, batch_size=100):
+        # Async iterator over the rows of a MATCH, fetched batch by batch
+        opened = await self.connection.request("open", query=query, params=params or {})
+        cursor = opened["cursor"]
+        done = False
+        try:
+            while not done:
+                batch = await self.connection.request("fetch", cursor=cursor, size=batch_size)
+                done = batch["done"]
+                for row in batch["rows"]:
+                    yield row
+        finally:
+            if not done and not self.connection.closed:
+                with suppress(GraphClientError, ConnectionError):
+                    await self.connection.request("close", cursor=cursor)
+
+
+class GraphClient:
+    def __init__(self, database, password, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None, pool_size=10):
+        self.database = database
+        self.password = password
+        self.address = (host, port, unix_path)
+        self.pool_size = pool_size
+        self.idle = []
+        self.opened = 0
+        self.available = asyncio.Condition()
+
+    async def _connect(self):
+        connection = await Connection.open(*self.address)
+        try:
+            await connection.request("login", database=self.database, password=self.password)
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def acquire(self):
+        # Reuses an idle connection, opens a new one below pool_size, else waits
+        async with self.available:
+            while True:
+                while self.idle:
+                    connection = self.idle.pop()
+                    if not connection.closed:
+                        return connection
+                    self.opened -= 1
+                if self.opened < self.pool_size:
+                    self.opened += 1
+                    break
+                await self.available.wait()
+        try:
+            return await self._connect()
+        except BaseException:
+            async with self.available:
+                self.opened -= 1
+                self.available.notify()
+            raise
+
+    async def release(self, connection, reusable=True):
+        async with self.available:
+            if reusable and not connection.closed:
+                self.idle.append(connection)
+            else:
+                self.opened -= 1
+                asyncio.ensure_future(connection.close())
+            self.available.notify()
+
+    @asynccontextmanager
+    async def session(self):
+        connection = await self.acquire()
+        session = Session(connection)
+        reusable = False
+        try:
+            yield session
+        finally:
+            try:
+                reusable = await session.reset()
+            finally:
+                await self.release(connection, reusable)
+
+    async def run(self, query, params=None, limits=None):
+        async with self.session() as session:
+            return await session.run(query, params, limits)
+
+    async def pipeline(self, queries):
+        # [(query, params) or query, ...] -> results in the same order; errors
+        # are returned in place as GraphClientError instances
+        async with self.session() as session:
+            connection = session.connection
+            futures = []
+            for item in queries:
+                query, params = (item, None) if isinstance(item, str) else item
+                futures.append(connection.send("query", query=query, params=params or {}))
+                await connection.writer.drain()
+            results = []
+            for response in await asyncio.gather(*futures, return_exceptions=True):
+                if isinstance(response, BaseException):
+                    results.append(response)
+                    continue
+                try:
+                    results.append(unwrap(response))
+                except GraphClientError as e:
+                    results.append(e)
+            return results
+
+    async def close(self):
+        async with self.available:
+            idle, self.idle = self.idle, []
+            self.opened -= len(idle)
+        await asyncio.gather(*(connection.close() for connection in idle))
@@ -0,0 +1,277 @@
+import threading
+from range_index import order_key
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; WHERE filters then run row by row
+    np = None
+
+# Columnar evaluation of WHERE predicates over label scans.
+#
+# For every (label, property) a filter touches, the property values of the
+# label's nodes are kept as NumPy arrays in label-posting order, with validity
+# masks: `present` (the value is not null), `numeric` (it orders as a number,
+# see range_index.order_key) and `complex` (a list or map, which the masks do
+# not model). Strings are dictionary-encoded. Columns are built on first use
+# and extended in place with the tail of the posting list as nodes are added,
+# into buffers that double when full; entities are append-only, so existing
+# entries only change when a procedure writes properties back, which drops the
+# affected columns.
+#
+# Predicates are compiled by the planner into small mask programs (Compare,
+# IsNull, Not, Logical). A program evaluates to a pair of boolean masks (true,
+# false) over a range of the label; positions in neither are null, which gives
+# Cypher's three-valued logic without per-row Python code.
+
+available = np is not None
+
+
+class NotVectorisable(Exception):
+    # The values at hand need the row-by-row evaluator
+    pass
+
+
+def grow(array, count, needed):
+    # `array` with room for `needed` entries, keeping its first `count`; the
+    # capacity doubles, so appending n entries one tail at a time copies O(n)
+    if needed <= len(array):
+        return array
+    grown = np.empty(max(needed, 2 * len(array)), dtype=array.dtype)
+    grown[:count] = array[:count]
+    return grown
+
+
+comparisons = {
+    "=": lambda left, right: left == right,
+    "!=": lambda left, right: left != right,
+    "<": lambda left, right: left < right,
+    ">": lambda left, right: left > right,
+    "<=": lambda left, right: left <= right,
+    ">=": lambda left, right: left >= right,
+}
+
+
+class Dictionary:
+    # Distinct strings of a column and their codes. Codes follow first
+    # appearance and never change, so tails extend a column without
+    # re-encoding it, and each string is held once however long it is.
+    def __init__(self):
+        self.codes = {}
+        self.words = np.empty(16, dtype=object)
+
+    def encode(self, text):
+        code = self.codes.get(text)
+        if code is None:
+            code = len(self.codes)
+            self.words = grow(self.words, code, code + 1)
+            # The word goes in before its code, for readers sizing by codes
+            self.words[code] = text
+            self.codes[text] = code
+        return code
+
+    def matches(self, codes, op, key):
+        # Mask of the codes whose string compares true against `key`.
+        # Positions without a string (code -1) get an arbitrary answer that
+        # the caller masks out.
+        if op in ("=", "!="):
+            return comparisons[op](codes, self.codes.get(key, -2))
+        count = len(self.codes)
+        if not count:
+            return np.zeros(len(codes), dtype=bool)
+        return comparisons[op](self.words[:count], key)[codes]
+
+
+class Column:
+    # Only the first `count` entries of the arrays are filled; the rest is
+    # room for the tails appended as nodes are added
+    __slots__ = ("present", "numeric", "numbers", "codes", "complex", "dictionary", "count")
+    arrays = ("present", "numeric", "numbers", "codes", "complex")
+
+    def __init__(self, present, numeric, numbers, codes, complex, dictionary):
+        self.present = present
+        self.numeric = numeric
+        self.numbers = numbers
+        self.codes = codes
+        self.complex = complex
+        self.dictionary = dictionary
+        self.count = len(present)
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def build(cls, values, dictionary):
+        count = len(values)
+        present = np.zeros(count, dtype=bool)
+        numeric = np.zeros(count, dtype=bool)
+        complex = np.zeros(count, dtype=bool)
+        numbers = np.full(count, np.nan)
+        codes = np.full(count, -1, dtype=np.int64)
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            present[i] = True
+            if isinstance(value, (list, dict)):
+                complex[i] = True
+                continue
+            is_number, key = order_key(value)
+            if is_number:
+                numeric[i] = True
+                numbers[i] = key
+            else:
+                codes[i] = dictionary.encode(key)
+        return cls(present, numeric, numbers, codes, complex, dictionary)
+
+    def extend(self, values):
+        # Appends in place; entries below `count` never move or change, so
+        # slices taken by running scans stay valid
+        tail = Column.build(values, self.dictionary)
+        needed = self.count + len(tail)
+        for field in self.arrays:
+            array = grow(getattr(self, field), self.count, needed)
+            array[self.count:needed] = getattr(tail, field)
+            setattr(self, field, array)
+        self.count = needed
+        return self
+
+    def slice(self, start, stop):
+        stop = min(stop, self.count)
+        return Column(*(getattr(self, field)[start:stop] for field in self.arrays), self.dictionary)
+
+
+class Compare:
+    # `var.prop <op> value` with a constant value; op as in range_index
+    def __init__(self, prop, op, value):
+        self.prop = prop
+        self.op = op
+        self.value = value
+
+    def mask(self, scan):
+        column = scan.column(self.prop)
+        value = scan.constant(self.value)
+        if value is None:
+            none = np.zeros(len(column), dtype=bool)
+            return none, none
+        if isinstance(value, (list, dict)) or column.complex.any():
+            raise NotVectorisable(self.prop)
+        try:
+            is_number, key = order_key(value)
+        except TypeError:
+            raise NotVectorisable(self.prop)
+        compare = comparisons[self.op]
+        if is_number:
+            same_kind = column.numeric
+            true = same_kind & compare(column.numbers, key)
+        else:
+            same_kind = column.present & ~column.numeric
+            true = same_kind & column.dictionary.matches(column.codes, self.op, key)
+        if self.op == "!=":
+            # Values of the other kind are unequal; every other operator is false for them
+            true |= column.present & ~same_kind
+        return true, column.present & ~true
+
+
+class IsNull:
+    def __init__(self, prop, negated):
+        self.prop = prop
+        self.negated = negated
+
+    def mask(self, scan):
+        present = scan.column(self.prop).present
+        return (present, ~present) if self.negated else (~present, present)
+
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+    def mask(self, scan):
+        true, false = self.operand.mask(scan)
+        return false, true
+
+
+class Logical:
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def mask(self, scan):
+        left_true, left_false = self.left.mask(scan)
+        right_true, right_false = self.right.mask(scan)
+        if self.op == "AND":
+            return left_true & right_true, left_false | right_false
+        if self.op == "OR":
+            return left_true | right_true, left_false & right_false
+        return (
+            (left_true & right_false) | (left_false & right_true),
+            (left_true & right_true) | (left_false & right_false)
+        )
+
+
+class _Scan:
+    # The slice of a label's columns that one mask evaluation works on
+    def __init__(self, store, label, start, stop, constant):
+        self.store = store
+        self.label = label
+        self.start = start
+        self.stop = stop
+        self.constant = constant
+
+    def column(self, prop):
+        return self.store.column(self.label, prop).slice(self.start, self.stop)
+
+
+class ColumnStore:
+    # Property columns of one resident graph, per (label, property)
+    def __init__(self, graph):
+        self.graph = graph
+        self.columns = {}
+        # label -> (slot buffer, filled count)
+        self.slots = {}
+        # Readers share the graph, and any of them may extend a column
+        self.lock = threading.Lock()
+
+    def column(self, label, prop):
+        with self.lock:
+            postings = self.graph.label_index.get(label, ())
+            column = self.columns.get((label, prop))
+            done = len(column) if column is not None else 0
+            if done < len(postings):
+                store = self.graph.node_properties
+                values = [store.get(slot, prop) for slot in postings[done:]]
+                if column is None:
+                    column = self.columns[(label, prop)] = Column.build(values, Dictionary())
+                else:
+                    column.extend(values)
+            return column
+
+    def invalidate(self, prop):
+        # Existing nodes got new values for `prop`; its columns are rebuilt on next use
+        with self.lock:
+            for key in [key for key in self.columns if key[1] == prop]:
+                del self.columns[key]
+
+    def label_slots(self, label):
+        with self.lock:
+            postings = self.graph.label_index.get(label, ())
+            slots, done = self.slots.get(label, (None, 0))
+            if slots is None or done < len(postings):
+                # Copied, because the posting array must stay free to grow
+                tail = np.array(postings[done:], dtype=np.int64)
+                slots = tail if slots is None else grow(slots, done, len(postings))
+                slots[done:len(postings)] = tail
+                done = len(postings)
+                self.slots[label] = slots, done
+            return slots[:done]
+
+    def select(self, label, programs, constant, start=0, stop=None):
+        # Slots of the label's nodes in [start, stop) for which every program is true
+        count = len(self.graph.label_index.get(label, ()))
+        stop = count if stop is None else min(stop, count)
+        start = min(start, stop)
+        scan = _Scan(self, label, start, stop, constant)
+        selected = np.ones(stop - start, dtype=bool)
+        for program in programs:
+            selected &= program.mask(scan)[0]
+        return self.label_slots(label)[start:stop][selected].tolist()
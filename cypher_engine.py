@@ -1,409 +1,576 @@
-import re
-import uuid
-import os
-import json
-from graph_storage import GraphStorage
-from graph_entities import Node, Relationship
-
-node_pattern = re.compile(r"CREATE \((\w+):(\w+) \{([^}]+)\}\)")
-match_pattern_with_props = re.compile(r"MATCH \((\w+):(\w+) \{([^}]+)\}\) RETURN \w+")
-match_pattern_simple = re.compile(r"MATCH \((\w+):(\w+)\) RETURN \w+")
-rel_create_pattern = re.compile(
-    r"CREATE \((\w+):(\w+)(?: \{([^}]+)\})?\)"  # left node (3 groups)
-    r"-\[:(\w+)(?: \{([^}]+)\})?\]->"           # relationship type (1 group) + rel props (optional, 1 group)
-    r"\((\w+):(\w+)(?: \{([^}]+)\})?\)"        # right node (3 groups)
-)
-match_relationship_pattern_directed = re.compile(r"MATCH\s+\((\w+):(\w+)\)-\[:(\w+)\]->\((\w+):(\w+)\)\s+RETURN\s+\w+,\s*\w+")
-match_relationship_pattern_bidirectional = re.compile(r"MATCH\s+\((\w+):(\w+)\)<-\[:(\w+)\]-\((\w+):(\w+)\)\s+RETURN\s+\w+,\s*\w+")
-match_relationship_pattern_undirected = re.compile(r"MATCH\s+\((\w+):(\w+)\)-\[:(\w+)\]-\((\w+):(\w+)\)\s+RETURN\s+\w+,\s*\w+")
-match_pattern_with_where = re.compile(
-    r"MATCH\s+\((\w+):(\w+)\)\s+WHERE\s+(\w+)\.(\w+)\s*([=<>!]=?)\s*(\"[^\"]+\"|\d+(?:\.\d+)?)\s+RETURN\s+\w+"
-)
-match_all_pattern = re.compile(r"MATCH\s*\(\w+\)\s*RETURN\s*\w+")
-
-
-def load_indexes(db_path):
-    idx_file = os.path.join(db_path, "indexes.json")
-    if os.path.exists(idx_file):
-        with open(idx_file, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_indexes(db_path, indexes):
-    idx_file = os.path.join(db_path, "indexes.json")
-    with open(idx_file, "w") as f:
-        json.dump(indexes, f, indent=2)
-
-def build_index_for_label_prop(db_path, label, prop):
-    storage = GraphStorage(db_path)
-    nodes = storage.load_nodes()
-    index = {}
-    for node in nodes:
-        if label in node.labels:
-            value = node.properties.get(prop)
-            if value is not None:
-                index.setdefault(str(value), []).append(node.id)
-    return index
-
-def create_index(db_path, label, prop):
-    index_path = os.path.join(db_path, "indexes.json")
-    nodes_path = os.path.join(db_path, "nodes.json")
-
-    # Load existing indexes or start fresh
-    if os.path.exists(index_path):
-        with open(index_path) as f:
-            indexes = json.load(f)
-    else:
-        indexes = {}
-
-    # Load nodes
-    if os.path.exists(nodes_path):
-        with open(nodes_path) as f:
-            nodes = json.load(f)
-    else:
-        nodes = []
-
-    # Initialize nested index structure
-    if label not in indexes:
-        indexes[label] = {}
-    if prop not in indexes[label]:
-        indexes[label][prop] = {}
-
-    # Populate the index with property values
-    for node in nodes:
-        if label in node.get("labels", []):
-            props = node.get("properties", {})
-            node_id = node.get("id")
-            value = props.get(prop)
-
-            if value is not None:
-                value_str = str(value)
-                indexes[label][prop].setdefault(value_str, []).append(node_id)
-
-    # Write back the updated index
-    with open(index_path, "w") as f:
-        json.dump(indexes, f, indent=2)
-
-    print(f"Index created for :{label} on property '{prop}'")
-
-def find_nodes_with_index(db_path, label, prop, value):
-    indexes_path = os.path.join(db_path, "indexes.json")
-    if not os.path.exists(indexes_path):
-        return []
-
-    with open(indexes_path, "r") as f:
-        indexes = json.load(f)
-
-    label_indexes = indexes.get(label, {})
-
-    # Ensure label_indexes is a dict
-    if not isinstance(label_indexes, dict):
-        print(f"Invalid index format for label '{label}': Expected dict but got {type(label_indexes)}")
-        return []
-
-    prop_index = label_indexes.get(prop, {})
-
-    if not isinstance(prop_index, dict):
-        print(f"Invalid property index for prop '{prop}': Expected dict but got {type(prop_index)}")
-        return []
-
-    return prop_index.get(str(value), [])
-
-
-def parse_properties(prop_str):
-    props = {}
-    for item in prop_str.split(','):
-        key, value = item.split(':', 1)
-        key = key.strip()
-        value = value.strip().strip('"').strip("'")  # Remove both " and '
-        # Try to convert to int, float, or leave as string
-        if value.lower() == "true":
-            value = True
-        elif value.lower() == "false":
-            value = False
-        else:
-            try:
-                if '.' in value:
-                    value = float(value)
-                else:
-                    value = int(value)
-            except ValueError:
-                pass  # leave as string
-        props[key] = value
-    return props
-
-
-def handle_create(query, db_path):
-    storage = GraphStorage(db_path)
-    nodes = storage.load_nodes()
-
-    matches = node_pattern.findall(query)
-    new_nodes = []
-
-    for var, label, prop_str in matches:
-        props = parse_properties(prop_str)
-        existing_node = find_node(nodes, label, props)
-        if existing_node:
-            continue
-        node_id = str(uuid.uuid4())
-        new_node = Node(id=node_id, labels=[label], properties=props)
-        nodes.append(new_node)
-        new_nodes.append(new_node)
-
-    storage.save_nodes(nodes)
-
-    return {
-        "message": "Node(s) created",
-        "nodes": [n.to_dict() for n in new_nodes],
-        "relationships": []
-    }
-
-
-def handle_match(query, db_path):
-    storage = GraphStorage(db_path)
-    nodes = storage.load_nodes()
-    rels = storage.load_relationships()
-    matched_nodes = []
-    matched_rels = []
-
-    # MATCH with WHERE clause
-    match = match_pattern_with_where.match(query)
-    if match:
-        var, label, where_var, prop, operator, value = match.groups()
-        if var != where_var:
-            return {"error": "Variable mismatch in WHERE clause"}
-
-        for node in nodes:
-            if label in node.labels:
-                node_val = node.properties.get(prop)
-                if node_val is None:
-                    continue
-
-                # Try to compare as float if possible
-                try:
-                    node_val = float(node_val)
-                    value = float(value)
-                except ValueError:
-                    node_val = str(node_val)
-                    value = str(value)
-
-                # Safe evaluation
-                try:
-                    if operator == '=':
-                        cond = node_val == value
-                    elif operator == '!=':
-                        cond = node_val != value
-                    elif operator == '>':
-                        cond = node_val > value
-                    elif operator == '<':
-                        cond = node_val < value
-                    elif operator == '>=':
-                        cond = node_val >= value
-                    elif operator == '<=':
-                        cond = node_val <= value
-                    else:
-                        return {"error": "Unsupported operator in WHERE clause"}
-                except:
-                    cond = False
-
-                if cond:
-                    matched_nodes.append(node)
-
-        return {
-            "message": f"{len(matched_nodes)} nodes matched with WHERE",
-            "nodes": [n.to_dict() for n in matched_nodes],
-            "relationships": []
-        }
-    
-    # Directed relationship pattern
-    match = match_relationship_pattern_directed.match(query)
-    if match:
-        var1, label1, rel_type, var2, label2 = match.groups()
-        node_dict = {node.id: node for node in nodes}
-
-        for rel in rels:
-            if rel.rel_type != rel_type:
-                continue
-            start_node = node_dict.get(rel.start_node)
-            end_node = node_dict.get(rel.end_node)
-            if start_node and end_node:
-                if label1 in start_node.labels and label2 in end_node.labels:
-                    matched_nodes.extend([start_node, end_node])
-                    matched_rels.append(rel)
-
-        return {
-            "message": f"{len(matched_rels)} directed relationship(s) matched",
-            "nodes": [n.to_dict() for n in {n.id: n for n in matched_nodes}.values()],
-            "relationships": [r.to_dict() for r in matched_rels]
-        }
-
-    # Bidirectional relationship pattern
-    match = match_relationship_pattern_bidirectional.match(query)
-    if match:
-        var1, label1, rel_type, var2, label2 = match.groups()
-        node_dict = {node.id: node for node in nodes}
-
-        for rel in rels:
-            if rel.rel_type != rel_type:
-                continue
-            start_node = node_dict.get(rel.start_node)
-            end_node = node_dict.get(rel.end_node)
-            if start_node and end_node:
-                if label2 in start_node.labels and label1 in end_node.labels:
-                    matched_nodes.extend([start_node, end_node])
-                    matched_rels.append(rel)
-
-        return {
-            "message": f"{len(matched_rels)} bidirectional relationship(s) matched",
-            "nodes": [n.to_dict() for n in {n.id: n for n in matched_nodes}.values()],
-            "relationships": [r.to_dict() for r in matched_rels]
-        }
-
-    # Undirected relationship pattern
-    match = match_relationship_pattern_undirected.match(query)
-    if match:
-        var1, label1, rel_type, var2, label2 = match.groups()
-        node_dict = {node.id: node for node in nodes}
-
-        for rel in rels:
-            if rel.rel_type != rel_type:
-                continue
-            start_node = node_dict.get(rel.start_node)
-            end_node = node_dict.get(rel.end_node)
-            if start_node and end_node:
-                # Check both directions
-                cond1 = label1 in start_node.labels and label2 in end_node.labels
-                cond2 = label2 in start_node.labels and label1 in end_node.labels
-                if cond1 or cond2:
-                    matched_nodes.extend([start_node, end_node])
-                    matched_rels.append(rel)
-
-        return {
-            "message": f"{len(matched_rels)} undirected relationship(s) matched",
-            "nodes": [n.to_dict() for n in {n.id: n for n in matched_nodes}.values()],
-            "relationships": [r.to_dict() for r in matched_rels]
-        }
-
-    # MATCH with properties
-    match = match_pattern_with_props.match(query)
-    if match:
-        var, label, prop_str = match.groups()
-        props = parse_properties(prop_str)
-
-        # Check if single property (for index usage)
-        if len(props) == 1:
-            prop_key, prop_val = next(iter(props.items()))
-            # Try to find node IDs using index
-            node_ids = find_nodes_with_index(db_path, label, prop_key, prop_val)
-
-            if node_ids:
-                # Load all nodes once and filter by IDs
-                nodes = storage.load_nodes()
-                matched_nodes = [node for node in nodes if node.id in node_ids]
-            else:
-                # Index not found or no matches, fallback to scan all nodes
-                matched_nodes = [node for node in nodes if label in node.labels and all(str(node.properties.get(k)) == str(v) for k, v in props.items())]
-        else:
-            # Multiple props, fallback to scan all nodes (no composite indexes yet)
-            matched_nodes = [node for node in nodes if label in node.labels and all(str(node.properties.get(k)) == str(v) for k, v in props.items())]
-
-        return {
-            "message": f"{len(matched_nodes)} nodes matched with properties",
-            "nodes": [n.to_dict() for n in matched_nodes],
-            "relationships": []
-        }
-    
-    elif match_all_pattern.match(query):
-        return {
-            "message": f"{len(nodes)} nodes and {len(rels)} relationships returned",
-            "nodes": [n.to_dict() for n in nodes],
-            "relationships": [r.to_dict() for r in rels]
-        }
-
-
-    # MATCH without properties
-    else:
-        match = match_pattern_simple.match(query)
-        if match:
-            var, label = match.groups()
-            for node in nodes:
-                if label in node.labels:
-                    matched_nodes.append(node)
-        else:
-            return {"error": "Invalid MATCH syntax"}
-
-    return {
-        "message": f"{len(matched_nodes)} nodes matched",
-        "nodes": [n.to_dict() for n in matched_nodes],
-        "relationships": []
-    }
-
-    
-def find_node(nodes, label, props):
-    for node in nodes:
-        if label in node.labels and all(str(node.properties.get(k)) == str(v) for k,v in props.items()):
-            return node
-    return None
-
-def handle_create_with_relationship(query, db_path):
-    match = rel_create_pattern.match(query)
-    if not match:
-        return {"error": "Invalid CREATE with relationship syntax"}
-
-    (
-        var1, label1, props1,
-        rel_type, rel_props,
-        var2, label2, props2
-    ) = match.groups()
-
-    props1 = parse_properties(props1) if props1 else {}
-    props2 = parse_properties(props2) if props2 else {}
-    rel_props = parse_properties(rel_props) if rel_props else {}
-
-    storage = GraphStorage(db_path)
-    nodes = storage.load_nodes()
-    rels = storage.load_relationships()
-
-    # Find or create left node
-    node1 = find_node(nodes, label1, props1)
-    if not node1:
-        node1 = Node(id=str(uuid.uuid4()), labels=[label1], properties=props1)
-        nodes.append(node1)
-
-    # Find or create right node
-    node2 = find_node(nodes, label2, props2)
-    if not node2:
-        node2 = Node(id=str(uuid.uuid4()), labels=[label2], properties=props2)
-        nodes.append(node2)
-
-    # Create relationship
-    relationship = Relationship(
-        id=str(uuid.uuid4()),
-        start_node=node1.id,
-        end_node=node2.id,
-        rel_type=rel_type,
-        properties=rel_props
-    )
-    rels.append(relationship)
-
-    storage.save_nodes(nodes)
-    storage.save_relationships(rels)
-
-    return {
-        "message": "Nodes and relationship created",
-        "nodes": [node1.to_dict(), node2.to_dict()],
-        "relationships": [relationship.to_dict()]
-    }
-
-def execute_query(query, db_path, use_index=True):
-    query = query.strip()
-    if query.startswith("CREATE"):
-        if rel_create_pattern.match(query):
-            return handle_create_with_relationship(query, db_path)
-        return handle_create(query, db_path)
-    if query.strip().upper().startswith("CREATE INDEX"):
-        return create_index(query, db_path)
-    elif query.startswith("MATCH"):
-        return handle_match(query, db_path)
-    return {"error": "Unsupported query type"}
-
+import re
+import uuid
+import os
+import json
+from graph_cache import get_graph, graph_resource
+from mvcc import TransactionError
+from lock_manager import lock_manager, LockError, SHARED, EXCLUSIVE
+from graph_entities import Node, Relationship, MISSING
+from cypher_parser import CypherSyntaxError, parse_expression
+from query_planner import (
+    run_query, open_cursor as open_plan_cursor, explain_query, profile_query, plan_cache, QueryError,
+    ExecutionContext, evaluate
+)
+from graph_algorithms import find_procedure, procedure_config, compute, write_back
+
+node_pattern = re.compile(r"CREATE \((\w+):(\w+) \{([^}]+)\}\)")
+rel_create_pattern = re.compile(
+    r"CREATE \((\w+):(\w+)(?: \{([^}]+)\})?\)"  # left node (3 groups)
+    r"-\[:(\w+)(?: \{([^}]+)\})?\]->"           # relationship type (1 group) + rel props (optional, 1 group)
+    r"\((\w+):(\w+)(?: \{([^}]+)\})?\)"        # right node (3 groups)
+)
+merge_node_pattern = re.compile(r"MERGE \((\w+):(\w+)(?: \{([^}]+)\})?\)")
+rel_merge_pattern = re.compile(
+    r"MERGE \((\w+):(\w+)(?: \{([^}]+)\})?\)"
+    r"-\[:(\w+)(?: \{([^}]+)\})?\]->"
+    r"\((\w+):(\w+)(?: \{([^}]+)\})?\)\s*$"
+)
+create_index_pattern = re.compile(
+    r"CREATE\s+(?:(RANGE|HASH)\s+)?INDEX(?:\s+\w+)?(?:\s+IF\s+NOT\s+EXISTS)?"
+    r"\s+FOR\s+\((\w+):(\w+)\)\s+ON\s+\((\w+\.\w+(?:\s*,\s*\w+\.\w+)*)\)\s*$",
+    re.IGNORECASE
+)
+create_index_legacy_pattern = re.compile(
+    r"CREATE\s+(?:(RANGE|HASH)\s+)?INDEX\s+ON\s+:(\w+)\((\w+(?:\s*,\s*\w+)*)\)\s*$",
+    re.IGNORECASE
+)
+unwind_pattern = re.compile(r"UNWIND\s+(.+?)\s+AS\s+(\w+)\s+(\w.*)$", re.IGNORECASE | re.DOTALL)
+binding_pattern = re.compile(r"(\w+)((?:\.\w+)*)")
+call_pattern = re.compile(r"CALL\s+(\w+(?:\.\w+)+)\s*\((.*)\)(?:\s+YIELD\s+(.+?))?\s*$", re.IGNORECASE | re.DOTALL)
+profile_pattern = re.compile(r"(EXPLAIN|PROFILE)\s+(.*)$", re.IGNORECASE | re.DOTALL)
+yield_item_pattern = re.compile(r"\s*(\w+)(?:\s+AS\s+(\w+))?\s*$", re.IGNORECASE)
+
+
+def load_indexes(db_path):
+    idx_file = os.path.join(db_path, "indexes.json")
+    if os.path.exists(idx_file):
+        with open(idx_file, "r") as f:
+            return json.load(f)
+    return {}
+
+def save_indexes(db_path, indexes):
+    idx_file = os.path.join(db_path, "indexes.json")
+    with open(idx_file, "w") as f:
+        json.dump(indexes, f, indent=2)
+
+def build_index_for_label_prop(db_path, label, prop):
+    index = {}
+    for node in get_graph(db_path).nodes_with_label(label):
+        value = node.get_property(prop)
+        if value is not None:
+            index.setdefault(str(value), []).append(node.id)
+    return index
+
+def create_index(db_path, label, prop, index_type="hash"):
+    # Built from the resident graph and then kept up to date by every CREATE.
+    # "hash" serves equality lookups, "range" serves <, >, <=, >= in WHERE.
+    # A list of properties creates a composite index over the value tuple.
+    if index_type not in ("hash", "range"):
+        raise ValueError(f"Unknown index type: {index_type}")
+    if isinstance(prop, (list, tuple)) and len(prop) > 1 and index_type != "hash":
+        raise ValueError("Composite indexes only support equality lookups")
+    get_graph(db_path).create_index(label, prop, index_type)
+
+    if isinstance(prop, (list, tuple)):
+        prop = ", ".join(prop)
+    print(f"Index created for :{label} on property '{prop}' ({index_type})")
+
+def handle_create_index(query, db_path):
+    match = create_index_pattern.match(query)
+    if match:
+        index_type, var, label, prop_list = match.groups()
+        props = []
+        for item in prop_list.split(','):
+            prop_var, prop = item.strip().split('.')
+            if var != prop_var:
+                return {"error": "Variable mismatch in CREATE INDEX"}
+            props.append(prop)
+    else:
+        match = create_index_legacy_pattern.match(query)
+        if not match:
+            return {"error": "Invalid CREATE INDEX syntax"}
+        index_type, label, prop_list = match.groups()
+        props = [prop.strip() for prop in prop_list.split(',')]
+
+    index_type = (index_type or "hash").lower()
+    if len(props) > 1:
+        if index_type != "hash":
+            return {"error": "Composite indexes only support equality lookups"}
+        index_type = "composite"
+        create_index(db_path, label, props)
+    else:
+        create_index(db_path, label, props[0], index_type)
+    return {
+        "message": f"{index_type.capitalize()} index created for :{label}({', '.join(props)})",
+        "nodes": [],
+        "relationships": []
+    }
+
+def find_nodes_with_index(db_path, label, prop, value):
+    graph = get_graph(db_path)
+    if not graph.has_index(label, prop):
+        return []
+    return graph.index_lookup(label, prop, value)
+
+def verify_indexes(db_path):
+    # Returns a list of inconsistencies between the indexes and the nodes (empty when consistent)
+    return get_graph(db_path).verify_indexes()
+
+
+def resolve_value(text, bindings, params):
+    # $name reads a query parameter, row.key a variable bound by UNWIND;
+    # returns MISSING when the text is neither, so it is parsed as a literal
+    if text.startswith('$'):
+        name = text[1:]
+        if params is None or name not in params:
+            raise QueryError(f"Expected parameter ${name}")
+        return params[name]
+    match = binding_pattern.fullmatch(text)
+    if bindings and match and match.group(1) in bindings:
+        value = bindings[match.group(1)]
+        for key in match.group(2).split('.')[1:]:
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+    return MISSING
+
+
+def parse_properties(prop_str, bindings=None, params=None):
+    props = {}
+    for item in prop_str.split(','):
+        key, value = item.split(':', 1)
+        key = key.strip()
+        resolved = resolve_value(value.strip(), bindings, params)
+        if resolved is not MISSING:
+            # A null value leaves the property out, as in Cypher
+            if resolved is not None:
+                props[key] = resolved
+            continue
+        value = value.strip().strip('"').strip("'")  # Remove both " and '
+        # Try to convert to int, float, or leave as string
+        if value.lower() == "true":
+            value = True
+        elif value.lower() == "false":
+            value = False
+        else:
+            try:
+                if '.' in value:
+                    value = float(value)
+                else:
+                    value = int(value)
+            except ValueError:
+                pass  # leave as string
+        props[key] = value
+    return props
+
+
+def handle_create(query, db_path, bindings=None, params=None, transaction=None):
+    graph = graph_for(db_path, transaction)
+
+    matches = node_pattern.findall(query)
+    new_nodes = []
+
+    with statement_lock(db_path, EXCLUSIVE, transaction):
+        for var, label, prop_str in matches:
+            props = parse_properties(prop_str, bindings, params)
+            new_node, created = merge_node(graph, label, props)
+            if created:
+                new_nodes.append(new_node)
+
+        graph.commit()
+
+    return {
+        "message": "Node(s) created",
+        "nodes": [n.to_dict() for n in new_nodes],
+        "relationships": []
+    }
+
+
+def handle_match(query, db_path, params=None, transaction=None, limits=None, use_index=True):
+    # Parsed into an AST and run through the planner (label scans, index
+    # seeks, adjacency expansions and filters chosen by estimated cardinality).
+    # Compiled plans are cached per query shape; $name values come from params.
+    # limits ({"max_depth": ..., "max_expansions": ...}) bound path traversals.
+    # With use_index=False the planner only uses scans.
+    graph = graph_for(db_path, transaction)
+    try:
+        with statement_lock(db_path, SHARED, transaction):
+            return run_query(query, graph, params, limits, use_index)
+    except (CypherSyntaxError, QueryError) as e:
+        return {"error": str(e)}
+
+
+def handle_profile(mode, query, db_path, params=None, transaction=None, limits=None, use_index=True):
+    # EXPLAIN MATCH ... returns the chosen plan without running it; PROFILE
+    # MATCH ... runs it and reports rows, db hits, time and index per operator
+    mode = mode.upper()
+    if query[:5].upper() != "MATCH":
+        return {"error": f"{mode} only supports MATCH queries"}
+    graph = graph_for(db_path, transaction)
+    try:
+        with statement_lock(db_path, SHARED, transaction):
+            if mode == "EXPLAIN":
+                return explain_query(query, graph, params, use_index)
+            return profile_query(query, graph, params, limits, use_index)
+    except (CypherSyntaxError, QueryError) as e:
+        return {"error": str(e)}
+
+
+def find_node(graph, label, props):
+    # Node with this label and exactly these properties, via the identity index
+    return graph.find_identical(label, props)
+
+def merge_node(graph, label, props):
+    # Find-or-create in O(1); returns (node, created)
+    node = find_node(graph, label, props)
+    if node:
+        return node, False
+    node = Node(id=str(uuid.uuid4()), labels=[label], properties=props)
+    graph.add_node(node)
+    return node, True
+
+def handle_merge(query, db_path, bindings=None, params=None, transaction=None):
+    match = rel_merge_pattern.match(query)
+    if match:
+        return handle_merge_with_relationship(match, db_path, bindings, params, transaction)
+
+    matches = merge_node_pattern.findall(query)
+    if not matches:
+        return {"error": "Invalid MERGE syntax"}
+
+    graph = graph_for(db_path, transaction)
+    merged = []
+    created_count = 0
+
+    with statement_lock(db_path, EXCLUSIVE, transaction):
+        for var, label, prop_str in matches:
+            props = parse_properties(prop_str, bindings, params) if prop_str else {}
+            node, created = merge_node(graph, label, props)
+            created_count += created
+            merged.append(node)
+
+        graph.commit()
+
+    return {
+        "message": f"{len(merged)} node(s) merged, {created_count} created",
+        "nodes": [n.to_dict() for n in merged],
+        "relationships": []
+    }
+
+def handle_merge_with_relationship(match, db_path, bindings=None, params=None, transaction=None):
+    (
+        var1, label1, props1,
+        rel_type, rel_props,
+        var2, label2, props2
+    ) = match.groups()
+
+    props1 = parse_properties(props1, bindings, params) if props1 else {}
+    props2 = parse_properties(props2, bindings, params) if props2 else {}
+    rel_props = parse_properties(rel_props, bindings, params) if rel_props else {}
+
+    graph = graph_for(db_path, transaction)
+
+    with statement_lock(db_path, EXCLUSIVE, transaction):
+        node1, created1 = merge_node(graph, label1, props1)
+        node2, created2 = merge_node(graph, label2, props2)
+
+        # Reuse an existing relationship between the two nodes, found through adjacency
+        relationship = None
+        for rel in graph.outgoing(node1.id, rel_type):
+            if rel.end_node == node2.id and all(str(rel.properties.get(k)) == str(v) for k, v in rel_props.items()):
+                relationship = rel
+                break
+        created_rel = relationship is None
+        if created_rel:
+            relationship = Relationship(
+                id=str(uuid.uuid4()),
+                start_node=node1.id,
+                end_node=node2.id,
+                rel_type=rel_type,
+                properties=rel_props
+            )
+            graph.add_relationship(relationship)
+
+        graph.commit()
+
+    return {
+        "message": f"Relationship merged, {created1 + created2} node(s) and {int(created_rel)} relationship(s) created",
+        "nodes": [node1.to_dict(), node2.to_dict()],
+        "relationships": [relationship.to_dict()]
+    }
+
+def handle_create_with_relationship(query, db_path, bindings=None, params=None, transaction=None):
+    match = rel_create_pattern.match(query)
+    if not match:
+        return {"error": "Invalid CREATE with relationship syntax"}
+
+    (
+        var1, label1, props1,
+        rel_type, rel_props,
+        var2, label2, props2
+    ) = match.groups()
+
+    props1 = parse_properties(props1, bindings, params) if props1 else {}
+    props2 = parse_properties(props2, bindings, params) if props2 else {}
+    rel_props = parse_properties(rel_props, bindings, params) if rel_props else {}
+
+    graph = graph_for(db_path, transaction)
+
+    with statement_lock(db_path, EXCLUSIVE, transaction):
+        # Find or create left and right nodes
+        node1, _ = merge_node(graph, label1, props1)
+        node2, _ = merge_node(graph, label2, props2)
+
+        # Create relationship
+        relationship = Relationship(
+            id=str(uuid.uuid4()),
+            start_node=node1.id,
+            end_node=node2.id,
+            rel_type=rel_type,
+            properties=rel_props
+        )
+        graph.add_relationship(relationship)
+
+        graph.commit()
+
+    return {
+        "message": "Nodes and relationship created",
+        "nodes": [node1.to_dict(), node2.to_dict()],
+        "relationships": [relationship.to_dict()]
+    }
+
+def graph_for(db_path, transaction=None):
+    # Inside a transaction, statements see its snapshot and buffer their writes
+    return transaction.view if transaction is not None else get_graph(db_path)
+
+
+def statement_lock(db_path, mode, transaction=None):
+    # Readers share the database, writers have it to themselves. Inside a
+    # transaction writes only touch its write set, so reading is enough.
+    if transaction is not None:
+        mode = SHARED
+    return lock_manager.locked(graph_resource(db_path), mode)
+
+
+def statement_mode(statement):
+    statement = statement.lstrip()
+    profiled = profile_pattern.match(statement)
+    if profiled:
+        statement = profiled.group(2)
+    if statement[:5].upper() == "MATCH":
+        return SHARED
+    # Procedures only write when asked to store their results
+    if re.match(r"CALL\b", statement, re.IGNORECASE) and "writeProperty" not in statement:
+        return SHARED
+    return EXCLUSIVE
+
+
+def execute_query(query, db_path, use_index=True, params=None, transaction=None, limits=None):
+    # Text with several ';'-separated statements runs as one script
+    statements = split_statements(query)
+    if len(statements) > 1:
+        return execute_script(statements, db_path, params, transaction, limits, use_index)
+    return execute_statement(query, db_path, params, transaction=transaction, limits=limits, use_index=use_index)
+
+
+def execute_statement(query, db_path, params=None, bindings=None, transaction=None, limits=None, use_index=True):
+    query = query.strip()
+    try:
+        if re.match(r"CREATE\s+(?:\w+\s+)?INDEX\b", query, re.IGNORECASE):
+            if transaction is not None:
+                return {"error": "CREATE INDEX cannot run inside a transaction"}
+            return handle_create_index(query, db_path)
+        if query.startswith("CREATE"):
+            if rel_create_pattern.match(query):
+                return handle_create_with_relationship(query, db_path, bindings, params, transaction)
+            return handle_create(query, db_path, bindings, params, transaction)
+        elif query.startswith("MERGE"):
+            return handle_merge(query, db_path, bindings, params, transaction)
+        elif query[:6].upper() == "UNWIND":
+            return handle_unwind(query, db_path, params, transaction)
+        elif query[:5].upper() == "MATCH":
+            return handle_match(query, db_path, params, transaction, limits, use_index)
+        elif re.match(r"CALL\b", query, re.IGNORECASE):
+            return handle_call(query, db_path, params, transaction)
+        elif profile_pattern.match(query):
+            mode, body = profile_pattern.match(query).groups()
+            return handle_profile(mode, body.strip(), db_path, params, transaction, limits, use_index)
+    except (CypherSyntaxError, QueryError) as e:
+        return {"error": str(e)}
+    except TransactionError as e:
+        return {"error": f"Transaction error: {e}"}
+    except LockError as e:
+        return {"error": f"Lock error: {e}"}
+    return {"error": "Unsupported query type"}
+
+
+def split_statements(script):
+    # Split on ';' outside string literals; empty statements are dropped
+    statements = []
+    current = []
+    quote = None
+    escaped = False
+    for char in script:
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char == ';':
+            statements.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    statements.append(''.join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def merge_results(results):
+    # Nodes and relationships of several results, each reported once
+    nodes = {}
+    rels = {}
+    for result in results:
+        for node in result.get("nodes", ()):
+            nodes.setdefault(node["id"], node)
+        for rel in result.get("relationships", ()):
+            rels.setdefault(rel["id"], rel)
+    return list(nodes.values()), list(rels.values())
+
+
+def execute_script(statements, db_path, params=None, transaction=None, limits=None, use_index=True):
+    # All statements run against the resident graph under one lock, and
+    # their writes are logged with a single commit at the end. A failing
+    # statement stops the script; the ones before it stay applied.
+    # The lock is taken up front in the strongest mode any statement needs
+    # and held to the end (conservative two-phase locking).
+    if isinstance(statements, str):
+        statements = split_statements(statements)
+    mode = EXCLUSIVE if EXCLUSIVE in map(statement_mode, statements) else SHARED
+    try:
+        with statement_lock(db_path, mode, transaction):
+            return run_script(statements, db_path, params, transaction, limits, use_index)
+    except LockError as e:
+        return {"error": f"Lock error: {e}"}
+
+
+def run_script(statements, db_path, params, transaction, limits=None, use_index=True):
+    graph = graph_for(db_path, transaction)
+    results = []
+    with graph.batch():
+        for number, statement in enumerate(statements, 1):
+            result = execute_statement(
+                statement, db_path, params, transaction=transaction, limits=limits, use_index=use_index
+            )
+            if "error" in result:
+                return {"error": f"Statement {number}: {result['error']}", "results": results}
+            results.append(result)
+    nodes, rels = merge_results(results)
+    return {
+        "message": f"{len(results)} statement(s) executed",
+        "nodes": nodes,
+        "relationships": rels,
+        "results": results
+    }
+
+
+def handle_unwind(query, db_path, params=None, transaction=None):
+    # UNWIND <list> AS row CREATE/MERGE ... runs the statement once per
+    # element, with row.key / row usable as property values, and commits once
+    match = unwind_pattern.match(query)
+    if not match:
+        return {"error": "Invalid UNWIND syntax"}
+    list_text, var, body = match.groups()
+    if not re.match(r"(CREATE|MERGE)\b", body):
+        return {"error": "UNWIND only supports CREATE and MERGE statements"}
+
+    graph = graph_for(db_path, transaction)
+    values = evaluate(parse_expression(list_text), {}, ExecutionContext(graph, params))
+    if values is None:
+        values = []
+    if not isinstance(values, list):
+        return {"error": f"UNWIND expects a list, got {values!r}"}
+
+    results = []
+    with statement_lock(db_path, EXCLUSIVE, transaction), graph.batch():
+        for value in values:
+            result = execute_statement(body, db_path, params, {var: value}, transaction)
+            if "error" in result:
+                return {"error": f"UNWIND row {len(results) + 1}: {result['error']}"}
+            results.append(result)
+    nodes, rels = merge_results(results)
+    return {
+        "message": f"{len(results)} row(s) processed",
+        "nodes": nodes,
+        "relationships": rels
+    }
+
+
+def handle_call(query, db_path, params=None, transaction=None):
+    # CALL algo.<name>({settings}) [YIELD column [AS alias], ...] runs a graph
+    # algorithm over a CSR projection of the database (see graph_algorithms).
+    # It returns one row per node, or with writeProperty stores the values on
+    # the nodes and returns a single summary row.
+    match = call_pattern.match(query)
+    if not match:
+        return {"error": "Invalid CALL syntax"}
+    name, config_text, yield_text = match.groups()
+    procedure = find_procedure(name)
+    graph = graph_for(db_path, transaction)
+    config = evaluate(parse_expression(config_text), {}, ExecutionContext(graph, params)) if config_text.strip() else None
+    settings = procedure_config(procedure, config)
+    key = settings["writeProperty"]
+    if key is not None and transaction is not None:
+        return {"error": "CALL with writeProperty cannot run inside a transaction"}
+
+    # The algorithm only reads, so other readers are not held up while it runs
+    with statement_lock(db_path, SHARED, transaction):
+        generation = graph.generation
+        csr, values, summary = compute(procedure, graph, settings)
+    if key is None:
+        available = {"node": csr.nodes, procedure.column: values.tolist()}
+    else:
+        with statement_lock(db_path, EXCLUSIVE):
+            if graph.generation != generation:
+                return {"error": "The database was reloaded while the procedure ran; run it again"}
+            summary["writeMillis"] = write_back(graph, csr, values, key)
+        summary["nodePropertiesWritten"] = csr.node_count
+        available = {column: [value] for column, value in summary.items()}
+
+    columns = []
+    for item in yield_text.split(",") if yield_text else available:
+        item_match = yield_item_pattern.match(item)
+        if not item_match or item_match.group(1) not in available:
+            return {"error": f"{procedure.name} yields {', '.join(available)}; cannot YIELD {item.strip()!r}"}
+        columns.append((item_match.group(1), item_match.group(2) or item_match.group(1)))
+    nodes = []
+    if any(column == "node" for column, _ in columns):
+        # Shared by the rows and the graph view
+        nodes = available["node"] = [node.to_dict() for node in csr.nodes]
+    rows = [list(row) for row in zip(*(available[column] for column, _ in columns))]
+    if key is None:
+        message = f"{len(rows)} row(s) from {procedure.name}"
+    else:
+        message = f"{procedure.name} wrote {key} on {csr.node_count} node(s)"
+    return {
+        "message": message,
+        "nodes": nodes,
+        "relationships": [],
+        "columns": [alias for _, alias in columns],
+        "rows": rows
+    }
+
+
+def open_cursor(query, db_path, params=None, transaction=None, limits=None, use_index=True):
+    # Streaming alternative to execute_query for MATCH: call fetch(n) on the
+    # returned cursor to pull the next batch of rows as {column: value} dicts
+    graph = graph_for(db_path, transaction)
+    return open_plan_cursor(query.strip(), graph, params, limits, use_index)
+
+
+def plan_cache_stats():
+    # Hit/miss/eviction counters of the compiled plan cache, for tuning its capacity
+    return plan_cache.stats()
+
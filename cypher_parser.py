@@ -0,0 +1,596 @@
+import re
+
+
+class CypherSyntaxError(ValueError):
+    pass
+
+
+token_pattern = re.compile(r"""
+    (?P<space>\s+|//[^\n]*)
+  | (?P<number>\d+\.\d+(?:[eE][+-]?\d+)?|\d+(?:[eE][+-]?\d+)?)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<name>[A-Za-z_][A-Za-z_0-9]*|`[^`]+`)
+  | (?P<param>\$[A-Za-z_0-9]+)
+  | (?P<op><>|!=|<=|>=|->|<-|\.\.|[-+*/%=<>(){}\[\]:,.|;])
+""", re.VERBOSE)
+
+string_escapes = {"n": "\n", "t": "\t", "r": "\r", "\\": "\\", "'": "'", '"': '"'}
+
+comparison_ops = {"=", "<>", "!=", "<", ">", "<=", ">="}
+
+
+class Token:
+    def __init__(self, kind, value, pos):
+        self.kind = kind
+        self.value = value
+        self.pos = pos
+
+    def is_keyword(self, *words):
+        return self.kind == "name" and self.value.upper() in words
+
+    def __repr__(self):
+        return f"Token({self.kind}, {self.value!r})"
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = token_pattern.match(text, pos)
+        if not match:
+            raise CypherSyntaxError(f"Unexpected character {text[pos]!r} at position {pos}")
+        kind = match.lastgroup
+        value = match.group()
+        if kind == "string":
+            value = re.sub(r"\\(.)", lambda m: string_escapes.get(m.group(1), m.group(1)), value[1:-1])
+        elif kind == "number":
+            value = float(value) if any(c in value for c in ".eE") else int(value)
+        elif kind == "name" and value.startswith("`"):
+            value = value[1:-1]
+        if kind != "space":
+            tokens.append(Token(kind, value, match.start()))
+        pos = match.end()
+    tokens.append(Token("end", None, len(text)))
+    return tokens
+
+
+# ---- AST ----
+
+class Query:
+    def __init__(self, clauses):
+        self.clauses = clauses
+
+
+class MatchClause:
+    def __init__(self, patterns, where=None):
+        self.patterns = patterns
+        self.where = where
+
+
+class ReturnClause:
+    def __init__(self, items, distinct=False, skip=None, limit=None, order_by=None):
+        self.items = items
+        self.distinct = distinct
+        self.skip = skip
+        self.limit = limit
+        self.order_by = order_by or []
+
+
+class ReturnItem:
+    def __init__(self, expr, alias, text):
+        self.expr = expr
+        self.alias = alias
+        self.text = text
+
+    @property
+    def name(self):
+        return self.alias or self.text
+
+
+class SortItem:
+    def __init__(self, expr, descending=False):
+        self.expr = expr
+        self.descending = descending
+
+
+class NodePattern:
+    def __init__(self, var, labels, props):
+        self.var = var
+        self.labels = labels
+        self.props = props
+
+
+class RelPattern:
+    def __init__(self, var, types, props, direction, min_hops=1, max_hops=1, variable_length=False):
+        self.var = var
+        self.types = types
+        self.props = props
+        self.direction = direction  # "out", "in" or "both"
+        # -[*min..max]-: max_hops is None when the upper bound is left open
+        self.min_hops = min_hops
+        self.max_hops = max_hops
+        self.variable_length = variable_length
+
+
+class PathPattern:
+    # Alternating chain: nodes[i] -rels[i]- nodes[i + 1]. `var` names the
+    # whole path (p = ...); `shortest` is "one" for shortestPath(...) and
+    # "all" for allShortestPaths(...)
+    def __init__(self, nodes, rels, var=None, shortest=None):
+        self.nodes = nodes
+        self.rels = rels
+        self.var = var
+        self.shortest = shortest
+
+
+class Literal:
+    def __init__(self, value):
+        self.value = value
+
+
+class Parameter:
+    def __init__(self, name):
+        self.name = name
+
+
+class Variable:
+    def __init__(self, name):
+        self.name = name
+
+
+class Property:
+    def __init__(self, subject, key):
+        self.subject = subject
+        self.key = key
+
+
+class BinaryOp:
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+class UnaryOp:
+    def __init__(self, op, operand):
+        self.op = op
+        self.operand = operand
+
+
+class IsNull:
+    def __init__(self, operand, negated=False):
+        self.operand = operand
+        self.negated = negated
+
+
+class FunctionCall:
+    def __init__(self, name, args, distinct=False):
+        self.name = name
+        self.args = args
+        self.distinct = distinct
+
+
+class ListLiteral:
+    def __init__(self, items):
+        self.items = items
+
+
+class MapLiteral:
+    def __init__(self, items):
+        self.items = items
+
+
+class Star:
+    pass
+
+
+# ---- Parser ----
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+        self.anonymous = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def advance(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def error(self, message, token=None):
+        token = token or self.peek()
+        near = "end of query" if token.kind == "end" else repr(self.text[token.pos:token.pos + 20])
+        return CypherSyntaxError(f"{message} near {near}")
+
+    def accept(self, value):
+        token = self.peek()
+        if token.kind == "op" and token.value == value:
+            return self.advance()
+        return None
+
+    def expect(self, value):
+        token = self.accept(value)
+        if token is None:
+            raise self.error(f"Expected '{value}'")
+        return token
+
+    def accept_keyword(self, *words):
+        if self.peek().is_keyword(*words):
+            return self.advance()
+        return None
+
+    def expect_keyword(self, word):
+        token = self.accept_keyword(word)
+        if token is None:
+            raise self.error(f"Expected {word}")
+        return token
+
+    def expect_name(self):
+        token = self.peek()
+        if token.kind != "name":
+            raise self.error("Expected a name")
+        return self.advance().value
+
+    def anonymous_name(self, prefix):
+        # Spaces make the name impossible to reference from a query
+        self.anonymous += 1
+        return f"  {prefix}{self.anonymous}"
+
+    # -- clauses --
+
+    def parse_query(self):
+        clauses = []
+        while self.peek().kind != "end":
+            if self.accept(";"):
+                continue
+            clauses.append(self.parse_clause())
+        if not clauses:
+            raise self.error("Empty query")
+        return Query(clauses)
+
+    def parse_clause(self):
+        if self.accept_keyword("MATCH"):
+            patterns = [self.parse_path()]
+            while self.accept(","):
+                patterns.append(self.parse_path())
+            where = self.parse_expression() if self.accept_keyword("WHERE") else None
+            return MatchClause(patterns, where)
+        if self.accept_keyword("RETURN"):
+            distinct = bool(self.accept_keyword("DISTINCT"))
+            items = [self.parse_return_item()]
+            while self.accept(","):
+                items.append(self.parse_return_item())
+            order_by = []
+            if self.accept_keyword("ORDER"):
+                self.expect_keyword("BY")
+                order_by.append(self.parse_sort_item())
+                while self.accept(","):
+                    order_by.append(self.parse_sort_item())
+            skip = self.parse_expression() if self.accept_keyword("SKIP") else None
+            limit = self.parse_expression() if self.accept_keyword("LIMIT") else None
+            return ReturnClause(items, distinct, skip, limit, order_by)
+        raise self.error("Unsupported or misplaced clause")
+
+    def parse_return_item(self):
+        start = self.peek().pos
+        if self.accept("*"):
+            return ReturnItem(Star(), None, "*")
+        expr = self.parse_expression()
+        text = self.text[start:self.peek().pos].strip()
+        alias = self.expect_name() if self.accept_keyword("AS") else None
+        return ReturnItem(expr, alias, text)
+
+    def parse_sort_item(self):
+        expr = self.parse_expression()
+        if self.accept_keyword("DESC", "DESCENDING"):
+            return SortItem(expr, True)
+        self.accept_keyword("ASC", "ASCENDING")
+        return SortItem(expr)
+
+    # -- patterns --
+
+    def parse_path(self):
+        var = None
+        if self.peek().kind == "name" and self.peek(1).kind == "op" and self.peek(1).value == "=":
+            var = self.advance().value
+            self.advance()
+        shortest = None
+        if self.peek().is_keyword("SHORTESTPATH", "ALLSHORTESTPATHS"):
+            shortest = "all" if self.advance().value.upper() == "ALLSHORTESTPATHS" else "one"
+            self.expect("(")
+        nodes = [self.parse_node_pattern()]
+        rels = []
+        while self.peek().kind == "op" and self.peek().value in ("-", "<-"):
+            rels.append(self.parse_rel_pattern())
+            nodes.append(self.parse_node_pattern())
+        if shortest:
+            self.expect(")")
+            if len(rels) != 1:
+                raise self.error("shortestPath needs a pattern with exactly one relationship")
+        return PathPattern(nodes, rels, var, shortest)
+
+    def parse_node_pattern(self):
+        self.expect("(")
+        var = None
+        if self.peek().kind == "name":
+            var = self.advance().value
+        labels = []
+        while self.accept(":"):
+            labels.append(self.expect_name())
+        props = self.parse_map() if self.peek().value == "{" and self.peek().kind == "op" else {}
+        self.expect(")")
+        return NodePattern(var or self.anonymous_name("n"), labels, props)
+
+    def parse_rel_pattern(self):
+        left_arrow = bool(self.accept("<-"))
+        if not left_arrow:
+            self.expect("-")
+        var = None
+        types = []
+        props = {}
+        min_hops = max_hops = 1
+        variable_length = False
+        if self.accept("["):
+            if self.peek().kind == "name":
+                var = self.advance().value
+            if self.accept(":"):
+                types.append(self.expect_name())
+                while self.accept("|"):
+                    self.accept(":")
+                    types.append(self.expect_name())
+            if self.accept("*"):
+                variable_length = True
+                min_hops, max_hops = self.parse_hops()
+            if self.peek().kind == "op" and self.peek().value == "{":
+                props = self.parse_map()
+            self.expect("]")
+        if self.accept("->"):
+            right_arrow = True
+        else:
+            self.expect("-")
+            right_arrow = False
+        if left_arrow and right_arrow:
+            raise self.error("A relationship cannot point both ways")
+        direction = "in" if left_arrow else "out" if right_arrow else "both"
+        return RelPattern(var or self.anonymous_name("r"), types, props, direction, min_hops, max_hops, variable_length)
+
+    def parse_hops(self):
+        # After '*': nothing (1..), n (exactly n), n.., ..m or n..m
+        low = self.advance().value if self.peek().kind == "number" else None
+        if self.accept(".."):
+            high = self.advance().value if self.peek().kind == "number" else None
+            low = 1 if low is None else low
+        elif low is None:
+            low, high = 1, None
+        else:
+            high = low
+        if not all(isinstance(bound, int) for bound in (low, high) if bound is not None):
+            raise self.error("Path length bounds must be integers")
+        if high is not None and high < low:
+            raise self.error("Path length upper bound is below the lower bound")
+        return low, high
+
+    def parse_map(self):
+        self.expect("{")
+        items = {}
+        if not self.accept("}"):
+            while True:
+                key = self.expect_name()
+                self.expect(":")
+                items[key] = self.parse_expression()
+                if self.accept("}"):
+                    break
+                self.expect(",")
+        return items
+
+    # -- expressions --
+
+    def parse_expression(self):
+        return self.parse_or()
+
+    def parse_or(self):
+        left = self.parse_xor()
+        while self.accept_keyword("OR"):
+            left = BinaryOp("OR", left, self.parse_xor())
+        return left
+
+    def parse_xor(self):
+        left = self.parse_and()
+        while self.accept_keyword("XOR"):
+            left = BinaryOp("XOR", left, self.parse_and())
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.accept_keyword("AND"):
+            left = BinaryOp("AND", left, self.parse_not())
+        return left
+
+    def parse_not(self):
+        if self.accept_keyword("NOT"):
+            return UnaryOp("NOT", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_additive()
+        while True:
+            token = self.peek()
+            if token.kind == "op" and token.value in comparison_ops:
+                self.advance()
+                op = "<>" if token.value == "!=" else token.value
+                left = BinaryOp(op, left, self.parse_additive())
+            elif token.kind == "op" and token.value == "<-":
+                # `a<-1` is a comparison with a negative number, not an arrow
+                self.advance()
+                left = BinaryOp("<", left, UnaryOp("-", self.parse_multiplicative()))
+            elif token.is_keyword("IS"):
+                self.advance()
+                negated = bool(self.accept_keyword("NOT"))
+                self.expect_keyword("NULL")
+                left = IsNull(left, negated)
+            elif token.is_keyword("IN", "CONTAINS"):
+                self.advance()
+                left = BinaryOp(token.value.upper(), left, self.parse_additive())
+            elif token.is_keyword("STARTS", "ENDS"):
+                self.advance()
+                self.expect_keyword("WITH")
+                left = BinaryOp(token.value.upper() + " WITH", left, self.parse_additive())
+            else:
+                return left
+
+    def parse_additive(self):
+        left = self.parse_multiplicative()
+        while self.peek().kind == "op" and self.peek().value in ("+", "-"):
+            op = self.advance().value
+            left = BinaryOp(op, left, self.parse_multiplicative())
+        return left
+
+    def parse_multiplicative(self):
+        left = self.parse_unary()
+        while self.peek().kind == "op" and self.peek().value in ("*", "/", "%"):
+            op = self.advance().value
+            left = BinaryOp(op, left, self.parse_unary())
+        return left
+
+    def parse_unary(self):
+        if self.accept("-"):
+            return UnaryOp("-", self.parse_unary())
+        if self.accept("+"):
+            return self.parse_unary()
+        return self.parse_postfix()
+
+    def parse_postfix(self):
+        expr = self.parse_atom()
+        while self.accept("."):
+            expr = Property(expr, self.expect_name())
+        return expr
+
+    def parse_atom(self):
+        token = self.peek()
+        if token.kind in ("number", "string"):
+            self.advance()
+            return Literal(token.value)
+        if token.is_keyword("TRUE"):
+            self.advance()
+            return Literal(True)
+        if token.is_keyword("FALSE"):
+            self.advance()
+            return Literal(False)
+        if token.is_keyword("NULL"):
+            self.advance()
+            return Literal(None)
+        if token.kind == "param":
+            self.advance()
+            return Parameter(token.value[1:])
+        if token.kind == "name":
+            self.advance()
+            if self.accept("("):
+                return self.parse_function_call(token.value)
+            return Variable(token.value)
+        if self.accept("("):
+            expr = self.parse_expression()
+            self.expect(")")
+            return expr
+        if self.accept("["):
+            items = []
+            if not self.accept("]"):
+                items.append(self.parse_expression())
+                while self.accept(","):
+                    items.append(self.parse_expression())
+                self.expect("]")
+            return ListLiteral(items)
+        if token.kind == "op" and token.value == "{":
+            return MapLiteral(self.parse_map())
+        raise self.error("Expected an expression")
+
+    def parse_function_call(self, name):
+        if self.accept("*"):
+            self.expect(")")
+            return FunctionCall(name.lower(), [Star()])
+        distinct = bool(self.accept_keyword("DISTINCT"))
+        args = []
+        if not self.accept(")"):
+            args.append(self.parse_expression())
+            while self.accept(","):
+                args.append(self.parse_expression())
+            self.expect(")")
+        return FunctionCall(name.lower(), args, distinct)
+
+
+def parse(text):
+    return Parser(text).parse_query()
+
+
+def parse_expression(text):
+    # A single standalone expression, such as the list of an UNWIND
+    parser = Parser(text)
+    expr = parser.parse_expression()
+    if parser.peek().kind != "end":
+        raise parser.error("Unexpected input after expression")
+    return expr
+
+
+def display_name(name):
+    # Anonymous variables have names no query can write; show them readably
+    return f"anon_{name.strip()}" if name.startswith(" ") else name
+
+
+def to_text(expr):
+    # Cypher text of an expression, for plan descriptions
+    if isinstance(expr, Literal):
+        value = expr.value
+        if value is None:
+            return "null"
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, str):
+            return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+        return repr(value)
+    if isinstance(expr, Parameter):
+        return f"${expr.name}"
+    if isinstance(expr, Variable):
+        return display_name(expr.name)
+    if isinstance(expr, Property):
+        return f"{to_text(expr.subject)}.{expr.key}"
+    if isinstance(expr, BinaryOp):
+        left, right = (f"({to_text(side)})" if isinstance(side, BinaryOp) else to_text(side) for side in (expr.left, expr.right))
+        return f"{left} {expr.op} {right}"
+    if isinstance(expr, UnaryOp):
+        return f"NOT {to_text(expr.operand)}" if expr.op == "NOT" else f"{expr.op}{to_text(expr.operand)}"
+    if isinstance(expr, IsNull):
+        return f"{to_text(expr.operand)} IS {'NOT ' if expr.negated else ''}NULL"
+    if isinstance(expr, FunctionCall):
+        return f"{expr.name}({'DISTINCT ' if expr.distinct else ''}{', '.join(map(to_text, expr.args))})"
+    if isinstance(expr, Star):
+        return "*"
+    if isinstance(expr, ListLiteral):
+        return f"[{', '.join(map(to_text, expr.items))}]"
+    if isinstance(expr, MapLiteral):
+        return "{" + ", ".join(f"{key}: {to_text(value)}" for key, value in expr.items.items()) + "}"
+    return type(expr).__name__
+
+
+def normalize(text):
+    # Token-level form of a query: insensitive to whitespace, comments and
+    # keyword case, but not to anything inside string literals. The value's
+    # type is part of each entry, since 2 == 2.0 would otherwise share a plan.
+    return tuple(
+        (
+            token.kind,
+            type(token.value).__name__,
+            token.value.upper() if token.kind == "name" and token.value.upper() in keywords else token.value
+        )
+        for token in tokenize(text)
+    )
+
+
+keywords = {
+    "MATCH", "WHERE", "RETURN", "DISTINCT", "AS", "AND", "OR", "XOR", "NOT",
+    "IS", "NULL", "TRUE", "FALSE", "IN", "CONTAINS", "STARTS", "ENDS", "WITH",
+    "SKIP", "LIMIT", "SHORTESTPATH", "ALLSHORTESTPATHS", "ORDER", "BY", "ASC",
+    "ASCENDING", "DESC", "DESCENDING"
+}
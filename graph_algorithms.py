@@ -0,0 +1,309 @@
+import time
+import threading
+from graph_cache import CachedGraph
+from query_planner import QueryError
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; CALL algo.* then reports an error
+    np = None
+
+# Graph analytics procedures, reached through `CALL algo.<name>({config})`.
+#
+# A procedure projects the stored graph (optionally only the nodes with one
+# label and the relationships of some types) into a CSR snapshot: node
+# positions 0..n-1, and for every node the positions of its outgoing
+# neighbours as one contiguous run of `indices`, delimited by `indptr`. The
+# algorithms are whole-array NumPy operations over that snapshot, so their
+# per-iteration cost does not involve Python code per node or relationship.
+#
+# Results are streamed as (node, value) rows, or with `writeProperty` stored
+# on the nodes, in which case a single summary row is returned.
+#
+#   CALL algo.pageRank({label: 'Page', relationshipTypes: ['LINKS'], writeProperty: 'rank'})
+#   CALL algo.wcc() YIELD node, componentId
+
+available = np is not None
+
+# Projections of resident graphs, reused until the graph gains entities or is reloaded
+SNAPSHOT_CACHE_SIZE = 4
+
+
+class CSRSnapshot:
+    def __init__(self, nodes, sources, targets):
+        self.nodes = nodes
+        count = len(nodes)
+        order = np.argsort(sources, kind="stable")
+        # Source position of every entry of `indices`, for vectorised gathers
+        self.sources = sources[order]
+        self.indices = targets[order]
+        self.indptr = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.sources, minlength=count), out=self.indptr[1:])
+
+    @property
+    def node_count(self):
+        return len(self.nodes)
+
+    @property
+    def relationship_count(self):
+        return len(self.indices)
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def in_degree(self):
+        return np.bincount(self.indices, minlength=self.node_count)
+
+    @classmethod
+    def build(cls, graph, label=None, rel_types=()):
+        nodes = list(graph.scan_label(label) if label is not None else graph.scan_nodes())
+        position = {node.id: i for i, node in enumerate(nodes)}.get
+        sources = []
+        targets = []
+        for rel in graph.scan_relationships():
+            if rel_types and rel.rel_type not in rel_types:
+                continue
+            start = position(rel.start_node)
+            end = position(rel.end_node)
+            # Relationships leaving the projection are dropped
+            if start is not None and end is not None:
+                sources.append(start)
+                targets.append(end)
+        return cls(nodes, np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64))
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def snapshot(graph, label=None, rel_types=()):
+    if not isinstance(graph, CachedGraph):
+        # A transaction's view is projected afresh; it is not shared
+        return CSRSnapshot.build(graph, label, rel_types)
+    # Entities are append-only, so the counts identify the topology of a generation
+    key = (graph.resource, graph.generation, len(graph.nodes), len(graph.relationships), label, rel_types)
+    with _snapshots_lock:
+        csr = _snapshots.get(key)
+    if csr is None:
+        csr = CSRSnapshot.build(graph, label, rel_types)
+        with _snapshots_lock:
+            _snapshots[key] = csr
+            while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+                del _snapshots[next(iter(_snapshots))]
+    return csr
+
+
+def _undirected(csr):
+    return (
+        np.concatenate((csr.sources, csr.indices)),
+        np.concatenate((csr.indices, csr.sources))
+    )
+
+
+def _renumber(labels):
+    # Arbitrary representatives -> 0..k-1, in order of the smallest representative
+    _, compact = np.unique(labels, return_inverse=True)
+    return compact.reshape(-1)
+
+
+def page_rank(csr, damping_factor=0.85, max_iterations=20, tolerance=1e-7):
+    # Power iteration; the rank of nodes without outgoing relationships is
+    # spread over all nodes, so the scores keep summing to 1
+    count = csr.node_count
+    if not count:
+        return np.zeros(0), 0, True
+    out_degree = csr.out_degree().astype(float)
+    dangling = out_degree == 0
+    rank = np.full(count, 1.0 / count)
+    share = np.zeros(count)
+    iterations = 0
+    converged = False
+    while iterations < max_iterations and not converged:
+        iterations += 1
+        np.divide(rank, out_degree, out=share, where=~dangling)
+        incoming = np.bincount(csr.indices, weights=share[csr.sources], minlength=count)
+        updated = (1 - damping_factor) / count + damping_factor * (incoming + rank[dangling].sum() / count)
+        converged = np.abs(updated - rank).sum() < tolerance
+        rank = updated
+    return rank, iterations, converged
+
+
+def weakly_connected_components(csr):
+    # Min-label propagation with pointer jumping: every node points at a node
+    # of its component, each round pulls the smallest label across every
+    # relationship and then follows the pointers one step
+    sources, targets = _undirected(csr)
+    labels = np.arange(csr.node_count)
+    rounds = 0
+    while True:
+        rounds += 1
+        updated = labels.copy()
+        np.minimum.at(updated, sources, labels[targets])
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return _renumber(labels), rounds
+        labels = updated
+
+
+def label_propagation(csr, max_iterations=10):
+    # Every node adopts the label most frequent among its neighbours and
+    # itself (ties go to the smallest label), all nodes at once per iteration.
+    # Counting its own label keeps two-node structures from swapping forever.
+    count = csr.node_count
+    if not count:
+        return np.zeros(0, dtype=np.int64), 0, True
+    own = np.arange(count)
+    sources, targets = _undirected(csr)
+    sources = np.concatenate((sources, own))
+    targets = np.concatenate((targets, own))
+    labels = own.copy()
+    iterations = 0
+    converged = False
+    while iterations < max_iterations and not converged:
+        iterations += 1
+        # One key per (node, candidate label); n * n fits int64 below 3e9 nodes
+        keys, votes = np.unique(sources * count + labels[targets], return_counts=True)
+        nodes, candidates = np.divmod(keys, count)
+        order = np.lexsort((candidates, -votes, nodes))
+        nodes = nodes[order]
+        first = np.ones(len(nodes), dtype=bool)
+        first[1:] = nodes[1:] != nodes[:-1]
+        updated = np.empty_like(labels)
+        updated[nodes[first]] = candidates[order][first]
+        converged = np.array_equal(updated, labels)
+        labels = updated
+    return _renumber(labels), iterations, converged
+
+
+def degree(csr, direction="out"):
+    if direction == "out":
+        return csr.out_degree()
+    if direction == "in":
+        return csr.in_degree()
+    return csr.out_degree() + csr.in_degree()
+
+
+# ---- Procedures ----
+
+class Procedure:
+    # `run(csr, config)` returns (values, summary); options maps every
+    # procedure-specific config key to (default, check, description)
+    def __init__(self, name, column, run, options):
+        self.name = name
+        self.column = column
+        self.run = run
+        self.options = options
+
+
+def _number(low, high=None):
+    def check(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and low <= value and (high is None or value <= high)
+    return check
+
+
+def _positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _run_page_rank(csr, config):
+    scores, iterations, converged = page_rank(csr, config["dampingFactor"], config["maxIterations"], config["tolerance"])
+    return scores, {"ranIterations": iterations, "didConverge": bool(converged)}
+
+
+def _run_wcc(csr, config):
+    components, rounds = weakly_connected_components(csr)
+    return components, {"componentCount": int(components.max()) + 1 if len(components) else 0, "ranIterations": rounds}
+
+
+def _run_label_propagation(csr, config):
+    communities, iterations, converged = label_propagation(csr, config["maxIterations"])
+    return communities, {
+        "communityCount": int(communities.max()) + 1 if len(communities) else 0,
+        "ranIterations": iterations,
+        "didConverge": bool(converged)
+    }
+
+
+def _run_degree(csr, config):
+    return degree(csr, config["direction"]), {}
+
+
+procedures = {
+    procedure.name.lower(): procedure for procedure in (
+        Procedure("algo.pageRank", "score", _run_page_rank, {
+            "dampingFactor": (0.85, _number(0, 1), "a number between 0 and 1"),
+            "maxIterations": (20, _positive_int, "a positive integer"),
+            "tolerance": (1e-7, _number(0), "a non-negative number"),
+        }),
+        Procedure("algo.wcc", "componentId", _run_wcc, {}),
+        Procedure("algo.labelPropagation", "communityId", _run_label_propagation, {
+            "maxIterations": (10, _positive_int, "a positive integer"),
+        }),
+        Procedure("algo.degree", "degree", _run_degree, {
+            "direction": ("out", lambda value: value in ("out", "in", "both"), "'out', 'in' or 'both'"),
+        }),
+    )
+}
+
+
+def find_procedure(name):
+    procedure = procedures.get(name.lower())
+    if procedure is None:
+        raise QueryError(f"Unknown procedure: {name} (available: {', '.join(p.name for p in procedures.values())})")
+    return procedure
+
+
+def procedure_config(procedure, config):
+    # Validated copy of the CALL's config map, with defaults filled in
+    if config is None:
+        config = {}
+    if not isinstance(config, dict):
+        raise QueryError(f"{procedure.name} expects a map of settings, got {config!r}")
+    config = dict(config)
+    settings = {}
+    label = config.pop("label", None)
+    if label is not None and not isinstance(label, str):
+        raise QueryError(f"label must be a string, got {label!r}")
+    settings["label"] = label
+    rel_types = config.pop("relationshipTypes", None)
+    if isinstance(rel_types, str):
+        rel_types = [rel_types]
+    if rel_types is not None and not (isinstance(rel_types, list) and all(isinstance(t, str) for t in rel_types)):
+        raise QueryError(f"relationshipTypes must be a list of strings, got {rel_types!r}")
+    settings["relationshipTypes"] = tuple(sorted(set(rel_types or ())))
+    write_property = config.pop("writeProperty", None)
+    if write_property is not None and (not isinstance(write_property, str) or not write_property):
+        raise QueryError(f"writeProperty must be a property name, got {write_property!r}")
+    settings["writeProperty"] = write_property
+    for key, (default, check, description) in procedure.options.items():
+        value = config.pop(key, default)
+        if not check(value):
+            raise QueryError(f"{key} of {procedure.name} must be {description}, got {value!r}")
+        settings[key] = value
+    if config:
+        raise QueryError(f"Unknown setting for {procedure.name}: {sorted(config)[0]}")
+    return settings
+
+
+def compute(procedure, graph, settings):
+    # Runs the algorithm; the caller holds at least a shared lock
+    if not available:
+        raise QueryError("CALL algo.* procedures need NumPy")
+    started = time.perf_counter()
+    csr = snapshot(graph, settings["label"], settings["relationshipTypes"])
+    values, summary = procedure.run(csr, settings)
+    summary = {
+        "nodeCount": csr.node_count,
+        "relationshipCount": csr.relationship_count,
+        **summary,
+        "computeMillis": round((time.perf_counter() - started) * 1000, 3)
+    }
+    return csr, values, summary
+
+
+def write_back(graph, csr, values, key):
+    # Stores one value per projected node; the caller holds the exclusive lock
+    started = time.perf_counter()
+    graph.set_node_properties(key, zip(csr.nodes, values.tolist()))
+    graph.commit()
+    return round((time.perf_counter() - started) * 1000, 3)
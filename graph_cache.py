@@ -0,0 +1,613 @@
+import os
+import threading
+from contextlib import contextmanager
+from array import array
+from itertools import islice
+from graph_storage import GraphStorage
+from lock_manager import lock_manager, SHARED, EXCLUSIVE
+from graph_entities import Node, Relationship, PropertyStore
+from range_index import RangeIndex, order_key
+from columnar import ColumnStore, available as columnar_available
+
+# Number of logged mutations after which the log is folded into the snapshot files
+CHECKPOINT_INTERVAL = 1000
+
+
+class CachedGraph:
+    # Long-lived in-memory copy of one database folder. It is loaded once and
+    # only reloaded when the snapshot files or the write-ahead log change on
+    # disk, so queries work against memory instead of re-parsing the JSON files.
+    #
+    # Mutations are appended to wal.log on commit; the snapshot files
+    # (nodes.json and relationships.json, or the binary store) are only
+    # rewritten on checkpoint.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.storage = GraphStorage(db_path)
+        # Queries take shared / exclusive locks on `resource` through the lock
+        # manager; `lock` only guards short internal sections (log writes)
+        self.resource = graph_resource(db_path)
+        self.lock = threading.RLock()
+        # An entity's internal integer id (`slot`) is its position in these
+        # lists; node_by_id / rel_by_id map the external UUIDs back to them
+        self.nodes = []
+        self.relationships = []
+        self.node_by_id = {}
+        self.rel_by_id = {}
+        # Properties of every node / relationship, stored column by column
+        self.node_properties = PropertyStore()
+        self.rel_properties = PropertyStore()
+        # Label index: label -> array of node slots. Append-only, so a
+        # streaming scan can keep iterating while new nodes are added.
+        self.label_index = {}
+        # Property indexes: label -> prop -> str(value) -> {node id: None}.
+        # Registered indexes are maintained by every node write.
+        self.indexes = {}
+        # Ordered indexes for range predicates: label -> prop -> RangeIndex
+        self.range_indexes = {}
+        # Composite indexes: label -> (prop, ...) -> (str(value), ...) -> {node id: None}
+        self.composite_indexes = {}
+        # Identity index for find-or-create: (label, canonical properties) -> node id
+        self.identity_index = {}
+        # Adjacency: node id -> relationship type -> [Relationship]
+        self.out_edges = {}
+        self.in_edges = {}
+        # NumPy property columns for vectorised WHERE filters (None without NumPy)
+        self.columns = None
+        self._pending = []
+        self._batch_depth = 0
+        self._log_entries = 0
+        self._signature = None
+        # Bumped whenever the set of indexes may have changed (cached plans depend on it)
+        self.schema_version = 0
+        # Bumped on every reload from disk; open transactions cannot survive one
+        self.generation = 0
+        # Bumped whenever existing nodes get new property values (entities are
+        # otherwise immutable, which snapshot isolation relies on)
+        self.property_version = 0
+        # Not visible to other threads yet, so the first load needs no locks
+        self._load()
+
+    def _file_signature(self):
+        signature = []
+        for path in (self.storage.nodes_file, self.storage.rels_file, self.storage.log_file):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def refresh(self):
+        # Reload only if the files were changed by someone other than us.
+        # Reloading replaces every structure, so it waits for running queries.
+        if self._file_signature() == self._signature:
+            return
+        with lock_manager.locked(self.resource, EXCLUSIVE), self.lock:
+            if self._file_signature() != self._signature:
+                self._load()
+
+    def _load(self):
+        # Snapshot, log and signature are read under the database's file lock,
+        # so they belong together even when other processes write. Another
+        # process may also have converted the snapshot format meanwhile.
+        with self.storage.lock:
+            self.storage.select_format()
+            self._read_files()
+
+    def _read_files(self):
+        self.schema_version += 1
+        self.generation += 1
+        self.nodes = []
+        self.relationships = []
+        self.node_by_id = {}
+        self.rel_by_id = {}
+        self.node_properties = PropertyStore()
+        self.rel_properties = PropertyStore()
+        self.label_index = {}
+        self.identity_index = {}
+        self.out_edges = {}
+        self.in_edges = {}
+        self.columns = ColumnStore(self) if columnar_available else None
+        self._pending = []
+        # Index entries are rebuilt from the nodes themselves, so an
+        # indexes.json that lags behind the snapshot is never trusted
+        self.indexes = {
+            label: {prop: {} for prop in props}
+            for label, props in self.storage.load_indexes().items()
+            if isinstance(props, dict)
+        }
+        # Range indexes are registered once the nodes are in and then bulk
+        # built, instead of taking a sorted insert per node
+        self.range_indexes = {}
+        self.composite_indexes = {}
+        schema = self.storage.load_schema()
+        for label, props in schema.get("composite", []):
+            self.composite_indexes.setdefault(label, {})[tuple(props)] = {}
+        nodes, relationships = self.storage.load_graph()
+        label_index = self.storage.load_label_index()
+        for node in nodes:
+            self._apply_node(node, index_labels=label_index is None)
+        if label_index is not None:
+            node_by_id = self.node_by_id
+            self.label_index = {
+                label: array("q", (node_by_id[node_id].slot for node_id in ids))
+                for label, ids in label_index.items()
+            }
+        for rel in relationships:
+            self._apply_relationship(rel)
+        log = self.storage.read_log()
+        self._replay(log)
+        for label, prop in schema.get("range", []):
+            self.range_indexes.setdefault(label, {})[prop] = self._build_range_index(label, prop)
+        self._log_entries = log_size(log)
+        self._signature = self._file_signature()
+
+    def _replay(self, entries):
+        # Entries already present in the snapshot (crash between checkpoint
+        # and log truncation) are skipped, so replay is idempotent
+        for entry in entries:
+            if entry["op"] == "create_node":
+                node = Node.from_dict(entry["node"])
+                if node.id not in self.node_by_id:
+                    self._apply_node(node)
+            elif entry["op"] == "create_relationship":
+                rel = Relationship.from_dict(entry["relationship"])
+                if rel.id not in self.rel_by_id:
+                    self._apply_relationship(rel)
+            elif entry["op"] == "set_node_properties":
+                # Setting a value twice is harmless
+                node_by_id = self.node_by_id
+                key = entry["key"]
+                for node_id, value in entry["values"].items():
+                    node = node_by_id.get(node_id)
+                    if node is not None:
+                        self._apply_property(node, key, value)
+                if self.columns is not None:
+                    self.columns.invalidate(key)
+
+    def _apply_node(self, node, index_labels=True):
+        # Keys are built from the plain dict; reading back through the
+        # attached view would scan every property column per key
+        properties = node.properties
+        node.attach(self.node_properties, len(self.nodes))
+        self.nodes.append(node)
+        self.node_by_id[node.id] = node
+        for label in node.labels:
+            if index_labels:
+                postings = self.label_index.get(label)
+                if postings is None:
+                    postings = self.label_index[label] = array("q")
+                postings.append(node.slot)
+            self.identity_index.setdefault(identity_key(label, properties), node.id)
+            for prop, index in self.indexes.get(label, {}).items():
+                value = properties.get(prop)
+                if value is not None:
+                    index.setdefault(str(value), {})[node.id] = None
+            for prop, index in self.range_indexes.get(label, {}).items():
+                value = properties.get(prop)
+                if value is not None:
+                    index.insert(value, node.id)
+            for props, index in self.composite_indexes.get(label, {}).items():
+                key = composite_key(node, props)
+                if key is not None:
+                    index.setdefault(key, {})[node.id] = None
+
+    def _apply_relationship(self, rel):
+        # Endpoints share the node's id string instead of holding their own copy
+        start = self.node_by_id.get(rel.start_node)
+        if start is not None:
+            rel.start_node = start.id
+        end = self.node_by_id.get(rel.end_node)
+        if end is not None:
+            rel.end_node = end.id
+        rel.attach(self.rel_properties, len(self.relationships))
+        self.relationships.append(rel)
+        self.rel_by_id[rel.id] = rel
+        self.out_edges.setdefault(rel.start_node, {}).setdefault(rel.rel_type, []).append(rel)
+        self.in_edges.setdefault(rel.end_node, {}).setdefault(rel.rel_type, []).append(rel)
+
+    def _apply_property(self, node, key, value):
+        # Moves the node's entries for `key` in every index from the old value to the new one
+        old = node.get_property(key)
+        affected = [
+            (label, props) for label in node.labels
+            for props in self.composite_indexes.get(label, {}) if key in props
+        ]
+        for label in node.labels:
+            identity = identity_key(label, node.properties)
+            if self.identity_index.get(identity) == node.id:
+                del self.identity_index[identity]
+            if old is not None:
+                index = self.indexes.get(label, {}).get(key)
+                if index is not None:
+                    bucket = index.get(str(old), {})
+                    bucket.pop(node.id, None)
+                    if not bucket:
+                        index.pop(str(old), None)
+                range_index = self.range_indexes.get(label, {}).get(key)
+                if range_index is not None:
+                    range_index.remove(old, node.id)
+        for label, props in affected:
+            index = self.composite_indexes[label][props]
+            old_key = composite_key(node, props)
+            if old_key is not None:
+                bucket = index.get(old_key, {})
+                bucket.pop(node.id, None)
+                if not bucket:
+                    index.pop(old_key, None)
+        if value is not None:
+            node.properties[key] = value
+        elif old is not None:
+            del node.properties[key]
+        for label in node.labels:
+            self.identity_index.setdefault(identity_key(label, node.properties), node.id)
+            if value is not None:
+                index = self.indexes.get(label, {}).get(key)
+                if index is not None:
+                    index.setdefault(str(value), {})[node.id] = None
+                range_index = self.range_indexes.get(label, {}).get(key)
+                if range_index is not None:
+                    range_index.insert(value, node.id)
+        for label, props in affected:
+            new_key = composite_key(node, props)
+            if new_key is not None:
+                self.composite_indexes[label][props].setdefault(new_key, {})[node.id] = None
+
+    def node_count(self):
+        return len(self.nodes)
+
+    def scan_nodes(self, offset=0):
+        return islice(self.nodes, offset, None)
+
+    def scan_relationships(self):
+        return iter(self.relationships)
+
+    def nodes_with_label(self, label):
+        nodes = self.nodes
+        return [nodes[slot] for slot in self.label_index.get(label, ())]
+
+    def scan_label(self, label, offset=0):
+        # Lazy variant of nodes_with_label, starting after `offset` nodes
+        nodes = self.nodes
+        for slot in islice(self.label_index.get(label, ()), offset, None):
+            yield nodes[slot]
+
+    def label_count(self, label):
+        return len(self.label_index.get(label, ()))
+
+    def has_index(self, label, prop):
+        return prop in self.indexes.get(label, {})
+
+    def index_lookup(self, label, prop, value):
+        return list(self.indexes.get(label, {}).get(prop, {}).get(str(value), ()))
+
+    def has_range_index(self, label, prop):
+        return prop in self.range_indexes.get(label, {})
+
+    def range_scan(self, label, prop, operator, value):
+        return self.range_indexes[label][prop].scan(operator, value)
+
+    def range_count(self, label, prop, operator, value):
+        return self.range_indexes[label][prop].count(operator, value)
+
+    def range_scan_between(self, label, prop, lower, upper):
+        return self.range_indexes[label][prop].scan_between(lower, upper)
+
+    def range_count_between(self, label, prop, lower, upper):
+        return self.range_indexes[label][prop].count_between(lower, upper)
+
+    def find_identical(self, label, props):
+        # O(1) lookup of a node with this label and exactly these properties
+        node_id = self.identity_index.get(identity_key(label, props))
+        return self.node_by_id[node_id] if node_id is not None else None
+
+    def _covering_index(self, label, props):
+        # Widest composite index whose properties are all given in `props`
+        covering = [
+            index_props for index_props in self.composite_indexes.get(label, {})
+            if all(prop in props for prop in index_props)
+        ]
+        return max(covering, key=len) if covering else None
+
+    def seek(self, label, props):
+        # Pick index access for an equality pattern on `props`: the widest
+        # composite index covered by the pattern, else the intersection of the
+        # single-property indexes. Returns candidate node ids (a superset of
+        # the matches when only part of the pattern is indexed), or None when
+        # no index applies and the caller has to scan the label.
+        index_props = self._covering_index(label, props)
+        if index_props is not None:
+            key = tuple(str(props[prop]) for prop in index_props)
+            return list(self.composite_indexes[label][index_props].get(key, ()))
+
+        postings = [
+            self.indexes[label][prop].get(str(value), {})
+            for prop, value in props.items()
+            if self.has_index(label, prop)
+        ]
+        if not postings:
+            return None
+        postings.sort(key=len)
+        return [node_id for node_id in postings[0] if all(node_id in other for other in postings[1:])]
+
+    def estimate_seek(self, label, props):
+        # Upper bound on the ids seek() would return, from posting list sizes only
+        index_props = self._covering_index(label, props)
+        if index_props is not None:
+            key = tuple(str(props[prop]) for prop in index_props)
+            return len(self.composite_indexes[label][index_props].get(key, ()))
+        sizes = [
+            len(self.indexes[label][prop].get(str(value), ()))
+            for prop, value in props.items()
+            if self.has_index(label, prop)
+        ]
+        return min(sizes) if sizes else None
+
+    def seek_indexes(self, label, props):
+        # Names of the indexes seek() uses for `props`, for EXPLAIN / PROFILE
+        index_props = self._covering_index(label, props)
+        if index_props is not None:
+            return [f"composite :{label}({', '.join(index_props)})"]
+        return [f"hash :{label}({prop})" for prop in props if self.has_index(label, prop)]
+
+    def create_index(self, label, prop, index_type="hash"):
+        with lock_manager.locked(self.resource, EXCLUSIVE), self.lock:
+            self.schema_version += 1
+            if isinstance(prop, (list, tuple)) and len(prop) > 1:
+                props = tuple(prop)
+                index = {}
+                for node in self.nodes_with_label(label):
+                    key = composite_key(node, props)
+                    if key is not None:
+                        index.setdefault(key, {})[node.id] = None
+                self.composite_indexes.setdefault(label, {})[props] = index
+                self.storage.save_schema(self._schema())
+                return
+            if isinstance(prop, (list, tuple)):
+                prop = prop[0]
+            if index_type == "range":
+                self.range_indexes.setdefault(label, {})[prop] = self._build_range_index(label, prop)
+                self.storage.save_schema(self._schema())
+                return
+            index = {}
+            for node in self.nodes_with_label(label):
+                value = node.get_property(prop)
+                if value is not None:
+                    index.setdefault(str(value), {})[node.id] = None
+            self.indexes.setdefault(label, {})[prop] = index
+            self.storage.save_indexes(self.indexes)
+
+    def _build_range_index(self, label, prop):
+        # One sort over the current values; RangeIndex.insert is for single writes
+        index = RangeIndex()
+        index.build(
+            (value, node.id) for node in self.nodes_with_label(label)
+            for value in (node.get_property(prop),) if value is not None
+        )
+        return index
+
+    def verify_indexes(self):
+        # Compare every registered index against a fresh build from the nodes
+        problems = []
+        for label, props in self.indexes.items():
+            for prop, index in props.items():
+                expected = {}
+                for node in self.nodes_with_label(label):
+                    value = node.get_property(prop)
+                    if value is not None:
+                        expected.setdefault(str(value), set()).add(node.id)
+                problems.extend(_diff_index(f":{label}({prop})", index, expected))
+        for label, composites in self.composite_indexes.items():
+            for props, index in composites.items():
+                expected = {}
+                for node in self.nodes_with_label(label):
+                    key = composite_key(node, props)
+                    if key is not None:
+                        expected.setdefault(key, set()).add(node.id)
+                problems.extend(_diff_index(f":{label}({', '.join(props)})", index, expected))
+        for label, props in self.range_indexes.items():
+            for prop, index in props.items():
+                expected = {
+                    (order_key(node.get_property(prop)), node.id)
+                    for node in self.nodes_with_label(label)
+                    if node.get_property(prop) is not None
+                }
+                actual = set(index.entries())
+                for key, node_id in expected - actual:
+                    problems.append(f":{label}({prop}) range index missing node {node_id} for value {key[1]!r}")
+                for key, node_id in actual - expected:
+                    problems.append(f":{label}({prop}) range index has stale node {node_id} for value {key[1]!r}")
+                for numeric in (True, False):
+                    if index.keys[numeric] != sorted(index.keys[numeric]):
+                        problems.append(f":{label}({prop}) range index is out of order")
+        return problems
+
+    def _schema(self):
+        return {
+            "range": [[label, prop] for label, props in self.range_indexes.items() for prop in props],
+            "composite": [[label, list(props)] for label, composites in self.composite_indexes.items() for props in composites]
+        }
+
+    def outgoing(self, node_id, rel_type):
+        return self.out_edges.get(node_id, {}).get(rel_type, ())
+
+    def incoming(self, node_id, rel_type):
+        return self.in_edges.get(node_id, {}).get(rel_type, ())
+
+    def expand(self, node_id, rel_types, direction):
+        return expand_edges(self.out_edges, self.in_edges, node_id, rel_types, direction)
+
+    def add_node(self, node):
+        self._apply_node(node)
+        self._pending.append({"op": "create_node", "node": node.to_dict()})
+
+    def add_relationship(self, rel):
+        self._apply_relationship(rel)
+        self._pending.append({"op": "create_relationship", "relationship": rel.to_dict()})
+
+    def set_node_properties(self, key, values):
+        # Sets `key` on many nodes, from (node, value) pairs; None removes it.
+        # Logged as one entry. Open transactions fail from here on, since
+        # their snapshot would otherwise see the new values.
+        logged = {}
+        for node, value in values:
+            self._apply_property(node, key, value)
+            logged[node.id] = value
+        self.property_version += 1
+        if self.columns is not None:
+            self.columns.invalidate(key)
+        self._pending.append({"op": "set_node_properties", "key": key, "values": logged})
+
+    def disk_state(self):
+        # Identifies the state of the files this copy reflects; None while it
+        # holds writes that are not logged yet. Another process that loads the
+        # same files reports the same value.
+        return len(self.nodes), len(self.relationships), self._signature if not self._pending else None
+
+    @contextmanager
+    def batch(self):
+        # Defers commit() until the outermost batch ends, so a script or an
+        # UNWIND with many writes is logged with a single fsync'd append.
+        # Writers hold the exclusive lock, so no other writer can interleave.
+        with self.lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self._batch_depth -= 1
+                outermost = not self._batch_depth
+            if outermost:
+                self.commit()
+
+    def commit(self):
+        # Append the pending mutations to the log in one fsync'd write
+        with self.lock, self.storage.lock:
+            if not self._pending or self._batch_depth:
+                return
+            current = self._file_signature() == self._signature
+            self.storage.append_log(self._pending)
+            self._log_entries += log_size(self._pending)
+            self._pending = []
+            if not current:
+                # Another process wrote since this copy was loaded. Our entries
+                # are logged after its own; the copy keeps its old signature,
+                # so the next refresh() reloads both, and it must not be
+                # checkpointed until then or the other writes would be lost.
+                return
+            if self._log_entries >= CHECKPOINT_INTERVAL:
+                self.checkpoint()
+            else:
+                # Our own write must not trigger a reload on the next query
+                self._signature = self._file_signature()
+
+    def checkpoint(self):
+        with lock_manager.locked(self.resource, SHARED), self.lock, self.storage.lock:
+            self.commit()
+            if self._file_signature() != self._signature:
+                # The files hold writes of another process that this copy has
+                # not loaded; a checkpoint after the next refresh() folds them in
+                return
+            if self._log_entries == 0 and os.path.exists(self.storage.nodes_file):
+                return
+            self.storage.save_graph(self.nodes, self.relationships)
+            nodes = self.nodes
+            self.storage.save_label_index({
+                label: [nodes[slot].id for slot in slots]
+                for label, slots in self.label_index.items()
+            })
+            self.storage.save_indexes(self.indexes)
+            self.storage.truncate_log()
+            self._log_entries = 0
+            self._signature = self._file_signature()
+
+
+def _edges(adjacency, node_id, rel_types):
+    by_type = adjacency.get(node_id)
+    if not by_type:
+        return
+    if not rel_types:
+        for rels in by_type.values():
+            yield from rels
+        return
+    for rel_type in rel_types:
+        yield from by_type.get(rel_type, ())
+
+
+def expand_edges(out_edges, in_edges, node_id, rel_types, direction):
+    # (relationship, neighbour id) pairs of a node; all types when rel_types is empty
+    if direction in ("out", "both"):
+        for rel in _edges(out_edges, node_id, rel_types):
+            yield rel, rel.end_node
+    if direction in ("in", "both"):
+        for rel in _edges(in_edges, node_id, rel_types):
+            # A self-loop was already produced as an outgoing edge
+            if direction == "both" and rel.start_node == rel.end_node:
+                continue
+            yield rel, rel.start_node
+
+
+def log_size(entries):
+    # Mutations in a run of log entries; a property write-back counts one per node
+    return sum(len(entry["values"]) if entry["op"] == "set_node_properties" else 1 for entry in entries)
+
+
+def graph_resource(db_path):
+    # Lock manager resource name of a database
+    return "graph", os.path.abspath(db_path)
+
+
+def identity_key(label, props):
+    # Values are compared as strings, the same way MATCH compares properties
+    return label, tuple(sorted((key, str(value)) for key, value in props.items()))
+
+
+def composite_key(node, props):
+    # Ordered tuple of the node's values for `props`, or None if any is missing
+    key = []
+    for prop in props:
+        value = node.get_property(prop)
+        if value is None:
+            return None
+        key.append(str(value))
+    return tuple(key)
+
+
+def _diff_index(name, index, expected):
+    problems = []
+    for value in expected.keys() | index.keys():
+        actual_ids = set(index.get(value, ()))
+        expected_ids = expected.get(value, set())
+        for node_id in expected_ids - actual_ids:
+            problems.append(f"{name} missing node {node_id} for value {value!r}")
+        for node_id in actual_ids - expected_ids:
+            problems.append(f"{name} has stale node {node_id} for value {value!r}")
+    return problems
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def get_graph(db_path):
+    key = os.path.abspath(db_path)
+    with _graphs_lock:
+        graph = _graphs.get(key)
+        if graph is None:
+            graph = CachedGraph(db_path)
+            _graphs[key] = graph
+            return graph
+    graph.refresh()
+    return graph
+
+
+def loaded_graph(db_path):
+    # The resident copy of a database as it is, or None; never loads or refreshes
+    with _graphs_lock:
+        return _graphs.get(os.path.abspath(db_path))
+
+
+def checkpoint(db_path):
+    # Fold the write-ahead log into the snapshot files
+    get_graph(db_path).checkpoint()
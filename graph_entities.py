@@ -1,16 +1,131 @@
 # graph_entities.py
+import sys
+from collections.abc import MutableMapping
+
+# Marks a hole in a property column (the entity has no value for that key)
+MISSING = object()
+
+# Label sets are shared between all nodes with the same labels
+_label_sets = {}
+
+
+def intern_labels(labels):
+    labels = frozenset(sys.intern(label) for label in labels or ())
+    return _label_sets.setdefault(labels, labels)
+
+
+class PropertyStore:
+    # Column-oriented property storage for the entities of one graph: one
+    # list per property key, indexed by the entity's internal integer id.
+    # Keys are stored once per graph instead of once per entity.
+    __slots__ = ("columns",)
+
+    def __init__(self):
+        self.columns = {}
+
+    def get(self, slot, key, default=None):
+        column = self.columns.get(key)
+        if column is None or slot >= len(column):
+            return default
+        value = column[slot]
+        return default if value is MISSING else value
+
+    def set(self, slot, key, value):
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[sys.intern(key)] = []
+        if slot == len(column):
+            # Loading appends entity after entity
+            column.append(value)
+            return
+        if slot > len(column):
+            column.extend([MISSING] * (slot + 1 - len(column)))
+        column[slot] = value
+
+    def delete(self, slot, key):
+        column = self.columns.get(key)
+        if column is None or slot >= len(column) or column[slot] is MISSING:
+            raise KeyError(key)
+        column[slot] = MISSING
+
+    def keys(self, slot):
+        for key, column in self.columns.items():
+            if slot < len(column) and column[slot] is not MISSING:
+                yield key
+
+
+class Properties(MutableMapping):
+    # Dict-like view of one entity's row in a PropertyStore
+    __slots__ = ("store", "slot")
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    def __getitem__(self, key):
+        value = self.store.get(self.slot, key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return self.store.get(self.slot, key, default)
+
+    def __setitem__(self, key, value):
+        self.store.set(self.slot, key, value)
+
+    def __delitem__(self, key):
+        self.store.delete(self.slot, key)
+
+    def __iter__(self):
+        return self.store.keys(self.slot)
+
+    def __len__(self):
+        return sum(1 for _ in self.store.keys(self.slot))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Entity:
+    # Until an entity is attached to a graph its properties are a plain dict;
+    # attach() moves them into the graph's PropertyStore and gives the entity
+    # its internal integer id (`slot`), which is its position in the graph
+    __slots__ = ("id", "slot", "_properties")
+
+    @property
+    def properties(self):
+        if self.slot is None:
+            return self._properties
+        return Properties(self._properties, self.slot)
+
+    def get_property(self, key, default=None):
+        # Same as properties.get(), without building a view
+        if self.slot is None:
+            return self._properties.get(key, default)
+        return self._properties.get(self.slot, key, default)
+
+    def attach(self, store, slot):
+        for key, value in self._properties.items():
+            store.set(slot, key, value)
+        self._properties = store
+        self.slot = slot
+
+
+class Node(Entity):
+    __slots__ = ("labels",)
 
-class Node:
     def __init__(self, id, labels=None, properties=None):
         self.id = id
-        self.labels = labels or []
-        self.properties = properties or {}
+        self.slot = None
+        self.labels = intern_labels(labels)  # shared frozenset for O(1) label checks
+        self._properties = properties or {}
 
     def to_dict(self):
         return {
             "id": self.id,
-            "labels": self.labels,
-            "properties": self.properties
+            "labels": sorted(self.labels),
+            "properties": dict(self.properties)
         }
 
     @staticmethod
@@ -18,13 +133,16 @@ class Node:
         return Node(data["id"], data.get("labels", []), data.get("properties", {}))
 
 
-class Relationship:
+class Relationship(Entity):
+    __slots__ = ("start_node", "end_node", "rel_type")
+
     def __init__(self, id, start_node, end_node, rel_type, properties=None):
         self.id = id
+        self.slot = None
         self.start_node = start_node
         self.end_node = end_node
-        self.rel_type = rel_type
-        self.properties = properties or {}
+        self.rel_type = sys.intern(rel_type)
+        self._properties = properties or {}
 
     def to_dict(self):
         return {
@@ -32,7 +150,7 @@ class Relationship:
             "start_node": self.start_node,
             "end_node": self.end_node,
             "type": self.rel_type,
-            "properties": self.properties
+            "properties": dict(self.properties)
         }
 
     @staticmethod
@@ -44,3 +162,21 @@ class Relationship:
             data["type"],
             data.get("properties", {})
         )
+
+
+class Path:
+    # A walk through the graph: nodes[i] -relationships[i]- nodes[i + 1]
+    __slots__ = ("nodes", "relationships")
+
+    def __init__(self, nodes, relationships):
+        self.nodes = nodes
+        self.relationships = relationships
+
+    def __len__(self):
+        return len(self.relationships)
+
+    def to_dict(self):
+        return {
+            "nodes": [node.to_dict() for node in self.nodes],
+            "relationships": [rel.to_dict() for rel in self.relationships]
+        }
@@ -1,14 +1,127 @@
 import os
 import json
+import threading
 from graph_entities import Node, Relationship
+from binary_storage import BinaryGraphReader, write_binary_store, has_binary_store, NODES_FILE, MANIFEST_FILE
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    # Exclusive lock on a database's db.lock, held by at most one process at
+    # a time. Within a process it is re-entrant and threads take turns, so
+    # one flock covers nested sections (a commit that checkpoints).
+    def __init__(self, path):
+        self.path = path
+        self.mutex = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.mutex.acquire()
+        try:
+            # A folder that does not exist yet holds nothing to protect
+            if self.depth == 0 and os.path.isdir(os.path.dirname(self.path)):
+                self.file = open(self.path, "a+b")
+                try:
+                    _lock_file(self.file)
+                except BaseException:
+                    self.file.close()
+                    self.file = None
+                    raise
+        except BaseException:
+            self.mutex.release()
+            raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0 and self.file is not None:
+            _unlock_file(self.file)
+            self.file.close()
+            self.file = None
+        self.mutex.release()
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK gives up after about ten seconds; keep waiting
+            pass
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+_file_locks = {}
+_file_locks_mutex = threading.Lock()
+
+
+def file_lock(db_path):
+    # The process's FileLock of a database, shared by every GraphStorage on it
+    path = os.path.join(os.path.abspath(db_path), "db.lock")
+    with _file_locks_mutex:
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = _file_locks[path] = FileLock(path)
+        return lock
+
 
 class GraphStorage:
     def __init__(self, db_path):
         self.db_path = db_path
-        self.nodes_file = os.path.join(db_path, "nodes.json")
-        self.rels_file = os.path.join(db_path, "relationships.json")
+        # Several processes may open one database (the app and the query
+        # server). Whoever reads or changes the snapshot files or the log
+        # holds this lock, so nobody reads a log another process is appending
+        # to, or checkpoints over entries it has not loaded.
+        self.lock = file_lock(db_path)
+        self.select_format()
+        self.log_file = os.path.join(db_path, "wal.log")
+        self.labels_file = os.path.join(db_path, "labels.json")
+        self.indexes_file = os.path.join(db_path, "indexes.json")
+        self.schema_file = os.path.join(db_path, "schema.json")
+
+    def select_format(self):
+        # Snapshots are the binary store when it exists, JSON otherwise. Every
+        # binary snapshot replaces store.manifest, so its stat identifies the
+        # snapshot (nodes.store for stores older than the manifest).
+        self.format = "binary" if has_binary_store(self.db_path) else "json"
+        if self.format == "binary":
+            manifest = os.path.join(self.db_path, MANIFEST_FILE)
+            self.nodes_file = manifest if os.path.exists(manifest) else os.path.join(self.db_path, NODES_FILE)
+            self.rels_file = self.nodes_file
+        else:
+            self.nodes_file = os.path.join(self.db_path, "nodes.json")
+            self.rels_file = os.path.join(self.db_path, "relationships.json")
+
+    def load_graph(self):
+        # (nodes, relationships) of the snapshot; the binary store decodes
+        # both in one pass over its mapped record arrays
+        if self.format == "binary":
+            with BinaryGraphReader(self.db_path) as reader:
+                return reader.load()
+        return self.load_nodes(), self.load_relationships()
 
     def load_nodes(self):
+        if self.format == "binary":
+            return self.load_graph()[0]
         if not os.path.exists(self.nodes_file):
             return []
         with open(self.nodes_file) as f:
@@ -16,10 +129,11 @@ class GraphStorage:
         return [Node.from_dict(d) for d in data]
 
     def save_nodes(self, nodes):
-        with open(self.nodes_file, 'w') as f:
-            json.dump([n.to_dict() for n in nodes], f, indent=2)
+        self._write_snapshot(self.nodes_file, [n.to_dict() for n in nodes])
 
     def load_relationships(self):
+        if self.format == "binary":
+            return self.load_graph()[1]
         if not os.path.exists(self.rels_file):
             return []
         with open(self.rels_file) as f:
@@ -27,5 +141,108 @@ class GraphStorage:
         return [Relationship.from_dict(d) for d in data]
 
     def save_relationships(self, rels):
-        with open(self.rels_file, 'w') as f:
-            json.dump([r.to_dict() for r in rels], f, indent=2)
+        self._write_snapshot(self.rels_file, [r.to_dict() for r in rels])
+
+    def save_graph(self, nodes, rels):
+        # Full snapshot in the database's format; binary records point at
+        # each other, so nodes and relationships are written together
+        if self.format == "binary":
+            write_binary_store(self.db_path, nodes, rels)
+            # A store older than the manifest is now replaced by one with it
+            self.select_format()
+        else:
+            self.save_json_snapshot(nodes, rels)
+
+    def save_json_snapshot(self, nodes, rels):
+        self._write_snapshot(os.path.join(self.db_path, "nodes.json"), [n.to_dict() for n in nodes])
+        self._write_snapshot(os.path.join(self.db_path, "relationships.json"), [r.to_dict() for r in rels])
+
+    def load_label_index(self):
+        # The label index is only valid for the nodes.json it was saved with
+        if not os.path.exists(self.labels_file) or not os.path.exists(self.nodes_file):
+            return None
+        with open(self.labels_file) as f:
+            data = json.load(f)
+        if data.get("nodes_file") != self._stat_key(self.nodes_file):
+            return None
+        return {label: list(ids) for label, ids in data.get("labels", {}).items()}
+
+    def save_label_index(self, label_index):
+        data = {
+            "nodes_file": self._stat_key(self.nodes_file),
+            "labels": {label: list(ids) for label, ids in label_index.items()}
+        }
+        self._write_snapshot(self.labels_file, data)
+
+    def load_indexes(self):
+        if not os.path.exists(self.indexes_file):
+            return {}
+        with open(self.indexes_file) as f:
+            return json.load(f)
+
+    def save_indexes(self, indexes):
+        data = {
+            label: {
+                prop: {value: list(ids) for value, ids in index.items()}
+                for prop, index in props.items()
+            }
+            for label, props in indexes.items()
+        }
+        self._write_snapshot(self.indexes_file, data)
+
+    def load_schema(self):
+        # Definitions of index types beyond the plain equality indexes in indexes.json
+        if not os.path.exists(self.schema_file):
+            return {}
+        with open(self.schema_file) as f:
+            return json.load(f)
+
+    def save_schema(self, schema):
+        self._write_snapshot(self.schema_file, schema)
+
+    def _stat_key(self, path):
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _write_snapshot(self, path, data):
+        # Write to a temp file and rename, so a crash never leaves a half-written snapshot
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def append_log(self, entries):
+        # One JSON line per mutation; fsync'd so a returned commit is durable
+        with open(self.log_file, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read_log(self):
+        if not os.path.exists(self.log_file):
+            return []
+        entries = []
+        valid_size = 0
+        with open(self.log_file, 'rb') as f:
+            for line in f:
+                # A crash mid-append can leave a torn last line; stop there
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+                valid_size += len(line)
+        if valid_size != os.path.getsize(self.log_file):
+            with open(self.log_file, 'r+b') as f:
+                f.truncate(valid_size)
+        return entries
+
+    def truncate_log(self):
+        if os.path.exists(self.log_file):
+            with open(self.log_file, 'w') as f:
+                f.flush()
+                os.fsync(f.fileno())
@@ -1,21 +1,187 @@
-import threading
-
-class LockManager:
-    def __init__(self):
-        # Locks held: key = resource id (node or rel), value = threading.Lock()
-        self.locks = {}
-        self.locks_mutex = threading.Lock()  # To protect the locks dict itself
-
-    def acquire_lock(self, resource_id):
-        with self.locks_mutex:
-            if resource_id not in self.locks:
-                self.locks[resource_id] = threading.Lock()
-            lock = self.locks[resource_id]
-
-        lock.acquire()
-
-    def release_lock(self, resource_id):
-        with self.locks_mutex:
-            if resource_id in self.locks:
-                lock = self.locks[resource_id]
-                lock.release()
+import time
+import threading
+from contextlib import contextmanager
+
+SHARED = "S"
+EXCLUSIVE = "X"
+
+# Seconds a lock request waits before giving up
+DEFAULT_TIMEOUT = 30.0
+
+
+class LockError(Exception):
+    pass
+
+
+class LockTimeout(LockError):
+    pass
+
+
+class DeadlockError(LockError):
+    pass
+
+
+class _LockEntry:
+    __slots__ = ("holders", "waiting", "exclusive_waiters")
+
+    def __init__(self):
+        self.holders = {}  # owner -> [mode, count]
+        self.waiting = 0
+        self.exclusive_waiters = set()
+
+
+def current_owner():
+    # Statements lock on behalf of the thread running them
+    return threading.get_ident()
+
+
+class LockManager:
+    # Shared/exclusive locks on named resources, held by owners (threads by
+    # default). Locks are re-entrant per owner, and a sole shared holder can
+    # upgrade to exclusive.
+    #
+    # Two-phase locking: once an owner releases a lock completely, it cannot
+    # acquire new ones until it has released everything. Entries are removed
+    # from the lock table as soon as nobody holds or waits for them.
+    #
+    # Waiting requests are recorded in a wait-for graph. A request that would
+    # close a cycle fails immediately with DeadlockError, and one that waits
+    # longer than its timeout fails with LockTimeout.
+    def __init__(self, default_timeout=DEFAULT_TIMEOUT):
+        self.locks = {}
+        self.locks_mutex = threading.Lock()  # To protect the lock table itself
+        self.changed = threading.Condition(self.locks_mutex)
+        self.held = {}  # owner -> {resource: None}
+        self.waiting_for = {}  # owner -> (lock entry, mode) it is waiting for
+        self.shrinking = set()
+        self.default_timeout = default_timeout
+
+    def _blockers(self, entry, owner, mode):
+        others = {other for other, (held_mode, _) in entry.holders.items() if other != owner}
+        if mode == EXCLUSIVE:
+            return others
+        blockers = {other for other in others if entry.holders[other][0] == EXCLUSIVE}
+        # New readers queue behind waiting writers, so writers are not starved
+        if owner not in entry.holders:
+            blockers |= entry.exclusive_waiters - {owner}
+        return blockers
+
+    def _waits_for(self, owner):
+        # Edges of the wait-for graph, computed from the current lock table
+        request = self.waiting_for.get(owner)
+        return self._blockers(request[0], owner, request[1]) if request else ()
+
+    def _has_cycle(self, owner):
+        stack = list(self._waits_for(owner))
+        seen = set()
+        while stack:
+            other = stack.pop()
+            if other == owner:
+                return True
+            if other not in seen:
+                seen.add(other)
+                stack.extend(self._waits_for(other))
+        return False
+
+    def acquire(self, resource, mode=SHARED, owner=None, timeout=None):
+        owner = current_owner() if owner is None else owner
+        timeout = self.default_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self.locks_mutex:
+            if owner in self.shrinking:
+                raise LockError(f"Two-phase locking: {resource!r} requested after a lock was released")
+            entry = self.locks.get(resource)
+            if entry is None:
+                entry = self.locks[resource] = _LockEntry()
+            entry.waiting += 1
+            if mode == EXCLUSIVE:
+                entry.exclusive_waiters.add(owner)
+            try:
+                while True:
+                    blockers = self._blockers(entry, owner, mode)
+                    if not blockers:
+                        break
+                    self.waiting_for[owner] = (entry, mode)
+                    if self._has_cycle(owner):
+                        raise DeadlockError(f"Deadlock detected while waiting for {mode} lock on {resource!r}")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LockTimeout(f"Timed out after {timeout}s waiting for {mode} lock on {resource!r}")
+                    self.changed.wait(remaining)
+            except BaseException:
+                if not entry.holders and entry.waiting == 1:
+                    del self.locks[resource]
+                raise
+            finally:
+                entry.waiting -= 1
+                entry.exclusive_waiters.discard(owner)
+                self.waiting_for.pop(owner, None)
+                # A writer leaving the queue may unblock readers queued behind it
+                self.changed.notify_all()
+            held = entry.holders.get(owner)
+            if held is None:
+                entry.holders[owner] = [mode, 1]
+            else:
+                held[1] += 1
+                if mode == EXCLUSIVE:
+                    held[0] = EXCLUSIVE
+            self.held.setdefault(owner, {})[resource] = None
+
+    def release(self, resource, owner=None):
+        owner = current_owner() if owner is None else owner
+        with self.locks_mutex:
+            entry = self.locks.get(resource)
+            held = entry.holders.get(owner) if entry else None
+            if held is None:
+                raise LockError(f"{resource!r} is not locked by this owner")
+            held[1] -= 1
+            if held[1]:
+                return
+            del entry.holders[owner]
+            if not entry.holders and not entry.waiting:
+                del self.locks[resource]
+            owned = self.held[owner]
+            del owned[resource]
+            if owned:
+                self.shrinking.add(owner)
+            else:
+                # Everything is released: the owner's locking phase is over
+                del self.held[owner]
+                self.shrinking.discard(owner)
+            self.changed.notify_all()
+
+    def release_all(self, owner=None):
+        owner = current_owner() if owner is None else owner
+        with self.locks_mutex:
+            for resource in self.held.pop(owner, {}):
+                entry = self.locks[resource]
+                del entry.holders[owner]
+                if not entry.holders and not entry.waiting:
+                    del self.locks[resource]
+            self.shrinking.discard(owner)
+            self.changed.notify_all()
+
+    @contextmanager
+    def locked(self, resource, mode=SHARED, owner=None, timeout=None):
+        self.acquire(resource, mode, owner, timeout)
+        try:
+            yield
+        finally:
+            self.release(resource, owner)
+
+    def holders(self, resource):
+        with self.locks_mutex:
+            entry = self.locks.get(resource)
+            return {owner: mode for owner, (mode, _) in entry.holders.items()} if entry else {}
+
+    def stats(self):
+        with self.locks_mutex:
+            return {
+                "resources": len(self.locks),
+                "owners": len(self.held),
+                "waiting": sum(entry.waiting for entry in self.locks.values())
+            }
+
+
+# Shared by the query engine, the resident graphs and transactions
+lock_manager = LockManager()
@@ -42,6 +42,10 @@ def main_db_page():
             st.error(result["error"])
         else:
             show_graph_and_list(result)
+            if "plan" in result:
+                # EXPLAIN / PROFILE: one row per operator, in pipeline order
+                st.markdown("### Query Plan")
+                st.table(result["plan"])
             st.markdown(f"⏱️ Query executed in **{exec_time:.3f} seconds**")
 
     st.divider()
@@ -50,6 +54,7 @@ def main_db_page():
     with st.form("add_index_form"):
         label = st.text_input("Entity Label (e.g., Person)")
         prop = st.text_input("Property to Index (e.g., name)")
+        index_type = st.selectbox("Index Type", ["hash", "range"], help="range also serves <, >, <=, >= in WHERE")
         if st.form_submit_button("Add Index"):
             index_path = f"databases/{db}/indexes.json"
             if os.path.exists(index_path):
@@ -58,8 +63,8 @@ def main_db_page():
             else:
                 indexes = {}
 
-            create_index(os.path.join("databases", db), label, prop)
-            st.success(f"Index created for `{label}.{prop}`")
+            create_index(os.path.join("databases", db), label, prop, index_type)
+            st.success(f"{index_type.capitalize()} index created for `{label}.{prop}`")
 
     st.divider()
 
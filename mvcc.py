@@ -0,0 +1,299 @@
+from bisect import bisect_left
+from collections.abc import Mapping
+from contextlib import nullcontext
+from itertools import chain, islice, takewhile
+from graph_cache import get_graph, identity_key, expand_edges
+from lock_manager import lock_manager, SHARED, EXCLUSIVE
+from range_index import order_key, compare_keys
+
+# Snapshot-isolated transactions over the resident graph.
+#
+# Entities are only ever appended, so an entity's slot doubles as its version:
+# a snapshot is just the node and relationship counts at BEGIN, and a
+# committed entity is visible to a transaction iff its slot is below them.
+# BEGIN therefore copies nothing. Writes go to the transaction's own write
+# set and reach the shared graph (and its write-ahead log) only on COMMIT.
+# Existing nodes only change when a procedure writes properties back
+# (CALL algo.* with writeProperty); transactions open at that point fail.
+#
+# Find-or-create (MERGE, and the dedup in CREATE) reads "absence". A
+# transaction remembers every identity lookup that missed and every
+# relationship list it searched. COMMIT fails with TransactionConflict if a
+# concurrent commit has since added a match for any of them (first committer
+# wins), instead of letting both sides create a duplicate.
+
+
+class TransactionError(Exception):
+    pass
+
+
+class TransactionConflict(TransactionError):
+    pass
+
+
+class VisibleNodes(Mapping):
+    # node_by_id as seen by a snapshot
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def get(self, node_id, default=None):
+        snapshot = self.snapshot
+        node = snapshot._base().node_by_id.get(node_id) if node_id is not None else None
+        if node is not None and node.slot < snapshot.node_limit:
+            return node
+        return snapshot.own_nodes.get(node_id, default)
+
+    def __getitem__(self, node_id):
+        node = self.get(node_id)
+        if node is None:
+            raise KeyError(node_id)
+        return node
+
+    def __iter__(self):
+        return (node.id for node in self.snapshot.scan_nodes())
+
+    def __len__(self):
+        return self.snapshot.node_count()
+
+
+class SnapshotGraph:
+    # Graph interface that queries inside a transaction run against: the
+    # resident graph as of BEGIN plus the transaction's uncommitted writes
+    def __init__(self, graph):
+        self.graph = graph
+        self.db_path = graph.db_path
+        self.lock = graph.lock
+        self.resource = graph.resource
+        self.generation = graph.generation
+        self.property_version = graph.property_version
+        self.node_limit = len(graph.nodes)
+        self.rel_limit = len(graph.relationships)
+        # Write set
+        self.new_nodes = []
+        self.new_relationships = []
+        self.own_nodes = {}
+        self.own_labels = {}
+        self.own_identity = {}
+        self.own_out = {}
+        self.own_in = {}
+        # Read set checked at commit
+        self.missed_identities = set()
+        self.read_edges = set()
+        self.node_by_id = VisibleNodes(self)
+        self.closed = False
+
+    @property
+    def schema_version(self):
+        return self.graph.schema_version
+
+    def _base(self):
+        if self.closed:
+            raise TransactionError("The transaction is no longer active")
+        if self.graph.generation != self.generation:
+            raise TransactionConflict("The database was reloaded from disk during the transaction")
+        if self.graph.property_version != self.property_version:
+            raise TransactionConflict("Node properties were rewritten by a procedure during the transaction")
+        return self.graph
+
+    def _visible_ids(self, node_ids):
+        base = self._base()
+        return [node_id for node_id in node_ids if base.node_by_id[node_id].slot < self.node_limit]
+
+    def _own_with_label(self, label, predicate):
+        return [node.id for node in self.own_labels.get(label, ()) if predicate(node)]
+
+    # -- reads --
+
+    def node_count(self):
+        return self.node_limit + len(self.new_nodes)
+
+    def scan_nodes(self, offset=0):
+        base = self._base()
+        limit = self.node_limit
+        return chain(
+            islice(base.nodes, min(offset, limit), limit),
+            islice(self.new_nodes, max(0, offset - limit), None)
+        )
+
+    def scan_relationships(self):
+        return chain(islice(self._base().relationships, 0, self.rel_limit), self.new_relationships)
+
+    def label_count(self, label):
+        postings = self._base().label_index.get(label, ())
+        return bisect_left(postings, self.node_limit) + len(self.own_labels.get(label, ()))
+
+    def scan_label(self, label, offset=0):
+        # Label postings are in slot order, so the snapshot is a prefix
+        base = self._base()
+        postings = base.label_index.get(label, ())
+        end = bisect_left(postings, self.node_limit)
+        nodes = base.nodes
+        for slot in islice(postings, min(offset, end), end):
+            yield nodes[slot]
+        yield from islice(self.own_labels.get(label, ()), max(0, offset - end), None)
+
+    def nodes_with_label(self, label):
+        return list(self.scan_label(label))
+
+    def has_index(self, label, prop):
+        return self._base().has_index(label, prop)
+
+    def has_range_index(self, label, prop):
+        return self._base().has_range_index(label, prop)
+
+    def estimate_seek(self, label, props):
+        return self._base().estimate_seek(label, props)
+
+    def seek_indexes(self, label, props):
+        return self._base().seek_indexes(label, props)
+
+    def range_count(self, label, prop, operator, value):
+        return self._base().range_count(label, prop, operator, value)
+
+    def range_count_between(self, label, prop, lower, upper):
+        return self._base().range_count_between(label, prop, lower, upper)
+
+    def index_lookup(self, label, prop, value):
+        return self._visible_ids(self._base().index_lookup(label, prop, value)) + self._own_with_label(
+            label, lambda node: str(node.get_property(prop)) == str(value))
+
+    def seek(self, label, props):
+        node_ids = self._base().seek(label, props)
+        if node_ids is None:
+            return None
+        return self._visible_ids(node_ids) + self._own_with_label(
+            label, lambda node: all(str(node.get_property(key)) == str(value) for key, value in props.items()))
+
+    def range_scan(self, label, prop, operator, value):
+        key = order_key(value)
+
+        def matches(node):
+            own_value = node.get_property(prop)
+            return own_value is not None and compare_keys(order_key(own_value), operator, key)
+        return self._visible_ids(self._base().range_scan(label, prop, operator, value)) + self._own_with_label(label, matches)
+
+    def range_scan_between(self, label, prop, lower, upper):
+        bounds = [
+            (order_key(lower[0]), ">=" if lower[1] else ">"),
+            (order_key(upper[0]), "<=" if upper[1] else "<")
+        ]
+
+        def matches(node):
+            own_value = node.get_property(prop)
+            return own_value is not None and all(
+                compare_keys(order_key(own_value), operator, key) for key, operator in bounds)
+        return self._visible_ids(self._base().range_scan_between(label, prop, lower, upper)) + self._own_with_label(label, matches)
+
+    def find_identical(self, label, props):
+        key = identity_key(label, props)
+        node = self.own_identity.get(key)
+        if node is None:
+            node = self.node_by_id.get(self._base().identity_index.get(key))
+        if node is None:
+            self.missed_identities.add(key)
+        return node
+
+    def outgoing(self, node_id, rel_type):
+        self.read_edges.add((node_id, rel_type))
+        rel_limit = self.rel_limit
+        visible = list(takewhile(lambda rel: rel.slot < rel_limit, self._base().outgoing(node_id, rel_type)))
+        return visible + self.own_out.get(node_id, {}).get(rel_type, [])
+
+    def incoming(self, node_id, rel_type):
+        rel_limit = self.rel_limit
+        visible = list(takewhile(lambda rel: rel.slot < rel_limit, self._base().incoming(node_id, rel_type)))
+        return visible + self.own_in.get(node_id, {}).get(rel_type, [])
+
+    def expand(self, node_id, rel_types, direction):
+        base = self._base()
+        rel_limit = self.rel_limit
+        for rel, other_id in base.expand(node_id, rel_types, direction):
+            if rel.slot < rel_limit:
+                yield rel, other_id
+        yield from expand_edges(self.own_out, self.own_in, node_id, rel_types, direction)
+
+    # -- writes (kept in the write set until Transaction.commit) --
+
+    def add_node(self, node):
+        self._base()
+        self.new_nodes.append(node)
+        self.own_nodes[node.id] = node
+        for label in node.labels:
+            self.own_labels.setdefault(label, []).append(node)
+            self.own_identity.setdefault(identity_key(label, node.properties), node)
+
+    def add_relationship(self, rel):
+        self._base()
+        self.new_relationships.append(rel)
+        self.own_out.setdefault(rel.start_node, {}).setdefault(rel.rel_type, []).append(rel)
+        self.own_in.setdefault(rel.end_node, {}).setdefault(rel.rel_type, []).append(rel)
+
+    def commit(self):
+        # End of a statement; nothing is persisted before the transaction commits
+        pass
+
+    def batch(self):
+        return nullcontext(self)
+
+
+class Transaction:
+    def __init__(self, db_path):
+        # O(1): the snapshot is two counters, not a copy of the data
+        self.db_path = db_path
+        graph = get_graph(db_path)
+        with lock_manager.locked(graph.resource, SHARED):
+            self.view = SnapshotGraph(graph)
+
+    @property
+    def active(self):
+        return not self.view.closed
+
+    @property
+    def changes(self):
+        return len(self.view.new_nodes) + len(self.view.new_relationships)
+
+    def commit(self):
+        # Validates the read set and applies the write set: O(changes)
+        # Commit is the transaction's lock point: it holds the database
+        # exclusively while validating and applying, then releases everything
+        view = self.view
+        with lock_manager.locked(view.resource, EXCLUSIVE):
+            graph = get_graph(self.db_path)
+            try:
+                view._base()
+                conflicts = self._conflicts(graph)
+                if conflicts:
+                    raise TransactionConflict("; ".join(conflicts))
+            except TransactionConflict:
+                view.closed = True
+                raise
+            with graph.batch():
+                for node in view.new_nodes:
+                    graph.add_node(node)
+                for rel in view.new_relationships:
+                    graph.add_relationship(rel)
+            view.closed = True
+        return {"nodes": len(view.new_nodes), "relationships": len(view.new_relationships)}
+
+    def rollback(self):
+        self.view.closed = True
+        self.view.new_nodes = []
+        self.view.new_relationships = []
+
+    def _conflicts(self, graph):
+        view = self.view
+        conflicts = []
+        for key in view.missed_identities:
+            node_id = graph.identity_index.get(key)
+            if node_id is not None and graph.node_by_id[node_id].slot >= view.node_limit:
+                label, props = key
+                conflicts.append(f"(:{label} {dict(props)}) was created by a concurrent transaction")
+        for node_id, rel_type in view.read_edges:
+            rels = graph.outgoing(node_id, rel_type)
+            if rels and rels[-1].slot >= view.rel_limit:
+                conflicts.append(f"[:{rel_type}] relationships of node {node_id} were changed by a concurrent transaction")
+        return conflicts
+
+
+def begin_transaction(db_path):
+    return Transaction(db_path)
@@ -0,0 +1,278 @@
+import os
+import sys
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from graph_cache import CachedGraph, get_graph, loaded_graph
+from graph_entities import Node, Relationship, Path
+
+# Partitioned parallel execution of MATCH plans that start with a node scan.
+#
+# The scan's range (node slots, or positions in a label's posting list) is cut
+# into partitions, and each partition runs the whole operator pipeline (scan,
+# filters, expansions) on a worker. Partition results are put back together in
+# scan order, so the rows come out exactly as a serial run produces them.
+#
+# Workers are processes, since pure-Python operators do not run in parallel
+# under the GIL. A worker keeps its own resident copy of each database and
+# sends back entity ids that the caller maps to its own Node / Relationship
+# objects. Loading that copy costs as much as a cold start of the database,
+# so a query never waits for it: until every worker holds the state the
+# caller sees (see CachedGraph.disk_state), queries run serially and the
+# workers load the current state in the background (warm_up). A write makes
+# the copies stale again, and the next queries run serially while they
+# reload. On a free-threaded Python build the workers are threads that share
+# the caller's graph directly, and nothing needs loading.
+#
+# The degree of parallelism comes from GRAPH_DB_PARALLELISM (default: the
+# number of cores) and can be changed with set_parallelism(); 1 turns
+# parallel execution off.
+
+# Scans smaller than this run serially; the hand-off costs more than it saves
+MIN_PARALLEL_ROWS = int(os.environ.get("GRAPH_DB_PARALLEL_MIN_ROWS", 50000))
+# More partitions than workers, so one slow partition does not hold up the rest
+PARTITIONS_PER_WORKER = 4
+
+
+class StaleSnapshot(Exception):
+    # A worker's copy of the database does not match the caller's
+    pass
+
+
+def free_threaded():
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def _default_parallelism():
+    configured = os.environ.get("GRAPH_DB_PARALLELISM")
+    return max(1, int(configured)) if configured else (os.cpu_count() or 1)
+
+
+_parallelism = _default_parallelism()
+_executor = None
+_executor_lock = threading.Lock()
+# Database path -> disk state every worker of the pool has loaded
+_warm = {}
+# Database path -> disk state being loaded by the workers
+_warming = {}
+
+
+def set_parallelism(workers, min_rows=None):
+    # Number of workers used per query (1 = serial); takes effect on the next query
+    global _parallelism, _executor, MIN_PARALLEL_ROWS
+    with _executor_lock:
+        _parallelism = max(1, int(workers))
+        if min_rows is not None:
+            MIN_PARALLEL_ROWS = min_rows
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+        _warm.clear()
+        _warming.clear()
+
+
+def parallelism():
+    return _parallelism
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if free_threaded():
+                _executor = ThreadPoolExecutor(max_workers=_parallelism, thread_name_prefix="graph-scan")
+            else:
+                # Not fork: the parent runs other threads that may hold locks
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                _executor = ProcessPoolExecutor(max_workers=_parallelism, mp_context=multiprocessing.get_context(method))
+        return _executor
+
+
+def _discard_executor(executor):
+    # A worker died; the next query starts a fresh pool
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+            _warm.clear()
+            _warming.clear()
+
+
+def use_parallel(graph, size):
+    return (
+        _parallelism > 1 and size >= MIN_PARALLEL_ROWS
+        # Transactions run against a snapshot the workers cannot see
+        and isinstance(graph, CachedGraph)
+        and (free_threaded() or warm_up(graph))
+    )
+
+
+def warm_up(graph, wait_loaded=False):
+    # True when every worker holds the caller's state of the graph. Otherwise
+    # the workers start loading it (one load per database at a time) and
+    # False is returned, or with wait_loaded, the result once they are done.
+    key = os.path.abspath(graph.db_path)
+    state = graph.disk_state()
+    if state is None:
+        # Writes not logged yet are invisible to the workers
+        return False
+    with _executor_lock:
+        if _warm.get(key) == state:
+            return True
+        loading = key in _warming
+        if not loading:
+            _warming[key] = state
+    if loading:
+        return False
+    executor = _get_executor()
+    try:
+        futures = [executor.submit(_prepare, key) for _ in range(_parallelism)]
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        return False
+    if wait_loaded:
+        wait(futures)
+        return _warmed(executor, key, state, futures)
+
+    def done(_):
+        if all(future.done() for future in futures):
+            _warmed(executor, key, state, futures)
+    for future in futures:
+        future.add_done_callback(done)
+    return False
+
+
+def _warmed(executor, key, state, futures):
+    # A pool whose workers all reported `state` is warm; a write in the
+    # meantime leaves it cold until the next warm-up
+    loaded = all(not future.cancelled() and future.exception() is None and future.result() == state
+                 for future in futures)
+    with _executor_lock:
+        if _warming.get(key) == state:
+            del _warming[key]
+        if loaded and _executor is executor:
+            _warm[key] = state
+    return loaded
+
+
+def partitions(size, workers):
+    count = min(size, workers * PARTITIONS_PER_WORKER)
+    bounds = [size * i // count for i in range(count + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _run_partition(ctx, operators, start, stop):
+    rows = operators[0].apply(ctx, iter([{}]), offset=start, stop=stop)
+    for operator in operators[1:]:
+        rows = operator.apply(ctx, rows)
+    return rows
+
+
+def _counted_partition(graph, operators, params, limits, start, stop, encode=None):
+    # Rows of a partition run on a context of its own, and the relationship
+    # expansions it made; the caller charges those to the query's budget
+    from query_planner import ExecutionContext
+    ctx = ExecutionContext(graph, params, limits)
+    rows = _run_partition(ctx, operators, start, stop)
+    if encode is not None:
+        rows = ({var: encode(value) for var, value in row.items()} for row in rows)
+    return list(rows), ctx.expansions
+
+
+def _encode(value):
+    # Entities travel as ids; rows produced by MATCH hold nothing else than
+    # entities, lists of relationships and paths
+    if isinstance(value, Node):
+        return "n", value.id
+    if isinstance(value, Relationship):
+        return "r", value.id
+    if isinstance(value, Path):
+        return "p", [_encode(node) for node in value.nodes], [_encode(rel) for rel in value.relationships]
+    return "l", [_encode(item) for item in value]
+
+
+def _prepare(db_path):
+    # Runs inside a worker process: loads or refreshes its copy
+    return get_graph(db_path).disk_state()
+
+
+def _process_partition(db_path, expected, operators, params, limits, start, stop):
+    # Runs inside a worker process; a copy that would need loading first is
+    # stale, and the caller runs the partition itself
+    graph = loaded_graph(db_path)
+    if graph is None or graph.disk_state() != expected:
+        raise StaleSnapshot(db_path)
+    return _counted_partition(graph, operators, params, limits, start, stop, _encode)
+
+
+def _cooled(graph):
+    # A worker missed the caller's state, so the pool is not warm for it
+    with _executor_lock:
+        _warm.pop(os.path.abspath(graph.db_path), None)
+
+
+def _decode(graph, encoded):
+    kind = encoded[0]
+    if kind == "n":
+        return graph.node_by_id[encoded[1]]
+    if kind == "r":
+        return graph.rel_by_id[encoded[1]]
+    if kind == "p":
+        return Path([_decode(graph, node) for node in encoded[1]], [_decode(graph, rel) for rel in encoded[2]])
+    return [_decode(graph, item) for item in encoded[1]]
+
+
+def parallel_rows(operators, ctx, size, limits=None):
+    # Yields the rows of the pipeline, partitions running concurrently. `ctx`
+    # is the query's context: per-query limits such as max_expansions are
+    # enforced on the sum over all partitions, as a serial run would.
+    graph, params = ctx.graph, ctx.params
+    executor = _get_executor()
+    ranges = partitions(size, _parallelism)
+    threads = isinstance(executor, ThreadPoolExecutor)
+    db_path = os.path.abspath(graph.db_path)
+    expected = graph.disk_state()
+    try:
+        if threads:
+            futures = [executor.submit(_counted_partition, graph, operators, params, limits, *bounds)
+                       for bounds in ranges]
+        else:
+            futures = [executor.submit(_process_partition, db_path, expected, operators, params, limits, *bounds)
+                       for bounds in ranges]
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        futures = []
+    try:
+        yield from _collect(ctx, operators, ranges, futures, executor, threads)
+    finally:
+        # The consumer may stop early, or the query ran out of its budget
+        for future in futures:
+            future.cancel()
+
+
+def _collect(ctx, operators, ranges, futures, executor, threads):
+    graph = ctx.graph
+    for bounds, future in zip(ranges, futures):
+        try:
+            rows, expansions = future.result()
+        except (StaleSnapshot, BrokenProcessPool) as e:
+            # The worker died, or cannot see what the caller sees (writes of a
+            # running script not yet logged, a checkpoint in progress): run the
+            # partition here instead, on the query's own context
+            if isinstance(e, BrokenProcessPool):
+                _discard_executor(executor)
+            else:
+                _cooled(graph)
+            yield from _run_partition(ctx, operators, *bounds)
+            continue
+        # Raises once the partitions so far went over the query's limit
+        ctx.expanded(expansions)
+        if threads:
+            yield from rows
+        else:
+            for encoded in rows:
+                yield {var: _decode(graph, value) for var, value in encoded.items()}
+    for bounds in ranges[len(futures):]:
+        yield from _run_partition(ctx, operators, *bounds)
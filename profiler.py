@@ -0,0 +1,160 @@
+import time
+
+# Instrumentation behind PROFILE.
+#
+# Every stage of a plan (the operators, then projection / aggregation, sort
+# and limit) is a generator pulling rows from the stage before it. The
+# profiler wraps each one and times the calls into it, which gives the time
+# spent in that stage and everything upstream of it; a stage's own time is
+# that minus the upstream stage's. While a stage runs it is the "current"
+# one, and storage reads made on its behalf count as its db hits: entities
+# produced by scans, expansions and index lookups, lookups by id, property
+# reads and the column values read by vectorised filters. Reads go through
+# ProfiledGraph, a proxy around the real graph, so nothing is counted
+# outside of PROFILE.
+
+
+class StageStats:
+    def __init__(self, operator, details, index=None, estimated_rows=None):
+        self.operator = operator
+        self.details = details
+        self.index = index
+        self.estimated_rows = estimated_rows
+        self.rows = 0
+        self.db_hits = 0
+        self.elapsed = 0.0
+
+
+class Profiler:
+    def __init__(self):
+        self.stages = []
+        self.current = None
+
+    def hit(self, count=1):
+        if self.current is not None:
+            self.current.db_hits += count
+
+    def wrap(self, description, rows):
+        # description: (operator, details, index, estimated rows)
+        stats = StageStats(*description)
+        self.stages.append(stats)
+        return self._timed(stats, rows)
+
+    def _timed(self, stats, rows):
+        clock = time.perf_counter
+        rows = iter(rows)
+        while True:
+            previous, self.current = self.current, stats
+            started = clock()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                stats.elapsed += clock() - started
+                self.current = previous
+            stats.rows += 1
+            yield row
+
+    def report(self):
+        # One entry per stage, in pipeline order (the first produces rows)
+        entries = []
+        upstream = 0.0
+        for stats in self.stages:
+            entries.append({
+                "operator": stats.operator,
+                "details": stats.details,
+                "rows": stats.rows,
+                "estimated_rows": stats.estimated_rows,
+                "db_hits": stats.db_hits,
+                "time_ms": round(max(stats.elapsed - upstream, 0.0) * 1000, 3),
+                "index": stats.index
+            })
+            upstream = stats.elapsed
+        return entries
+
+
+class _CountingSequence:
+    # node_by_id / nodes of the profiled graph: every lookup is a db hit
+    def __init__(self, target, profiler):
+        self.target = target
+        self.profiler = profiler
+
+    def __getitem__(self, key):
+        self.profiler.hit()
+        return self.target[key]
+
+    def get(self, key, default=None):
+        self.profiler.hit()
+        return self.target.get(key, default)
+
+    def __len__(self):
+        return len(self.target)
+
+
+class _CountingColumns:
+    def __init__(self, columns, graph, profiler):
+        self.columns = columns
+        self.graph = graph
+        self.profiler = profiler
+
+    def select(self, label, programs, constant, start=0, stop=None):
+        # Every program reads one value per node of the range
+        count = self.graph.label_count(label)
+        stop = count if stop is None else min(stop, count)
+        self.profiler.hit(max(stop - start, 0) * len(programs))
+        return self.columns.select(label, programs, constant, start, stop)
+
+
+class ProfiledGraph:
+    def __init__(self, graph, profiler):
+        self._graph = graph
+        self._profiler = profiler
+        self.node_by_id = _CountingSequence(graph.node_by_id, profiler)
+
+    def __getattr__(self, name):
+        return getattr(self._graph, name)
+
+    @property
+    def nodes(self):
+        return _CountingSequence(self._graph.nodes, self._profiler)
+
+    @property
+    def columns(self):
+        columns = getattr(self._graph, "columns", None)
+        return None if columns is None else _CountingColumns(columns, self._graph, self._profiler)
+
+    def _count(self, items):
+        hit = self._profiler.hit
+        for item in items:
+            hit()
+            yield item
+
+    def _counted(self, found):
+        # An index lookup, plus one hit per entry it returns
+        self._profiler.hit(1 + len(found or ()))
+        return found
+
+    def scan_nodes(self, offset=0):
+        return self._count(self._graph.scan_nodes(offset))
+
+    def scan_label(self, label, offset=0):
+        return self._count(self._graph.scan_label(label, offset))
+
+    def scan_relationships(self):
+        return self._count(self._graph.scan_relationships())
+
+    def expand(self, node_id, rel_types, direction):
+        return self._count(self._graph.expand(node_id, rel_types, direction))
+
+    def seek(self, label, props):
+        return self._counted(self._graph.seek(label, props))
+
+    def index_lookup(self, label, prop, value):
+        return self._counted(self._graph.index_lookup(label, prop, value))
+
+    def range_scan(self, label, prop, operator, value):
+        return self._counted(self._graph.range_scan(label, prop, operator, value))
+
+    def range_scan_between(self, label, prop, lower, upper):
+        return self._counted(self._graph.range_scan_between(label, prop, lower, upper))
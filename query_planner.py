@@ -0,0 +1,1650 @@
+import math
+import time
+import heapq
+import threading
+from collections import OrderedDict
+from itertools import islice
+from lock_manager import lock_manager, SHARED
+from parallel import use_parallel, parallel_rows
+import columnar
+from graph_entities import Node, Relationship, Path
+from range_index import order_key, compare_keys
+from profiler import Profiler, ProfiledGraph
+from cypher_parser import (
+    parse, normalize, to_text, display_name, MatchClause, ReturnClause, PathPattern, Literal, Parameter,
+    Variable, Property, BinaryOp, UnaryOp, IsNull, FunctionCall, ListLiteral, MapLiteral, Star
+)
+
+
+class QueryError(ValueError):
+    pass
+
+
+# Traversal limits of a query, unless it passes its own `limits`:
+# max_depth caps variable-length and shortest paths (and is the bound of an
+# open-ended -[*]-), max_expansions caps the relationships they follow
+DEFAULT_MAX_DEPTH = 15
+DEFAULT_MAX_EXPANSIONS = 1000000
+
+
+class ExecutionContext:
+    def __init__(self, graph, params=None, limits=None, profiler=None):
+        # Under PROFILE, storage reads go through a proxy that counts them
+        self.graph = graph if profiler is None else ProfiledGraph(graph, profiler)
+        self.profiler = profiler
+        self.params = params or {}
+        limits = dict(limits or {})
+        self.max_depth = limits.pop("max_depth", DEFAULT_MAX_DEPTH)
+        self.max_expansions = limits.pop("max_expansions", DEFAULT_MAX_EXPANSIONS)
+        if limits:
+            raise QueryError(f"Unknown query limit: {sorted(limits)[0]}")
+        for name in ("max_depth", "max_expansions"):
+            value = getattr(self, name)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise QueryError(f"{name} must be a non-negative integer, got {value!r}")
+        self.expansions = 0
+
+    def expanded(self, count=1):
+        # Called by traversals for every relationship they follow
+        self.expansions += count
+        if self.expansions > self.max_expansions:
+            raise QueryError(f"Traversal stopped after {self.max_expansions} relationship expansions (max_expansions)")
+
+    def depth_limit(self, max_hops):
+        if max_hops is None:
+            return self.max_depth
+        if max_hops > self.max_depth:
+            raise QueryError(f"Path length {max_hops} exceeds the depth limit of {self.max_depth} (max_depth)")
+        return max_hops
+
+
+# ---- Expression evaluation ----
+
+def compare(left, op, right):
+    # Cypher-style: comparisons with null are null; entities compare by identity
+    if left is None or right is None:
+        return None
+    if isinstance(left, (Node, Relationship)) or isinstance(right, (Node, Relationship)):
+        if op == "=":
+            return left is right
+        if op == "<>":
+            return left is not right
+        return None
+    if isinstance(left, list) or isinstance(right, list):
+        if op == "=":
+            return left == right
+        if op == "<>":
+            return left != right
+        return None
+    return compare_keys(order_key(left), "!=" if op == "<>" else op, order_key(right))
+
+
+def arithmetic(op, left, right):
+    if left is None or right is None:
+        return None
+    try:
+        if op == "+":
+            if isinstance(left, list) or isinstance(right, list):
+                return (left if isinstance(left, list) else [left]) + (right if isinstance(right, list) else [right])
+            if isinstance(left, str) or isinstance(right, str):
+                return f"{left}{right}"
+            return left + right
+        if op == "-":
+            return left - right
+        if op == "*":
+            return left * right
+        if op == "/":
+            if isinstance(left, int) and isinstance(right, int):
+                return int(left / right)
+            return left / right
+        if op == "%":
+            return left % right
+    except (TypeError, ZeroDivisionError) as e:
+        raise QueryError(f"Cannot evaluate {left!r} {op} {right!r}: {e}")
+
+
+def evaluate(expr, row, ctx):
+    if isinstance(expr, Literal):
+        return expr.value
+    if isinstance(expr, Variable):
+        try:
+            return row[expr.name]
+        except KeyError:
+            raise QueryError(f"Variable '{expr.name}' not defined")
+    if isinstance(expr, Parameter):
+        try:
+            return ctx.params[expr.name]
+        except KeyError:
+            raise QueryError(f"Expected parameter ${expr.name}")
+    if isinstance(expr, Property):
+        subject = evaluate(expr.subject, row, ctx)
+        if subject is None:
+            return None
+        if isinstance(subject, (Node, Relationship)):
+            if ctx.profiler is not None:
+                ctx.profiler.hit()
+            return subject.get_property(expr.key)
+        if isinstance(subject, dict):
+            return subject.get(expr.key)
+        raise QueryError(f"Cannot read property '{expr.key}' of {subject!r}")
+    if isinstance(expr, BinaryOp):
+        op = expr.op
+        if op in ("AND", "OR", "XOR"):
+            return logical(op, evaluate(expr.left, row, ctx), lambda: evaluate(expr.right, row, ctx))
+        left = evaluate(expr.left, row, ctx)
+        right = evaluate(expr.right, row, ctx)
+        if op in ("=", "<>", "<", ">", "<=", ">="):
+            return compare(left, op, right)
+        if op == "IN":
+            if right is None or left is None:
+                return None
+            return any(compare(left, "=", item) for item in right)
+        if left is None or right is None:
+            return None
+        if op == "CONTAINS":
+            return str(right) in str(left)
+        if op == "STARTS WITH":
+            return str(left).startswith(str(right))
+        if op == "ENDS WITH":
+            return str(left).endswith(str(right))
+        return arithmetic(op, left, right)
+    if isinstance(expr, UnaryOp):
+        value = evaluate(expr.operand, row, ctx)
+        if value is None:
+            return None
+        if expr.op == "NOT":
+            return not value
+        return -value
+    if isinstance(expr, IsNull):
+        is_null = evaluate(expr.operand, row, ctx) is None
+        return not is_null if expr.negated else is_null
+    if isinstance(expr, FunctionCall):
+        function = functions.get(expr.name)
+        if function is None:
+            if expr.name in aggregate_functions:
+                raise QueryError(f"Aggregate function {expr.name}() can only be used in RETURN and ORDER BY")
+            raise QueryError(f"Unknown function '{expr.name}'")
+        return function(ctx, *[evaluate(arg, row, ctx) for arg in expr.args])
+    if isinstance(expr, ListLiteral):
+        return [evaluate(item, row, ctx) for item in expr.items]
+    if isinstance(expr, MapLiteral):
+        return {key: evaluate(value, row, ctx) for key, value in expr.items.items()}
+    raise QueryError(f"Cannot evaluate {type(expr).__name__}")
+
+
+def logical(op, left, right_thunk):
+    # Three-valued logic, short-circuiting where the result is already known
+    if op == "AND":
+        if left is False:
+            return False
+        right = right_thunk()
+        if right is False:
+            return False
+        return None if left is None or right is None else True
+    if op == "OR":
+        if left is True:
+            return True
+        right = right_thunk()
+        if right is True:
+            return True
+        return None if left is None or right is None else False
+    right = right_thunk()
+    if left is None or right is None:
+        return None
+    return bool(left) != bool(right)
+
+
+def _to_number(value, cast):
+    if value is None:
+        return None
+    try:
+        return cast(float(value)) if cast is int else cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+functions = {
+    "id": lambda ctx, entity: None if entity is None else entity.id,
+    "labels": lambda ctx, node: None if node is None else sorted(node.labels),
+    "type": lambda ctx, rel: None if rel is None else rel.rel_type,
+    "keys": lambda ctx, entity: None if entity is None else list(
+        entity.properties if isinstance(entity, (Node, Relationship)) else entity),
+    "properties": lambda ctx, entity: None if entity is None else dict(
+        entity.properties if isinstance(entity, (Node, Relationship)) else entity),
+    "startnode": lambda ctx, rel: None if rel is None else ctx.graph.node_by_id.get(rel.start_node),
+    "endnode": lambda ctx, rel: None if rel is None else ctx.graph.node_by_id.get(rel.end_node),
+    "nodes": lambda ctx, path: None if path is None else list(path.nodes),
+    "relationships": lambda ctx, value: None if value is None else list(
+        value.relationships if isinstance(value, Path) else value),
+    "size": lambda ctx, value: None if value is None else len(value),
+    "length": lambda ctx, value: None if value is None else len(value),
+    "tolower": lambda ctx, value: None if value is None else str(value).lower(),
+    "toupper": lambda ctx, value: None if value is None else str(value).upper(),
+    "trim": lambda ctx, value: None if value is None else str(value).strip(),
+    "tostring": lambda ctx, value: None if value is None else str(value),
+    "tointeger": lambda ctx, value: _to_number(value, int),
+    "tofloat": lambda ctx, value: _to_number(value, float),
+    "abs": lambda ctx, value: None if value is None else abs(value),
+    "coalesce": lambda ctx, *values: next((value for value in values if value is not None), None),
+}
+
+
+def variables_in(expr):
+    # Names of the query variables an expression depends on
+    if isinstance(expr, Variable):
+        return {expr.name}
+    if isinstance(expr, Property):
+        return variables_in(expr.subject)
+    if isinstance(expr, BinaryOp):
+        return variables_in(expr.left) | variables_in(expr.right)
+    if isinstance(expr, (UnaryOp, IsNull)):
+        return variables_in(expr.operand)
+    if isinstance(expr, FunctionCall):
+        return set().union(*[variables_in(arg) for arg in expr.args])
+    if isinstance(expr, ListLiteral):
+        return set().union(*[variables_in(item) for item in expr.items])
+    if isinstance(expr, MapLiteral):
+        return set().union(*[variables_in(value) for value in expr.items.values()])
+    return set()
+
+
+def is_constant(expr):
+    # Known before the first row is produced: literals and parameters
+    return isinstance(expr, (Literal, Parameter)) or (isinstance(expr, UnaryOp) and expr.op == "-" and is_constant(expr.operand))
+
+
+def split_conjuncts(expr):
+    if expr is None:
+        return []
+    if isinstance(expr, BinaryOp) and expr.op == "AND":
+        return split_conjuncts(expr.left) + split_conjuncts(expr.right)
+    return [expr]
+
+
+def props_match(entity, props, ctx, row):
+    # Inline pattern maps compare as strings, like the property indexes do
+    for key, expr in props.items():
+        if ctx.profiler is not None:
+            ctx.profiler.hit()
+        if str(entity.get_property(key)) != str(evaluate(expr, row, ctx)):
+            return False
+    return True
+
+
+def node_text(var, label=None, props=None):
+    label = f":{label}" if label else ""
+    props = f" {to_text(MapLiteral(props))}" if props else ""
+    return f"({display_name(var)}{label}{props})"
+
+
+def hops_text(min_hops, max_hops):
+    return f"*{min_hops}..{'' if max_hops is None else max_hops}"
+
+
+def rel_text(from_var, rel_var, to_var, types, direction, hops=""):
+    types = ":" + "|".join(types) if types else ""
+    left = "<-" if direction == "in" else "-"
+    right = "->" if direction == "out" else "-"
+    return f"({display_name(from_var)}){left}[{display_name(rel_var)}{types}{hops}]{right}({display_name(to_var)})"
+
+
+# ---- Physical operators ----
+# Each operator takes an iterator of rows (dicts of variable -> value) and
+# lazily yields the rows it produces, so a plan is a pipeline of generators.
+
+class AllNodesScan:
+    # Scans accept an offset so that a SKIP directly above them is pushed
+    # down, and a stop so that parallel execution can split them into ranges
+    def __init__(self, var):
+        self.var = var
+
+    def size(self, ctx):
+        return ctx.graph.node_count()
+
+    def describe(self, graph):
+        return "AllNodesScan", node_text(self.var), None
+
+    def apply(self, ctx, rows, offset=0, stop=None):
+        for row in rows:
+            nodes = ctx.graph.scan_nodes(offset)
+            for node in nodes if stop is None else islice(nodes, stop - offset):
+                yield {**row, self.var: node}
+
+
+class NodeByLabelScan:
+    def __init__(self, var, label):
+        self.var = var
+        self.label = label
+
+    def size(self, ctx):
+        return ctx.graph.label_count(self.label)
+
+    def describe(self, graph):
+        return "NodeByLabelScan", node_text(self.var, self.label), None
+
+    def apply(self, ctx, rows, offset=0, stop=None):
+        for row in rows:
+            nodes = ctx.graph.scan_label(self.label, offset)
+            for node in nodes if stop is None else islice(nodes, stop - offset):
+                yield {**row, self.var: node}
+
+
+class ColumnarLabelScan:
+    # Label scan with WHERE predicates on the scanned node evaluated as NumPy
+    # masks over the label's property columns (see columnar.py), so only the
+    # matching nodes become rows. Falls back to row-by-row evaluation inside
+    # transactions and for values the masks do not model.
+    def __init__(self, var, label, programs, predicates):
+        self.var = var
+        self.label = label
+        self.programs = programs
+        self.predicates = predicates
+
+    def size(self, ctx):
+        return ctx.graph.label_count(self.label)
+
+    def describe(self, graph):
+        where = " AND ".join(to_text(predicate) for predicate in self.predicates)
+        return "ColumnarLabelScan", f"{node_text(self.var, self.label)} WHERE {where}", None
+
+    def apply(self, ctx, rows, offset=0, stop=None):
+        columns = getattr(ctx.graph, "columns", None)
+        slots = None
+        if columns is not None:
+            try:
+                slots = columns.select(self.label, self.programs, lambda expr: evaluate(expr, {}, ctx), offset, stop)
+            except columnar.NotVectorisable:
+                pass
+        if slots is None:
+            rows = NodeByLabelScan(self.var, self.label).apply(ctx, rows, offset, stop)
+            for row in rows:
+                if all(evaluate(predicate, row, ctx) is True for predicate in self.predicates):
+                    yield row
+            return
+        nodes = ctx.graph.nodes
+        for row in rows:
+            for slot in slots:
+                yield {**row, self.var: nodes[slot]}
+
+
+class NodeIndexSeek:
+    # Equality lookup through a composite or single-property index
+    def __init__(self, var, label, props):
+        self.var = var
+        self.label = label
+        self.props = props
+
+    def describe(self, graph):
+        return "NodeIndexSeek", node_text(self.var, self.label, self.props), ", ".join(graph.seek_indexes(self.label, self.props))
+
+    def apply(self, ctx, rows):
+        graph = ctx.graph
+        for row in rows:
+            values = {key: evaluate(expr, row, ctx) for key, expr in self.props.items()}
+            for node_id in graph.seek(self.label, values) or ():
+                yield {**row, self.var: graph.node_by_id[node_id]}
+
+
+class NodeRangeSeek:
+    # `var.prop <op> value`; with `upper` ((op, value) of a < or <= bound),
+    # op / value are the lower bound and both ends are bisected
+    def __init__(self, var, label, prop, op, value, upper=None):
+        self.var = var
+        self.label = label
+        self.prop = prop
+        self.op = op
+        self.value = value
+        self.upper = upper
+
+    def describe(self, graph):
+        where = f"{display_name(self.var)}.{self.prop} {self.op} {to_text(self.value)}"
+        if self.upper is not None:
+            where += f" AND {display_name(self.var)}.{self.prop} {self.upper[0]} {to_text(self.upper[1])}"
+        return "NodeRangeSeek", f"{node_text(self.var, self.label)} WHERE {where}", f"range :{self.label}({self.prop})"
+
+    def apply(self, ctx, rows):
+        graph = ctx.graph
+        for row in rows:
+            value = evaluate(self.value, row, ctx)
+            if value is None:
+                continue
+            if self.upper is None:
+                node_ids = graph.range_scan(self.label, self.prop, self.op, value)
+            else:
+                upper_op, upper_expr = self.upper
+                upper = evaluate(upper_expr, row, ctx)
+                if upper is None:
+                    continue
+                node_ids = graph.range_scan_between(
+                    self.label, self.prop, (value, self.op == ">="), (upper, upper_op == "<="))
+            for node_id in node_ids:
+                yield {**row, self.var: graph.node_by_id[node_id]}
+
+
+class Expand:
+    # Follows the adjacency lists of a bound node. With `into`, the far end
+    # is already bound and the operator only checks that the edge exists.
+    def __init__(self, from_var, rel_var, to_var, types, direction, into=False):
+        self.from_var = from_var
+        self.rel_var = rel_var
+        self.to_var = to_var
+        self.types = types
+        self.direction = direction
+        self.into = into
+
+    def describe(self, graph):
+        pattern = rel_text(self.from_var, self.rel_var, self.to_var, self.types, self.direction)
+        return ("Expand(Into)" if self.into else "Expand(All)"), pattern, None
+
+    def apply(self, ctx, rows):
+        graph = ctx.graph
+        for row in rows:
+            node = row[self.from_var]
+            if node is None:
+                continue
+            # A relationship may only be matched once per pattern row
+            used = row_relationships(row)
+            for rel, other_id in graph.expand(node.id, self.types, self.direction):
+                if any(rel is seen for seen in used):
+                    continue
+                if self.into:
+                    if row[self.to_var].id == other_id:
+                        yield {**row, self.rel_var: rel}
+                else:
+                    yield {**row, self.rel_var: rel, self.to_var: graph.node_by_id[other_id]}
+
+
+class VarExpand:
+    # -[:T*min..max]-: every trail (a walk using no relationship twice) of
+    # min..max hops from a bound node, depth first. The relationship variable
+    # is bound to the list of relationships in pattern order.
+    def __init__(self, from_var, rel_var, to_var, types, direction, min_hops, max_hops, props,
+                 into=False, backwards=False):
+        self.from_var = from_var
+        self.rel_var = rel_var
+        self.to_var = to_var
+        self.types = types
+        self.direction = direction
+        self.min_hops = min_hops
+        self.max_hops = max_hops
+        self.props = props
+        self.into = into
+        # Planned right to left, so the walk is the reverse of the pattern
+        self.backwards = backwards
+
+    def describe(self, graph):
+        pattern = rel_text(self.from_var, self.rel_var, self.to_var, self.types, self.direction,
+                           hops_text(self.min_hops, self.max_hops))
+        return ("VarLengthExpand(Into)" if self.into else "VarLengthExpand(All)"), pattern, None
+
+    def apply(self, ctx, rows):
+        graph = ctx.graph
+        max_hops = ctx.depth_limit(self.max_hops)
+        for row in rows:
+            node = row[self.from_var]
+            if node is None:
+                continue
+            target = row[self.to_var] if self.into else None
+            for end_id, rels in self.walk(ctx, row, node.id, max_hops):
+                if self.backwards:
+                    rels.reverse()
+                if self.into:
+                    if target.id == end_id:
+                        yield {**row, self.rel_var: rels}
+                else:
+                    yield {**row, self.rel_var: rels, self.to_var: graph.node_by_id[end_id]}
+
+    def walk(self, ctx, row, start_id, max_hops):
+        # Iterative DFS: stack[i] iterates the edges leaving the end of trail[:i]
+        graph = ctx.graph
+        used = {rel.id for rel in row_relationships(row)}
+        trail = []
+        if self.min_hops == 0:
+            yield start_id, []
+        stack = [iter(graph.expand(start_id, self.types, self.direction))] if max_hops else []
+        while stack:
+            step = next(stack[-1], None)
+            if step is None:
+                stack.pop()
+                if trail:
+                    used.discard(trail.pop().id)
+                continue
+            rel, other_id = step
+            ctx.expanded()
+            if rel.id in used or (self.props and not props_match(rel, self.props, ctx, row)):
+                continue
+            trail.append(rel)
+            if len(trail) >= self.min_hops:
+                yield other_id, list(trail)
+            if len(trail) < max_hops:
+                used.add(rel.id)
+                stack.append(iter(graph.expand(other_id, self.types, self.direction)))
+            else:
+                trail.pop()
+
+
+class ShortestPath:
+    # shortestPath(...) / allShortestPaths(...) between two bound nodes
+    def __init__(self, path_var, from_var, rel_var, to_var, types, direction, min_hops, max_hops, props, all_paths):
+        self.path_var = path_var
+        self.from_var = from_var
+        self.rel_var = rel_var
+        self.to_var = to_var
+        self.types = types
+        self.direction = direction
+        self.min_hops = min_hops
+        self.max_hops = max_hops
+        self.props = props
+        self.all_paths = all_paths
+
+    def describe(self, graph):
+        pattern = rel_text(self.from_var, self.rel_var, self.to_var, self.types, self.direction,
+                           hops_text(self.min_hops, self.max_hops))
+        if self.all_paths:
+            return "AllShortestPaths", f"allShortestPaths({pattern})", None
+        return "ShortestPath", f"shortestPath({pattern})", None
+
+    def apply(self, ctx, rows):
+        max_hops = ctx.depth_limit(self.max_hops)
+        for row in rows:
+            source, target = row[self.from_var], row[self.to_var]
+            if source is None or target is None:
+                continue
+            if source is target:
+                paths = [Path([source], [])] if self.min_hops == 0 else []
+            else:
+                accept = (lambda rel: props_match(rel, self.props, ctx, row)) if self.props else None
+                paths = shortest_paths(ctx, source, target, self.types, self.direction, max_hops, self.all_paths, accept)
+            for path in paths:
+                found = {**row, self.rel_var: path.relationships}
+                if self.path_var:
+                    found[self.path_var] = path
+                yield found
+
+
+class BindPath:
+    # p = (a)-[...]-(b): the path value, rebuilt from the bound nodes and relationships
+    def __init__(self, var, start_var, rel_vars):
+        self.var = var
+        self.start_var = start_var
+        self.rel_vars = rel_vars
+
+    def describe(self, graph):
+        parts = ", ".join(display_name(var) for var in [self.start_var, *self.rel_vars])
+        return "BindPath", f"{display_name(self.var)} = path({parts})", None
+
+    def apply(self, ctx, rows):
+        node_by_id = ctx.graph.node_by_id
+        for row in rows:
+            nodes = [row[self.start_var]]
+            rels = []
+            for rel_var in self.rel_vars:
+                value = row[rel_var]
+                for rel in value if isinstance(value, list) else [value]:
+                    current = nodes[-1].id
+                    nodes.append(node_by_id[rel.end_node if rel.start_node == current else rel.start_node])
+                    rels.append(rel)
+            yield {**row, self.var: Path(nodes, rels)}
+
+
+class _Search:
+    # One side of a bidirectional breadth-first search. Visited nodes are
+    # flagged in a bytearray indexed by slot; nodes without a slot (written
+    # inside the current transaction) are tracked by id in `parents`, which
+    # holds the links back toward the root for the nodes this side reached.
+    def __init__(self, root, direction, size):
+        self.direction = direction
+        self.seen = bytearray(size)
+        self.parents = {}
+        self.frontier = [root]
+        self.mark(root)
+        self.parents[search_key(root)] = []
+
+    def visited(self, node):
+        slot = node.slot
+        if slot is not None and slot < len(self.seen):
+            return self.seen[slot]
+        return node.id in self.parents
+
+    def mark(self, node):
+        slot = node.slot
+        if slot is not None and slot < len(self.seen):
+            self.seen[slot] = 1
+
+    def grow(self, ctx, types, other, all_paths, accept):
+        # Advance one level; returns the new nodes the other side has reached
+        graph = ctx.graph
+        node_by_id = graph.node_by_id
+        parents = self.parents
+        level = {}
+        meets = []
+        for node in self.frontier:
+            for rel, other_id in graph.expand(node.id, types, self.direction):
+                ctx.expanded()
+                if accept is not None and not accept(rel):
+                    continue
+                reached = node_by_id[other_id]
+                key = search_key(reached)
+                if self.visited(reached):
+                    # Another shortest way into a node first reached on this level
+                    if all_paths and key in level:
+                        parents[key].append((rel, node))
+                    continue
+                self.mark(reached)
+                parents[key] = [(rel, node)]
+                level[key] = reached
+                if other.visited(reached):
+                    meets.append(reached)
+                    if not all_paths:
+                        return meets
+        self.frontier = list(level.values())
+        return meets
+
+    def walks(self, node, first_only):
+        # (nodes, relationships) of the walks from the root to `node`
+        links = self.parents[search_key(node)]
+        if not links:
+            yield [node], []
+            return
+        for rel, previous in links[:1] if first_only else links:
+            for nodes, rels in self.walks(previous, first_only):
+                yield nodes + [node], rels + [rel]
+                if first_only:
+                    return
+
+
+def search_key(node):
+    return node.slot if node.slot is not None else node.id
+
+
+def shortest_paths(ctx, source, target, types, direction, max_hops, all_paths, accept=None):
+    # Bidirectional BFS: the side with the smaller frontier grows one level at
+    # a time, so the search explores about twice b^(d/2) nodes instead of b^d.
+    # The first level on which the sides meet gives the shortest length, and
+    # every node met on it lies on a shortest path.
+    reverse = {"out": "in", "in": "out", "both": "both"}
+    size = ctx.graph.node_count()
+    forward = _Search(source, direction, size)
+    backward = _Search(target, reverse[direction], size)
+    for _ in range(max_hops):
+        if not forward.frontier or not backward.frontier:
+            return []
+        if len(forward.frontier) <= len(backward.frontier):
+            meets = forward.grow(ctx, types, backward, all_paths, accept)
+        else:
+            meets = backward.grow(ctx, types, forward, all_paths, accept)
+        if meets:
+            break
+    else:
+        return []
+    paths = []
+    for node in meets:
+        for head_nodes, head_rels in forward.walks(node, not all_paths):
+            for tail_nodes, tail_rels in backward.walks(node, not all_paths):
+                paths.append(Path(head_nodes + tail_nodes[-2::-1], head_rels + tail_rels[::-1]))
+        if not all_paths:
+            break
+    return paths
+
+
+def row_relationships(row):
+    # Relationships bound in a row, including those of variable-length matches
+    rels = []
+    for value in row.values():
+        if isinstance(value, Relationship):
+            rels.append(value)
+        elif isinstance(value, list):
+            rels.extend(item for item in value if isinstance(item, Relationship))
+    return rels
+
+
+class PatternFilter:
+    # Labels and inline {key: value} maps of a node or relationship pattern
+    def __init__(self, var, labels, props):
+        self.var = var
+        self.labels = labels
+        self.props = props
+
+    def describe(self, graph):
+        labels = "".join(f":{label}" for label in self.labels)
+        props = f" {to_text(MapLiteral(self.props))}" if self.props else ""
+        return "Filter", f"{display_name(self.var)}{labels}{props}", None
+
+    def apply(self, ctx, rows):
+        for row in rows:
+            entity = row[self.var]
+            if any(label not in entity.labels for label in self.labels):
+                continue
+            if self.props and not props_match(entity, self.props, ctx, row):
+                continue
+            yield row
+
+
+class Filter:
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def describe(self, graph):
+        return "Filter", to_text(self.predicate), None
+
+    def apply(self, ctx, rows):
+        for row in rows:
+            if evaluate(self.predicate, row, ctx) is True:
+                yield row
+
+
+# ---- Aggregation and ordering ----
+
+def order_value(value):
+    # Sort key giving Cypher's order across types: maps, nodes, relationships,
+    # lists, paths, strings, booleans, numbers, and null last. Numbers and
+    # strings are told apart the way WHERE compares them (see order_key).
+    if value is None:
+        return (8,)
+    if isinstance(value, bool):
+        return (6, value)
+    if isinstance(value, dict):
+        return (0, tuple(sorted((key, order_value(item)) for key, item in value.items())))
+    if isinstance(value, Node):
+        return (1, value.id)
+    if isinstance(value, Relationship):
+        return (2, value.id)
+    if isinstance(value, list):
+        return (3, tuple(order_value(item) for item in value))
+    if isinstance(value, Path):
+        return (4, len(value), tuple(entity.id for entity in value.nodes + value.relationships))
+    numeric, key = order_key(value)
+    return (7, key) if numeric else (5, key)
+
+
+class Descending:
+    # Sort key wrapper that reverses the order of the key it holds
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+def group_key(value):
+    # Hashable stand-in for a value when grouping: equal numbers (1 and 1.0)
+    # share a key, entities are keyed by identity
+    if isinstance(value, bool):
+        return bool, value
+    if isinstance(value, (list, dict, Path)):
+        return list, repr(to_output(value))
+    return value
+
+
+def _number(function, value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    numeric, key = order_key(value)
+    if not numeric or isinstance(value, bool):
+        raise QueryError(f"{function}() expects numbers, got {value!r}")
+    return key
+
+
+class Count:
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def result(self):
+        return self.count
+
+
+class Sum:
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += _number("sum", value)
+
+    def result(self):
+        return self.total
+
+
+class Avg:
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += _number("avg", value)
+        self.count += 1
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+
+class Min:
+    # In ORDER BY order
+    def __init__(self):
+        self.value = None
+        self.key = None
+
+    def add(self, value):
+        key = order_value(value)
+        if self.key is None or self.better(key):
+            self.value = value
+            self.key = key
+
+    def better(self, key):
+        return key < self.key
+
+    def result(self):
+        return self.value
+
+
+class Max(Min):
+    def better(self, key):
+        return key > self.key
+
+
+class Collect:
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def result(self):
+        return self.values
+
+
+aggregate_functions = {"count": Count, "sum": Sum, "avg": Avg, "min": Min, "max": Max, "collect": Collect}
+
+
+def aggregate_var(number):
+    # Row variable holding an aggregate's result; the space keeps it out of RETURN *
+    return f" agg{number}"
+
+
+class Aggregation:
+    # Streaming hash aggregation. Every row is folded into the accumulators of
+    # its group as it arrives, so memory grows with the number of groups, not
+    # of rows. The group key is the values of the RETURN items that contain no
+    # aggregate; the first row of a group stands in for it when the outputs
+    # are evaluated, with the aggregate results added as variables.
+    def __init__(self, keys, calls, outputs):
+        self.keys = keys
+        self.calls = calls
+        self.outputs = outputs
+
+    def start(self):
+        return [aggregate_functions[call.name]() for call in self.calls], [
+            set() if call.distinct else None for call in self.calls
+        ]
+
+    def apply(self, ctx, rows):
+        groups = {}
+        calls = list(enumerate(self.calls))
+        for row in rows:
+            key = tuple(group_key(evaluate(expr, row, ctx)) for expr in self.keys)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (row, *self.start())
+            _, states, seen = group
+            for i, call in calls:
+                arg = call.args[0]
+                if isinstance(arg, Star):
+                    states[i].add(None)
+                    continue
+                value = evaluate(arg, row, ctx)
+                if value is None:
+                    continue
+                if seen[i] is not None:
+                    marker = group_key(value)
+                    if marker in seen[i]:
+                        continue
+                    seen[i].add(marker)
+                states[i].add(value)
+        if not groups and not self.keys:
+            # Aggregating no rows still gives one row (count(*) = 0)
+            groups[()] = ({}, *self.start())
+        for row, states, _ in groups.values():
+            row = {**row, **{aggregate_var(i): state.result() for i, state in enumerate(states)}}
+            yield [evaluate(expr, row, ctx) for expr in self.outputs], row
+
+
+def is_aggregate(expr):
+    return isinstance(expr, FunctionCall) and expr.name in aggregate_functions
+
+
+def subexpressions(expr):
+    if isinstance(expr, Property):
+        return [expr.subject]
+    if isinstance(expr, BinaryOp):
+        return [expr.left, expr.right]
+    if isinstance(expr, (UnaryOp, IsNull)):
+        return [expr.operand]
+    if isinstance(expr, FunctionCall):
+        return list(expr.args)
+    if isinstance(expr, ListLiteral):
+        return list(expr.items)
+    if isinstance(expr, MapLiteral):
+        return list(expr.items.values())
+    return []
+
+
+def contains_aggregate(expr):
+    return is_aggregate(expr) or any(contains_aggregate(sub) for sub in subexpressions(expr))
+
+
+def expression_key(expr):
+    # Structural identity of an expression, to match ORDER BY against RETURN
+    if isinstance(expr, (list, tuple)):
+        return tuple(expression_key(item) for item in expr)
+    if isinstance(expr, dict):
+        return tuple(sorted((key, expression_key(item)) for key, item in expr.items()))
+    if hasattr(expr, "__dict__"):
+        return type(expr).__name__, expression_key(vars(expr))
+    return expr
+
+
+def extract_aggregates(expr, calls):
+    # Copy of expr in which every aggregate call is replaced by the variable
+    # that will hold its result; the calls are appended to `calls`
+    if is_aggregate(expr):
+        if len(expr.args) != 1 or (isinstance(expr.args[0], Star) and expr.name != "count"):
+            raise QueryError(f"{expr.name}() takes exactly one argument")
+        if contains_aggregate(expr.args[0]):
+            raise QueryError("Aggregate functions cannot be nested")
+        calls.append(expr)
+        return Variable(aggregate_var(len(calls) - 1))
+    if isinstance(expr, Property):
+        return Property(extract_aggregates(expr.subject, calls), expr.key)
+    if isinstance(expr, BinaryOp):
+        return BinaryOp(expr.op, extract_aggregates(expr.left, calls), extract_aggregates(expr.right, calls))
+    if isinstance(expr, UnaryOp):
+        return UnaryOp(expr.op, extract_aggregates(expr.operand, calls))
+    if isinstance(expr, IsNull):
+        return IsNull(extract_aggregates(expr.operand, calls), expr.negated)
+    if isinstance(expr, FunctionCall):
+        return FunctionCall(expr.name, [extract_aggregates(arg, calls) for arg in expr.args], expr.distinct)
+    if isinstance(expr, ListLiteral):
+        return ListLiteral([extract_aggregates(item, calls) for item in expr.items])
+    if isinstance(expr, MapLiteral):
+        return MapLiteral({key: extract_aggregates(value, calls) for key, value in expr.items.items()})
+    return expr
+
+
+def check_grouped(expr, grouped):
+    # Outside its aggregates, an aggregating expression may only use the
+    # grouping keys, or else its value would differ between rows of a group
+    if is_aggregate(expr) or expression_key(expr) in grouped:
+        return
+    if isinstance(expr, Variable):
+        raise QueryError(f"Variable '{expr.name}' is used next to an aggregate but is not a grouping key")
+    for sub in subexpressions(expr):
+        check_grouped(sub, grouped)
+
+
+def sort_rows(plan, ctx, results, count=None):
+    # ORDER BY. With a LIMIT only the first `count` rows are needed: they are
+    # selected with a heap of that size (O(n log k) time, O(k) memory)
+    # instead of sorting every row. Both keep ties in arrival order.
+    names = [name for _, name in plan.columns]
+
+    def key(result):
+        values, row = result
+        scope = None
+        parts = []
+        for index, expr, descending in plan.order:
+            if index is not None:
+                value = values[index]
+            else:
+                if scope is None:
+                    # Returned columns are visible under their names
+                    scope = {**row, **dict(zip(names, values))}
+                value = evaluate(expr, scope, ctx)
+            part = order_value(value)
+            parts.append(Descending(part) if descending else part)
+        return tuple(parts)
+
+    if count is None:
+        yield from sorted(results, key=key)
+    else:
+        yield from heapq.nsmallest(count, results, key=key)
+
+
+# ---- Planner ----
+
+class Plan:
+    def __init__(self, operators, return_clause, columns, whole_graph=False, aggregation=None, order=None):
+        self.operators = operators
+        self.return_clause = return_clause
+        self.columns = columns
+        self.whole_graph = whole_graph
+        # Aggregation of the projected rows, or None
+        self.aggregation = aggregation
+        # ORDER BY as [(column index or None, expression, descending)]
+        self.order = order or []
+
+
+def range_predicate(pred, var):
+    # `var.prop <op> constant` (either side), normalised to (prop, op, expr)
+    flipped = {"<": ">", ">": "<", "<=": ">=", ">=": "<=", "=": "=", "<>": "<>"}
+    if not isinstance(pred, BinaryOp) or pred.op not in flipped:
+        return None
+    left, right, op = pred.left, pred.right, pred.op
+    if is_constant(left) and not is_constant(right):
+        left, right, op = right, left, flipped[op]
+    if (isinstance(left, Property) and isinstance(left.subject, Variable)
+            and left.subject.name == var and is_constant(right)):
+        return left.key, ("!=" if op == "<>" else op), right
+    return None
+
+
+def column_program(pred, var):
+    # A WHERE conjunct on `var` as a columnar mask program, or None when it
+    # needs the row-by-row evaluator
+    if isinstance(pred, BinaryOp) and pred.op in ("AND", "OR", "XOR"):
+        left = column_program(pred.left, var)
+        right = column_program(pred.right, var)
+        return columnar.Logical(pred.op, left, right) if left and right else None
+    if isinstance(pred, UnaryOp) and pred.op == "NOT":
+        operand = column_program(pred.operand, var)
+        return columnar.Not(operand) if operand else None
+    if isinstance(pred, IsNull):
+        operand = pred.operand
+        if isinstance(operand, Property) and isinstance(operand.subject, Variable) and operand.subject.name == var:
+            return columnar.IsNull(operand.key, pred.negated)
+        return None
+    found = range_predicate(pred, var)
+    return columnar.Compare(*found) if found else None
+
+
+def fuse_column_filters(operators):
+    # A label scan followed by WHERE filters on the scanned node becomes one
+    # ColumnarLabelScan; filters it cannot take stay where they were
+    fused = []
+    i = 0
+    while i < len(operators):
+        operator = operators[i]
+        i += 1
+        if not isinstance(operator, NodeByLabelScan):
+            fused.append(operator)
+            continue
+        programs, predicates, kept = [], [], []
+        while i < len(operators) and isinstance(operators[i], (Filter, PatternFilter)):
+            following = operators[i]
+            program = column_program(following.predicate, operator.var) if isinstance(following, Filter) else None
+            if program is None:
+                kept.append(following)
+            else:
+                programs.append(program)
+                predicates.append(following.predicate)
+            i += 1
+        if programs:
+            scan = ColumnarLabelScan(operator.var, operator.label, programs, predicates)
+            scan.estimated_rows = getattr(operator, "estimated_rows", None)
+            fused.append(scan)
+        else:
+            fused.append(operator)
+        fused.extend(kept)
+    return fused
+
+
+def choose_node_access(node, pending, graph, ctx, use_index=True):
+    # Cheapest way to produce the first node of a pattern, by estimated rows;
+    # with use_index=False only scans are considered
+    # Each option also names the WHERE conjuncts the operator makes redundant
+    var = node.var
+    options = [(graph.node_count(), AllNodesScan(var), ())]
+    constant_props = {key: expr for key, expr in node.props.items() if is_constant(expr)}
+    for label in node.labels:
+        options.append((graph.label_count(label), NodeByLabelScan(var, label), ()))
+        if not use_index:
+            continue
+        if constant_props:
+            values = {key: evaluate(expr, {}, ctx) for key, expr in constant_props.items()}
+            estimate = graph.estimate_seek(label, values)
+            if estimate is not None:
+                options.append((estimate, NodeIndexSeek(var, label, constant_props), ()))
+        # prop -> ([lower bounds], [upper bounds]) as (op, expr, value, predicate)
+        bounds = {}
+        for pred in pending:
+            found = range_predicate(pred, var)
+            if not found:
+                continue
+            prop, op, value_expr = found
+            value = evaluate(value_expr, {}, ctx)
+            if value is None:
+                continue
+            if graph.has_range_index(label, prop):
+                estimate = graph.range_count(label, prop, op, value)
+                options.append((estimate, NodeRangeSeek(var, label, prop, op, value_expr), (pred,)))
+                if op in (">", ">=", "<", "<="):
+                    bounds.setdefault(prop, ([], []))[op[0] == "<"].append((op, value_expr, value, pred))
+            elif op == "=" and isinstance(value, str) and not order_key(value)[0] and graph.has_index(label, prop):
+                # Hash keys are str(value), which agrees with `=` for non-numeric strings
+                estimate = graph.estimate_seek(label, {prop: value})
+                options.append((estimate, NodeIndexSeek(var, label, {prop: value_expr}), (pred,)))
+        # A lower and an upper bound on one property become a single bounded seek
+        for prop, (lowers, uppers) in bounds.items():
+            for low_op, low_expr, low, low_pred in lowers:
+                for high_op, high_expr, high, high_pred in uppers:
+                    estimate = graph.range_count_between(label, prop, (low, low_op == ">="), (high, high_op == "<="))
+                    seek = NodeRangeSeek(var, label, prop, low_op, low_expr, (high_op, high_expr))
+                    options.append((estimate, seek, (low_pred, high_pred)))
+    # Prefer the smallest estimate; on ties prefer the more selective operator
+    # kind, which comes later in `options`
+    return min(reversed(options), key=lambda option: option[0])
+
+
+def place_filters(operators, pending, bound):
+    for pred in list(pending):
+        if variables_in(pred) <= bound:
+            operators.append(Filter(pred))
+            pending.remove(pred)
+
+
+def plan_pattern(pattern, operators, pending, bound, graph, ctx, use_index=True):
+    nodes = pattern.nodes
+    for rel in pattern.rels:
+        if rel.var in bound:
+            raise QueryError(f"Relationship variable '{rel.var}' is already bound")
+    if pattern.var is not None and pattern.var in bound:
+        raise QueryError(f"Path variable '{pattern.var}' is already bound")
+    if pattern.shortest:
+        plan_shortest_path(pattern, operators, pending, bound, graph, ctx, use_index)
+        return
+
+    # Start from an already bound node if there is one, otherwise from the
+    # node with the cheapest access path
+    start = next((i for i, node in enumerate(nodes) if node.var in bound), None)
+    covered_label = None
+    if start is None:
+        best = None
+        for i, node in enumerate(nodes):
+            cost, operator, consumed = choose_node_access(node, pending, graph, ctx, use_index)
+            if best is None or cost < best[0]:
+                best = (cost, i, operator, consumed)
+        cost, start, operator, consumed = best
+        # Shown by EXPLAIN / PROFILE next to the actual row count
+        operator.estimated_rows = cost
+        operators.append(operator)
+        for pred in consumed:
+            pending.remove(pred)
+        # Label scans and index seeks only produce nodes carrying their label
+        covered_label = getattr(operator, "label", None)
+    node = nodes[start]
+    labels = [label for label in node.labels if label != covered_label]
+    bound.add(node.var)
+    if labels or node.props:
+        operators.append(PatternFilter(node.var, labels, node.props))
+    place_filters(operators, pending, bound)
+
+    # Expand to the right, then to the left of the start node
+    steps = [(i, nodes[i], pattern.rels[i], nodes[i + 1], False) for i in range(start, len(nodes) - 1)]
+    steps += [(i, nodes[i + 1], pattern.rels[i], nodes[i], True) for i in range(start - 1, -1, -1)]
+    reverse = {"out": "in", "in": "out", "both": "both"}
+    for _, source, rel, target, backwards in steps:
+        direction = reverse[rel.direction] if backwards else rel.direction
+        into = target.var in bound
+        if rel.variable_length:
+            operators.append(VarExpand(
+                source.var, rel.var, target.var, rel.types, direction,
+                rel.min_hops, rel.max_hops, rel.props, into, backwards
+            ))
+        else:
+            operators.append(Expand(source.var, rel.var, target.var, rel.types, direction, into))
+            if rel.props:
+                operators.append(PatternFilter(rel.var, [], rel.props))
+        bound.add(rel.var)
+        if target.labels or target.props:
+            operators.append(PatternFilter(target.var, target.labels, target.props))
+        bound.add(target.var)
+        place_filters(operators, pending, bound)
+
+    if pattern.var is not None:
+        operators.append(BindPath(pattern.var, nodes[0].var, [rel.var for rel in pattern.rels]))
+        bound.add(pattern.var)
+        place_filters(operators, pending, bound)
+
+
+def plan_shortest_path(pattern, operators, pending, bound, graph, ctx, use_index=True):
+    # Both ends are matched first (each through its cheapest access path),
+    # then the search runs between every pair of them
+    rel = pattern.rels[0]
+    if rel.min_hops > 1:
+        raise QueryError("shortestPath only supports a minimum length of 0 or 1")
+    for node in pattern.nodes:
+        plan_pattern(PathPattern([node], []), operators, pending, bound, graph, ctx, use_index)
+    start, end = pattern.nodes
+    operators.append(ShortestPath(
+        pattern.var, start.var, rel.var, end.var, rel.types, rel.direction,
+        rel.min_hops, rel.max_hops, rel.props, pattern.shortest == "all"
+    ))
+    bound.add(rel.var)
+    if pattern.var is not None:
+        bound.add(pattern.var)
+    place_filters(operators, pending, bound)
+
+
+def plan_query(query, graph, params=None, use_index=True):
+    clauses = query.clauses
+    if not clauses or not isinstance(clauses[-1], ReturnClause):
+        raise QueryError("Query must end with RETURN")
+    matches = clauses[:-1]
+    if not matches or not all(isinstance(clause, MatchClause) for clause in matches):
+        raise QueryError("Only MATCH ... [WHERE ...] RETURN ... queries are supported")
+    return_clause = clauses[-1]
+
+    ctx = ExecutionContext(graph, params)
+    operators = []
+    bound = set()
+    pending = []
+    for clause in matches:
+        pending.extend(split_conjuncts(clause.where))
+    for clause in matches:
+        for pattern in clause.patterns:
+            plan_pattern(pattern, operators, pending, bound, graph, ctx, use_index)
+    if pending:
+        missing = set().union(*[variables_in(pred) for pred in pending]) - bound
+        raise QueryError(f"Variable '{sorted(missing)[0]}' not defined" if missing else "Unplannable WHERE clause")
+    if columnar.available:
+        operators = fuse_column_filters(operators)
+
+    items = []
+    for item in return_clause.items:
+        if isinstance(item.expr, Star):
+            items.extend((Variable(var), var) for var in sorted(bound) if not var.startswith(" "))
+        else:
+            unknown = variables_in(item.expr) - bound
+            if unknown:
+                raise QueryError(f"Variable '{sorted(unknown)[0]}' not defined")
+            items.append((item.expr, item.name))
+
+    # `MATCH (n) RETURN n` is the whole-graph view and also returns every relationship
+    only = matches[0].patterns[0] if len(matches) == 1 and len(matches[0].patterns) == 1 else None
+    whole_graph = (
+        only is not None and not only.rels and not only.nodes[0].labels and not only.nodes[0].props
+        and matches[0].where is None and len(items) == 1 and isinstance(items[0][0], Variable)
+        and items[0][0].name == only.nodes[0].var and not return_clause.distinct
+    )
+    for clause_expr in (return_clause.skip, return_clause.limit):
+        if clause_expr is not None and not is_constant(clause_expr):
+            raise QueryError("SKIP and LIMIT must be literals or parameters")
+
+    names = [name for _, name in items]
+    aggregating = any(contains_aggregate(expr) for expr, _ in items)
+    calls = []
+    if aggregating:
+        keys = [expr for expr, _ in items if not contains_aggregate(expr)]
+        grouped = {expression_key(expr) for expr in keys}
+        outputs = []
+        for expr, _ in items:
+            if contains_aggregate(expr):
+                check_grouped(expr, grouped)
+                expr = extract_aggregates(expr, calls)
+            outputs.append(expr)
+        # ORDER BY may also use the returned columns by name
+        grouped |= {expression_key(Variable(name)) for name in names}
+
+    order = []
+    column_keys = [expression_key(expr) for expr, _ in items]
+    for sort in return_clause.order_by:
+        expr = sort.expr
+        if isinstance(expr, Variable) and expr.name in names:
+            index = names.index(expr.name)
+        elif expression_key(expr) in column_keys:
+            index = column_keys.index(expression_key(expr))
+        else:
+            index = None
+            if aggregating:
+                check_grouped(expr, grouped)
+                expr = extract_aggregates(expr, calls)
+            elif return_clause.distinct:
+                raise QueryError("ORDER BY after RETURN DISTINCT can only use the returned columns")
+            elif contains_aggregate(expr):
+                raise QueryError("ORDER BY can only use aggregates when RETURN aggregates")
+            unknown = variables_in(sort.expr) - bound - set(names)
+            if unknown:
+                raise QueryError(f"Variable '{sorted(unknown)[0]}' not defined")
+        order.append((index, expr, sort.descending))
+
+    aggregation = Aggregation(keys, calls, outputs) if aggregating else None
+    return Plan(operators, return_clause, items, whole_graph, aggregation, order)
+
+
+# ---- Execution ----
+
+def to_output(value):
+    if isinstance(value, (Node, Relationship, Path)):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [to_output(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_output(item) for key, item in value.items()}
+    return value
+
+
+def row_bounds(plan, ctx):
+    bounds = []
+    for name, expr in (("SKIP", plan.return_clause.skip), ("LIMIT", plan.return_clause.limit)):
+        value = None if expr is None else evaluate(expr, {}, ctx)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            raise QueryError(f"{name} must be a non-negative integer, got {value!r}")
+        bounds.append(value)
+    return bounds
+
+
+def execute_plan(plan, graph, params=None, parallel=True, limits=None, profiler=None):
+    # Lazily yields (values, row) pairs. Projection, DISTINCT, SKIP and LIMIT
+    # are applied as rows stream out of the operator pipeline, so a LIMIT
+    # stops the underlying scans and expansions as soon as it is reached.
+    # Aggregation and ORDER BY have to see every row first. Large scans that
+    # are read to the end are split across workers (see parallel.py), except
+    # under PROFILE, which instruments every stage in this process.
+    ctx = ExecutionContext(graph, params, limits, profiler)
+    skip, limit = row_bounds(plan, ctx)
+    skip = skip or 0
+    distinct = plan.return_clause.distinct
+    reads_all = plan.aggregation is not None or bool(plan.order)
+
+    def track(stage_rows, describe):
+        return stage_rows if profiler is None else profiler.wrap(describe(), stage_rows)
+
+    rows = iter([{}])
+    operators = plan.operators
+    if (skip and not distinct and not reads_all and len(operators) == 1
+            and isinstance(operators[0], (AllNodesScan, NodeByLabelScan))):
+        rows = track(operators[0].apply(ctx, rows, offset=skip), lambda: describe_operator(operators[0], graph))
+        skip = 0
+    elif (parallel and profiler is None and (limit is None or reads_all) and operators
+          and isinstance(operators[0], (AllNodesScan, NodeByLabelScan, ColumnarLabelScan))
+          and use_parallel(graph, operators[0].size(ctx))):
+        rows = parallel_rows(operators, ctx, operators[0].size(ctx), limits)
+    else:
+        for operator in operators:
+            rows = track(operator.apply(ctx, rows), lambda: describe_operator(operator, graph))
+
+    def project():
+        seen = set()
+        if plan.aggregation is not None:
+            projected = plan.aggregation.apply(ctx, rows)
+        else:
+            projected = (([evaluate(expr, row, ctx) for expr, _ in plan.columns], row) for row in rows)
+        for values, row in projected:
+            if distinct:
+                key = tuple(repr(to_output(value)) for value in values)
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield values, row
+
+    results = track(project(), lambda: describe_projection(plan))
+    if plan.order:
+        results = track(sort_rows(plan, ctx, results, None if limit is None else skip + limit),
+                        lambda: describe_sort(plan))
+    results = islice(results, skip, None if limit is None else skip + limit)
+    if skip or limit is not None:
+        results = track(results, lambda: describe_limit(plan))
+    return results
+
+
+# ---- EXPLAIN / PROFILE ----
+
+def describe_operator(operator, graph):
+    # (operator, details, index, estimated rows) of a pipeline stage
+    name, details, index = operator.describe(graph)
+    return name, details, index or None, getattr(operator, "estimated_rows", None)
+
+
+def describe_projection(plan):
+    if plan.aggregation is not None:
+        keys = ", ".join(to_text(expr) for expr in plan.aggregation.keys)
+        calls = ", ".join(to_text(call) for call in plan.aggregation.calls)
+        details = f"{keys}; {calls}" if keys else calls
+        return ("Distinct" if plan.return_clause.distinct else "") + "Aggregation", details, None, None
+    columns = ", ".join(
+        to_text(expr) if to_text(expr) == display_name(name) else f"{to_text(expr)} AS {display_name(name)}"
+        for expr, name in plan.columns
+    )
+    return ("Distinct" if plan.return_clause.distinct else "Projection"), columns, None, None
+
+
+def describe_sort(plan):
+    # The ORDER BY items as written; a LIMIT makes the sort a top-k selection
+    order = ", ".join(
+        to_text(sort.expr) + (" DESC" if sort.descending else "") for sort in plan.return_clause.order_by
+    )
+    limit = plan.return_clause.limit
+    if limit is None:
+        return "Sort", order, None, None
+    return "Top", f"{order} LIMIT {describe_bound(plan.return_clause.skip, limit)}", None, None
+
+
+def describe_bound(skip, limit):
+    return to_text(limit) if skip is None else f"{to_text(skip)} + {to_text(limit)}"
+
+
+def describe_limit(plan):
+    clause = plan.return_clause
+    parts = []
+    if clause.skip is not None:
+        parts.append(f"SKIP {to_text(clause.skip)}")
+    if clause.limit is not None:
+        parts.append(f"LIMIT {to_text(clause.limit)}")
+    return ("Limit" if clause.limit is not None else "Skip"), " ".join(parts), None, None
+
+
+def describe_plan(plan, graph):
+    # The stages execute_plan runs, in pipeline order, without running them
+    stages = [describe_operator(operator, graph) for operator in plan.operators]
+    stages.append(describe_projection(plan))
+    if plan.order:
+        stages.append(describe_sort(plan))
+    if plan.return_clause.skip is not None or plan.return_clause.limit is not None:
+        stages.append(describe_limit(plan))
+    return [
+        {"operator": name, "details": details, "estimated_rows": estimated_rows, "index": index}
+        for name, details, index, estimated_rows in stages
+    ]
+
+
+def collect_entities(value, nodes, rels):
+    # Nodes and relationships in a returned value, for the graph view
+    if isinstance(value, Node):
+        nodes.setdefault(value.id, value)
+    elif isinstance(value, Relationship):
+        rels.setdefault(value.id, value)
+    elif isinstance(value, Path):
+        for node in value.nodes:
+            nodes.setdefault(node.id, node)
+        for rel in value.relationships:
+            rels.setdefault(rel.id, rel)
+    elif isinstance(value, list):
+        for item in value:
+            collect_entities(item, nodes, rels)
+
+
+def run_plan(plan, graph, params=None, limits=None, profiler=None):
+    entity_only = all(isinstance(expr, Variable) for expr, _ in plan.columns)
+    bounded = plan.return_clause.skip is not None or plan.return_clause.limit is not None
+    nodes = {}
+    rels = {}
+    bound_rels = []
+    out_rows = []
+    for values, row in execute_plan(plan, graph, params, limits=limits, profiler=profiler):
+        out_rows.append(values)
+        for value in values:
+            collect_entities(value, nodes, rels)
+        bound_rels.extend(row_relationships(row))
+
+    if plan.whole_graph and not bounded:
+        rels = {rel.id: rel for rel in graph.scan_relationships()}
+    elif plan.whole_graph:
+        # A page of the whole graph carries the relationships between its nodes
+        for node_id in nodes:
+            for rel, other_id in graph.expand(node_id, (), "out"):
+                if other_id in nodes:
+                    rels.setdefault(rel.id, rel)
+    else:
+        # Relationships walked by the pattern are returned when both ends are
+        for rel in bound_rels:
+            if rel.start_node in nodes and rel.end_node in nodes:
+                rels.setdefault(rel.id, rel)
+
+    if plan.whole_graph:
+        message = f"{len(nodes)} nodes and {len(rels)} relationships returned"
+    else:
+        message = f"{len(out_rows)} row(s) matched"
+    result = {
+        "message": message,
+        "nodes": [node.to_dict() for node in nodes.values()],
+        "relationships": [rel.to_dict() for rel in rels.values()]
+    }
+    if not entity_only:
+        result["columns"] = [name for _, name in plan.columns]
+        result["rows"] = [[to_output(value) for value in values] for values in out_rows]
+    return result
+
+
+class Cursor:
+    # Pull-based access to a query result: rows are produced only as batches
+    # are fetched, so a client can page through a large result
+    def __init__(self, plan, graph, params=None, limits=None):
+        self.graph = graph
+        self.columns = [name for _, name in plan.columns]
+        self.exhausted = False
+        self.rows_fetched = 0
+        with lock_manager.locked(graph.resource, SHARED):
+            # Pages are pulled lazily, which parallel execution would defeat
+            self._rows = execute_plan(plan, graph, params, parallel=False, limits=limits)
+
+    def fetch(self, size=100):
+        if self.exhausted:
+            return []
+        batch = []
+        # Each batch is read under a shared lock; writers can run between batches
+        with lock_manager.locked(self.graph.resource, SHARED):
+            for values, _ in islice(self._rows, size):
+                batch.append(dict(zip(self.columns, [to_output(value) for value in values])))
+        self.rows_fetched += len(batch)
+        if len(batch) < size:
+            self.close()
+        return batch
+
+    def __iter__(self):
+        while not self.exhausted:
+            yield from self.fetch()
+
+    def close(self):
+        self.exhausted = True
+        self._rows = iter(())
+
+
+class PlanCache:
+    # LRU cache of compiled plans keyed on the normalized query text. Plans
+    # hold no entities, only operator descriptions, so one plan serves every
+    # parameter set of the same query shape.
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            plan = self.plans.get(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self.plans.move_to_end(key)
+            self.hits += 1
+            return plan
+
+    def put(self, key, plan):
+        with self.lock:
+            self.plans[key] = plan
+            self.plans.move_to_end(key)
+            while len(self.plans) > self.capacity:
+                self.plans.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.plans),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+plan_cache = PlanCache()
+
+
+def param_kind(value):
+    # What choose_node_access tells apart about a parameter: a hash seek
+    # only stands in for `=` on non-numeric strings, and nulls seek nothing
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        return "numeric string" if order_key(value)[0] else "string"
+    return type(value).__name__
+
+
+def plan_cache_key(text, graph, use_index=True, params=None):
+    # Plans are per database and are re-planned after an index is created
+    # or the graph doubles in size, since either can change the best plan.
+    # The access path may depend on the kinds of the parameter values, so
+    # those are part of the key too.
+    size_class = int(math.log2(graph.node_count() + 1))
+    kinds = tuple(sorted((name, param_kind(value)) for name, value in (params or {}).items()))
+    return graph.db_path, graph.schema_version, size_class, use_index, kinds, normalize(text)
+
+
+def get_plan(text, graph, params=None, use_index=True):
+    key = plan_cache_key(text, graph, use_index, params)
+    plan = plan_cache.get(key)
+    if plan is None:
+        plan = plan_query(parse(text), graph, params, use_index)
+        plan_cache.put(key, plan)
+    return plan
+
+
+def run_query(text, graph, params=None, limits=None, use_index=True):
+    return run_plan(get_plan(text, graph, params, use_index), graph, params, limits)
+
+
+def open_cursor(text, graph, params=None, limits=None, use_index=True):
+    return Cursor(get_plan(text, graph, params, use_index), graph, params, limits)
+
+
+def explain_query(text, graph, params=None, use_index=True):
+    plan = get_plan(text, graph, params, use_index)
+    return {"message": "Query plan (not executed)", "nodes": [], "relationships": [], "plan": describe_plan(plan, graph)}
+
+
+def profile_query(text, graph, params=None, limits=None, use_index=True):
+    # Runs the query and adds, per stage: rows produced, db hits and the
+    # time spent in the stage itself
+    plan = get_plan(text, graph, params, use_index)
+    profiler = Profiler()
+    started = time.perf_counter()
+    result = run_plan(plan, graph, params, limits, profiler)
+    total_ms = round((time.perf_counter() - started) * 1000, 3)
+    result["plan"] = profiler.report()
+    result["total_db_hits"] = sum(stage["db_hits"] for stage in result["plan"])
+    result["total_time_ms"] = total_ms
+    result["message"] += f" ({result['total_db_hits']} db hits, {total_ms} ms)"
+    return result
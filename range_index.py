@@ -0,0 +1,137 @@
+import math
+from bisect import bisect_left, bisect_right
+
+
+def order_key(value):
+    # Numbers (including numeric strings such as "25") and strings are kept in
+    # separate orderings, so values are cast once when indexed, not per query
+    if isinstance(value, bool):
+        return False, str(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return False, str(value)
+    # "NaN" / "Infinity" are names, not numbers, and NaN would break the ordering
+    if not math.isfinite(number):
+        return False, str(value)
+    return True, number
+
+
+def compare_keys(left, operator, right):
+    # Keys of different kinds never compare, except for '!='
+    if left[0] != right[0]:
+        return operator == '!='
+    left, right = left[1], right[1]
+    if operator == '=':
+        return left == right
+    if operator == '!=':
+        return left != right
+    if operator == '>':
+        return left > right
+    if operator == '<':
+        return left < right
+    if operator == '>=':
+        return left >= right
+    if operator == '<=':
+        return left <= right
+    raise ValueError(f"Unsupported operator: {operator}")
+
+
+class RangeIndex:
+    # Sorted arrays of keys with a parallel array of node ids, searched with bisect
+    def __init__(self):
+        self.keys = {True: [], False: []}
+        self.ids = {True: [], False: []}
+
+    def insert(self, value, node_id):
+        numeric, key = order_key(value)
+        keys = self.keys[numeric]
+        pos = bisect_right(keys, key)
+        keys.insert(pos, key)
+        self.ids[numeric].insert(pos, node_id)
+
+    def remove(self, value, node_id):
+        numeric, key = order_key(value)
+        keys = self.keys[numeric]
+        ids = self.ids[numeric]
+        for pos in range(bisect_left(keys, key), bisect_right(keys, key)):
+            if ids[pos] == node_id:
+                del keys[pos]
+                del ids[pos]
+                return
+
+    def build(self, entries):
+        # Bulk load from (value, node id) pairs with a single sort per ordering
+        pairs = {True: [], False: []}
+        for value, node_id in entries:
+            numeric, key = order_key(value)
+            pairs[numeric].append((key, node_id))
+        for numeric, items in pairs.items():
+            items.sort(key=lambda item: item[0])
+            self.keys[numeric] = [key for key, _ in items]
+            self.ids[numeric] = [node_id for _, node_id in items]
+
+    def entries(self):
+        for numeric in (True, False):
+            for key, node_id in zip(self.keys[numeric], self.ids[numeric]):
+                yield (numeric, key), node_id
+
+    def count(self, operator, value):
+        # Number of ids scan() would return, without copying them
+        numeric, key = order_key(value)
+        keys = self.keys[numeric]
+        if operator == '=':
+            return bisect_right(keys, key) - bisect_left(keys, key)
+        if operator == '<':
+            return bisect_left(keys, key)
+        if operator == '<=':
+            return bisect_right(keys, key)
+        if operator == '>':
+            return len(keys) - bisect_right(keys, key)
+        if operator == '>=':
+            return len(keys) - bisect_left(keys, key)
+        if operator == '!=':
+            return len(keys) - self.count('=', value) + len(self.keys[not numeric])
+        raise ValueError(f"Unsupported operator: {operator}")
+
+    def _span(self, lower, upper):
+        # Positions [start, stop) of the keys between two bounds, each a
+        # (value, inclusive) pair; bounds of different kinds match nothing
+        (low, low_inclusive), (high, high_inclusive) = lower, upper
+        numeric, low_key = order_key(low)
+        high_numeric, high_key = order_key(high)
+        if numeric != high_numeric:
+            return numeric, 0, 0
+        keys = self.keys[numeric]
+        start = bisect_left(keys, low_key) if low_inclusive else bisect_right(keys, low_key)
+        stop = bisect_right(keys, high_key) if high_inclusive else bisect_left(keys, high_key)
+        return numeric, start, max(start, stop)
+
+    def count_between(self, lower, upper):
+        _, start, stop = self._span(lower, upper)
+        return stop - start
+
+    def scan_between(self, lower, upper):
+        # Node ids with lower < value < upper (or <= per bound), in O(log n + k)
+        numeric, start, stop = self._span(lower, upper)
+        return self.ids[numeric][start:stop]
+
+    def scan(self, operator, value):
+        # Node ids whose value satisfies `<indexed value> <operator> value`,
+        # in O(log n + k)
+        numeric, key = order_key(value)
+        keys = self.keys[numeric]
+        ids = self.ids[numeric]
+        if operator == '=':
+            return ids[bisect_left(keys, key):bisect_right(keys, key)]
+        if operator == '<':
+            return ids[:bisect_left(keys, key)]
+        if operator == '<=':
+            return ids[:bisect_right(keys, key)]
+        if operator == '>':
+            return ids[bisect_right(keys, key):]
+        if operator == '>=':
+            return ids[bisect_left(keys, key):]
+        if operator == '!=':
+            return ids[:bisect_left(keys, key)] + ids[bisect_right(keys, key):] + self.ids[not numeric]
+        raise ValueError(f"Unsupported operator: {operator}")
@@ -0,0 +1,271 @@
+import os
+import re
+import json
+import asyncio
+import argparse
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from utils import hash_password
+from cypher_engine import execute_query, open_cursor
+from cypher_parser import CypherSyntaxError
+from query_planner import QueryError
+from mvcc import begin_transaction, TransactionError
+
+# Standalone query service, so programs can use the engine without the
+# Streamlit UI. The protocol is JSON lines over TCP or a Unix socket: every
+# request is one object with an "op" and an optional "id", and every response
+# echoes the id and carries either "result" or "error".
+#
+#   {"id": 1, "op": "login", "database": "DB1", "password": "..."}
+#   {"id": 2, "op": "query", "query": "MATCH (n:Person) RETURN n.name", "params": {}}
+#       optional "limits": {"max_depth": 10, "max_expansions": 100000} for path queries
+#   {"id": 3, "op": "begin"}            also "commit" and "rollback"
+#   {"id": 4, "op": "open", "query": "MATCH ..."}     -> {"cursor": 1, "columns": [...]}
+#   {"id": 5, "op": "fetch", "cursor": 1, "size": 100} -> {"rows": [...], "done": false}
+#   {"id": 6, "op": "close", "cursor": 1}
+#   {"id": 7, "op": "ping"}
+#
+# Each connection is a session: its database, open transaction and cursors.
+# A client may pipeline requests (send many before reading the answers). They
+# are executed in order per session, on a shared thread pool across sessions,
+# and answered in order. Backpressure: at most `pipeline_depth` requests of a
+# session are buffered, after which the server stops reading from that socket,
+# and a response is not followed by the next one until the client has read it.
+#
+# The server may run next to the Streamlit app on the same database folders.
+# The processes exclude each other through the database's db.lock while they
+# load, log or checkpoint (see GraphStorage), and a process picks up the
+# other's logged writes on its next statement. A statement sees the database
+# as of its start: a MERGE in each process can still create the same node
+# twice, and a transaction is validated against what its own process has
+# loaded when it commits.
+
+DEFAULT_PORT = 7688
+# Largest request line accepted, in bytes
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+database_name = re.compile(r"^\w+$")
+
+
+class RequestError(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, databases):
+        self.databases = databases
+        self.db_path = None
+        self.transaction = None
+        self.cursors = {}
+        self.cursor_ids = count(1)
+
+    def handle(self, request):
+        op = request.get("op")
+        handler = getattr(self, f"op_{op}", None) if isinstance(op, str) else None
+        if handler is None:
+            raise RequestError(f"Unknown op: {op!r}")
+        if op not in ("login", "ping") and self.db_path is None:
+            raise RequestError("Not logged in to a database")
+        return handler(request)
+
+    def op_ping(self, request):
+        return "pong"
+
+    def op_login(self, request):
+        # Same check as the Streamlit login page
+        name = request.get("database")
+        if not isinstance(name, str) or not database_name.match(name):
+            raise RequestError(f"Invalid database name: {name!r}")
+        db_path = os.path.join(self.databases, name)
+        pwd_path = os.path.join(db_path, "password.txt")
+        if not os.path.exists(pwd_path):
+            raise RequestError(f"Unknown database: {name}")
+        with open(pwd_path) as f:
+            stored_hash = f.read().strip()
+        if hash_password(str(request.get("password", ""))) != stored_hash:
+            raise RequestError("Incorrect password")
+        self.close()
+        self.db_path = db_path
+        return {"database": name}
+
+    def op_query(self, request):
+        query = request.get("query")
+        if not isinstance(query, str):
+            raise RequestError("query must be a string")
+        result = execute_query(
+            query, self.db_path, params=request.get("params"), transaction=self.transaction, limits=request.get("limits")
+        )
+        if "error" in result:
+            raise RequestError(result["error"])
+        return result
+
+    def op_begin(self, request):
+        if self.transaction is not None:
+            raise RequestError("A transaction is already open")
+        self.transaction = begin_transaction(self.db_path)
+        return {"transaction": "open"}
+
+    def op_commit(self, request):
+        transaction = self._end_transaction()
+        try:
+            return transaction.commit()
+        except TransactionError as e:
+            raise RequestError(f"Transaction failed: {e}")
+
+    def op_rollback(self, request):
+        self._end_transaction().rollback()
+        return {"transaction": "rolled back"}
+
+    def _end_transaction(self):
+        if self.transaction is None:
+            raise RequestError("No transaction is open")
+        transaction, self.transaction = self.transaction, None
+        return transaction
+
+    def op_open(self, request):
+        query = request.get("query")
+        if not isinstance(query, str):
+            raise RequestError("query must be a string")
+        try:
+            cursor = open_cursor(
+                query, self.db_path, params=request.get("params"), transaction=self.transaction, limits=request.get("limits")
+            )
+        except (CypherSyntaxError, QueryError) as e:
+            raise RequestError(str(e))
+        cursor_id = next(self.cursor_ids)
+        self.cursors[cursor_id] = cursor
+        return {"cursor": cursor_id, "columns": cursor.columns}
+
+    def op_fetch(self, request):
+        cursor = self._cursor(request)
+        size = request.get("size", 100)
+        if not isinstance(size, int) or size <= 0:
+            raise RequestError("size must be a positive integer")
+        try:
+            rows = cursor.fetch(size)
+        except (QueryError, TransactionError) as e:
+            raise RequestError(str(e))
+        if cursor.exhausted:
+            self.cursors.pop(request["cursor"], None)
+        return {"rows": rows, "done": cursor.exhausted}
+
+    def op_close(self, request):
+        self._cursor(request).close()
+        del self.cursors[request["cursor"]]
+        return {"closed": request["cursor"]}
+
+    def _cursor(self, request):
+        cursor = self.cursors.get(request.get("cursor"))
+        if cursor is None:
+            raise RequestError(f"Unknown cursor: {request.get('cursor')!r}")
+        return cursor
+
+    def close(self):
+        # Called when the connection goes away or the session switches database
+        if self.transaction is not None:
+            self.transaction.rollback()
+            self.transaction = None
+        for cursor in self.cursors.values():
+            cursor.close()
+        self.cursors.clear()
+        self.db_path = None
+
+
+class GraphServer:
+    def __init__(self, databases="databases", workers=None, pipeline_depth=32):
+        self.databases = databases
+        self.pipeline_depth = pipeline_depth
+        # Queries are blocking calls into the engine, so they run on threads
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) + 4))
+        # Connection handler task -> its writer, so close() can end them
+        self.connections = {}
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+        if unix_path:
+            self.server = await asyncio.start_unix_server(self.handle_connection, unix_path, limit=MAX_REQUEST_SIZE)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_REQUEST_SIZE)
+        return self.server
+
+    async def serve_forever(self, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+        server = await self.start(host, port, unix_path)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    async def handle_connection(self, reader, writer):
+        session = Session(self.databases)
+        self.connections[asyncio.current_task()] = writer
+        requests = asyncio.Queue(self.pipeline_depth)
+        responder = asyncio.create_task(self._respond(session, requests, writer))
+        try:
+            while not responder.done():
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Over MAX_REQUEST_SIZE: the stream cannot be resynchronised
+                    await requests.put(RequestError(f"Request exceeds {MAX_REQUEST_SIZE} bytes"))
+                    break
+                if not line:
+                    break
+                # Waits while the session has pipeline_depth requests queued
+                await requests.put(line)
+        except ConnectionError:
+            pass
+        finally:
+            await requests.put(None)
+            await asyncio.gather(responder, return_exceptions=True)
+            await asyncio.get_running_loop().run_in_executor(self.executor, session.close)
+            del self.connections[asyncio.current_task()]
+            writer.close()
+
+    async def _respond(self, session, requests, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await requests.get()
+            if line is None:
+                return
+            request_id = None
+            try:
+                if isinstance(line, RequestError):
+                    raise line
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    raise RequestError(f"Invalid request: {e}")
+                if not isinstance(request, dict):
+                    raise RequestError("A request must be a JSON object")
+                request_id = request.get("id")
+                result = await loop.run_in_executor(self.executor, session.handle, request)
+                response = {"id": request_id, "result": result}
+            except RequestError as e:
+                response = {"id": request_id, "error": str(e)}
+            except Exception as e:
+                response = {"id": request_id, "error": f"Internal error: {e}"}
+            writer.write(json.dumps(response, default=str).encode() + b"\n")
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the graph databases over a JSON-lines socket protocol")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", help="listen on a Unix socket at this path instead of TCP")
+    parser.add_argument("--databases", default="databases", help="folder holding the database folders")
+    parser.add_argument("--workers", type=int, help="threads running queries")
+    parser.add_argument("--pipeline", type=int, default=32, help="requests buffered per session")
+    args = parser.parse_args()
+    service = GraphServer(args.databases, args.workers, args.pipeline)
+    asyncio.run(service.serve_forever(args.host, args.port, args.unix))
@@ -0,0 +1,22 @@
+import os
+from binary_storage import json_to_binary, binary_to_json, MANIFEST_FILE
+from graph_cache import CachedGraph
+from cypher_engine import execute_query
+
+
+def snapshot(graph):
+    nodes = sorted((n.id, sorted(n.labels), dict(n.properties)) for n in graph.nodes)
+    rels = sorted((r.id, r.start_node, r.end_node, r.rel_type, dict(r.properties)) for r in graph.relationships)
+    return nodes, rels
+
+
+def test_round_trip_through_the_binary_store(tmp_path):
+    db = str(tmp_path)
+    execute_query("CREATE (a:P {name: 'Alice', age: 25.0})-[:KNOWS {since: 2020}]->(b:Q {name: 'Bob', ok: true})", db)
+    before = snapshot(CachedGraph(db))
+    json_to_binary(db)
+    assert os.path.exists(os.path.join(db, MANIFEST_FILE))
+    assert snapshot(CachedGraph(db)) == before
+    binary_to_json(db)
+    assert not os.path.exists(os.path.join(db, MANIFEST_FILE))
+    assert snapshot(CachedGraph(db)) == before
@@ -0,0 +1,30 @@
+import time
+import parallel
+from graph_cache import get_graph
+from cypher_engine import execute_query
+
+QUERY = "MATCH (a:P)-[:R*1..2]->(b) RETURN count(*)"
+
+
+def test_expansion_limit_is_shared_by_all_partitions(tmp_path):
+    db = str(tmp_path)
+    for i in range(20):
+        execute_query(f"CREATE (a:P {{i: {i}}})-[:R]->(b:P {{i: {i}}})", db)
+    # 40 expansions in all, at most 10 in any of the 8 partitions below
+    limits = {"max_expansions": 30}
+    serial = execute_query(QUERY, db, limits=limits)
+    assert "max_expansions" in serial["error"]
+
+    previous = parallel.parallelism(), parallel.MIN_PARALLEL_ROWS
+    try:
+        parallel.set_parallelism(2, min_rows=0)
+        graph = get_graph(db)
+        deadline = time.time() + 60
+        while not parallel.warm_up(graph, wait_loaded=True):
+            assert time.time() < deadline
+            time.sleep(0.1)
+        assert parallel.use_parallel(graph, len(graph.nodes))
+        assert "max_expansions" in execute_query(QUERY, db, limits=limits)["error"]
+        assert execute_query(QUERY, db, limits={"max_expansions": 40})["rows"] == [[20]]
+    finally:
+        parallel.set_parallelism(*previous)
@@ -0,0 +1,24 @@
+from cypher_engine import execute_query, create_index
+
+
+def make_people(db_path):
+    create_index(str(db_path), "P", "age")
+    create_index(str(db_path), "P", "name")
+    execute_query("CREATE (n:P {name: 'Alice', age: 25.0})", str(db_path))
+
+
+def test_string_then_number_parameter(tmp_path):
+    # A hash seek planned for a string must not be reused for a number
+    make_people(tmp_path)
+    query = "MATCH (n:P) WHERE n.age = $v RETURN n.name"
+    assert execute_query(query, str(tmp_path), params={"v": "x"})["rows"] == []
+    assert execute_query(query, str(tmp_path), params={"v": 25})["rows"] == [["Alice"]]
+    assert execute_query(query, str(tmp_path), params={"v": None})["rows"] == []
+
+
+def test_integer_and_float_literals_do_not_share_a_plan(tmp_path):
+    execute_query("CREATE (n:P {age: 7})", str(tmp_path))
+    assert execute_query("MATCH (n:P) RETURN n.age / 2", str(tmp_path))["rows"] == [[3]]
+    result = execute_query("MATCH (n:P) RETURN n.age / 2.0", str(tmp_path))
+    assert result["columns"] == ["n.age / 2.0"]
+    assert result["rows"] == [[3.5]]
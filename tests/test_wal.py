@@ -0,0 +1,30 @@
+import os
+import sys
+import subprocess
+from graph_cache import CachedGraph, get_graph
+from graph_entities import Node
+from cypher_engine import execute_query
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_in_other_process(db, name):
+    code = f"from cypher_engine import execute_query; execute_query(\"CREATE (n:P {{name: '{name}'}})\", {db!r})"
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+
+
+def names(graph):
+    return sorted(node.properties["name"] for node in graph.nodes)
+
+
+def test_checkpoint_keeps_writes_of_another_process(tmp_path):
+    db = str(tmp_path)
+    execute_query("CREATE (n:P {name: 'first'})", db)
+    graph = get_graph(db)
+    create_in_other_process(db, "theirs")
+    # Written against a copy that has not seen the other process's node
+    graph.add_node(Node("mine", ["P"], {"name": "mine"}))
+    graph.commit()
+    graph.checkpoint()
+    assert names(CachedGraph(db)) == ["first", "mine", "theirs"]
+    assert names(get_graph(db)) == ["first", "mine", "theirs"]
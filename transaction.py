@@ -1,7 +1,7 @@
 import os
-import json
 import streamlit as st
 from cypher_engine import execute_query
+from mvcc import begin_transaction, TransactionConflict
 
 def transaction_page():
     db_name = st.session_state.get("current_db")
@@ -10,7 +10,6 @@ def transaction_page():
         return
 
     db_path = os.path.join("databases", db_name)
-    temp_path = os.path.join(db_path, "transaction_temp")
     lilac = "#C8A2C8"
 
     st.markdown(f"<h2 style='color:{lilac}'>⚙️ Transaction Manager</h2>", unsafe_allow_html=True)
@@ -23,28 +22,24 @@ def transaction_page():
     if st.button("🔙 Back to Main DB"):
         if st.session_state.transaction_active:
             st.session_state.transaction_active = False
-            cleanup_transaction(temp_path)
+            rollback_transaction()
             st.warning("Transaction rolled back before returning to Main DB.")
         st.switch_page("main_db.py")
 
     if not st.session_state.transaction_active:
         if st.button("🔄 BEGIN TRANSACTION"):
-            os.makedirs(temp_path, exist_ok=True)
-            for f in ["nodes.json", "relationships.json"]:
-                src = os.path.join(db_path, f)
-                dst = os.path.join(temp_path, f)
-                if os.path.exists(src):
-                    with open(src, 'r') as fr, open(dst, 'w') as fw:
-                        json.dump(json.load(fr), fw, indent=2)
+            # A snapshot of the resident graph; nothing is copied
+            st.session_state.transaction = begin_transaction(db_path)
             st.session_state.transaction_active = True
             st.success("Transaction started.")
     else:
         st.info("Transaction in progress...")
+        transaction = st.session_state.transaction
 
         query = st.text_area("Run Cypher Query (in transaction)", height=150)
 
         if st.button("Execute Query"):
-            result = execute_query(query, temp_path, use_index=True)
+            result = execute_query(query, db_path, use_index=True, transaction=transaction)
             if "error" in result:
                 st.error(result["error"])
             else:
@@ -55,24 +50,26 @@ def transaction_page():
 
         with col1:
             if st.button("✅ COMMIT"):
-                for f in ["nodes.json", "relationships.json"]:
-                    src = os.path.join(temp_path, f)
-                    dst = os.path.join(db_path, f)
-                    if os.path.exists(src):
-                        with open(src, 'r') as fr, open(dst, 'w') as fw:
-                            json.dump(json.load(fr), fw, indent=2)
                 st.session_state.transaction_active = False
-                st.success("Changes committed to database.")
-                cleanup_transaction(temp_path)
+                try:
+                    # Only the transaction's own writes are applied
+                    applied = transaction.commit()
+                    st.success(
+                        f"Changes committed to database "
+                        f"({applied['nodes']} node(s), {applied['relationships']} relationship(s))."
+                    )
+                except TransactionConflict as e:
+                    st.error(f"Transaction aborted: {e}")
+                st.session_state.transaction = None
 
         with col2:
             if st.button("❌ ROLLBACK"):
                 st.session_state.transaction_active = False
-                cleanup_transaction(temp_path)
+                rollback_transaction()
                 st.warning("Transaction rolled back.")
 
-def cleanup_transaction(temp_path):
-    if os.path.exists(temp_path):
-        for file in os.listdir(temp_path):
-            os.remove(os.path.join(temp_path, file))
-        os.rmdir(temp_path)
+def rollback_transaction():
+    transaction = st.session_state.get("transaction")
+    if transaction is not None:
+        transaction.rollback()
+    st.session_state.transaction = None